@@ -24,3 +24,4 @@ import easy_reconcile
 import base_advanced_reconciliation
 import advanced_reconciliation
 import res_config  # noqa
+import reconcile_checkpoint
@@ -68,6 +68,13 @@ month, it will partial reconcile the debit move line with the first payment, the
 second month, it will partial reconcile the debit move line with 2 first
 payments, the third month, it will make the full reconciliation.
 
+When the reconciliation commits while it goes (setting of the company), the
+matched groups are saved in a checkpoint. If the run is interrupted, the next
+run of the profile resumes from the checkpoints without matching the items
+again, and its history includes the reconciliations of the interrupted run.
+The checkpoints are removed when the history is written. A checkpoint saved
+with another configuration of its method is discarded.
+
 This module is perfectly adapted for E-Commerce business where a big volume of
 move lines and so, reconciliations, are involved and payments often come from
 many offices.
@@ -75,7 +82,8 @@ many offices.
  """,
  'website': 'http://www.camptocamp.com',
  'data': ['easy_reconcile_view.xml',
-          'res_config_view.xml'],
+          'res_config_view.xml',
+          'security/ir.model.access.csv'],
  'test': [],
  'images': [],
  'installable': False,
@@ -20,6 +20,8 @@
 ##############################################################################
 
 from openerp.osv import orm
+from openerp.addons.account_easy_reconcile.base_reconciliation import (
+    normalize_ref, sql_normalize_ref)
 
 
 class easy_reconcile_advanced_ref(orm.TransientModel):
@@ -27,13 +29,16 @@ class easy_reconcile_advanced_ref(orm.TransientModel):
     _name = 'easy.reconcile.advanced.ref'
     _inherit = 'easy.reconcile.advanced'
 
+    _partner_shardable = True
+
     def _skip_line(self, cr, uid, rec, move_line, context=None):
         """
         When True is returned on some conditions, the credit move line
         will be skipped for reconciliation. Can be inherited to
         skip on some conditions. ie: ref or partner_id is empty.
         """
-        return not (move_line.get('ref') and move_line.get('partner_id'))
+        return not (normalize_ref(move_line.get('ref')) and
+                    move_line.get('partner_id'))
 
     def _matchers(self, cr, uid, rec, move_line, context=None):
         """
@@ -73,7 +78,7 @@ class easy_reconcile_advanced_ref(orm.TransientModel):
             A matching key can have multiples values.
         """
         return (('partner_id', move_line['partner_id']),
-                ('ref', move_line['ref'].lower().strip()))
+                ('ref', normalize_ref(move_line['ref'])))
 
     def _opposite_matchers(self, cr, uid, rec, move_line, context=None):
         """
@@ -114,5 +119,16 @@ class easy_reconcile_advanced_ref(orm.TransientModel):
         :yield: matchers as tuple ('matcher key', value(s))
         """
         yield ('partner_id', move_line['partner_id'])
-        yield ('ref', ((move_line['ref'] or '').lower().strip(),
-                       move_line['name'].lower().strip()))
+        yield ('ref', (normalize_ref(move_line['ref']),
+                       normalize_ref(move_line['name'])))
+
+    def _sql_matchers(self, rec):
+        """ SQL counterpart of the `_matchers()` / `_opposite_matchers()`
+        """
+        credit_ref = sql_normalize_ref('credit.ref')
+        return ["debit.partner_id = credit.partner_id",
+                "%s <> ''" % credit_ref,
+                "(%s = %s OR %s = %s)" % (sql_normalize_ref('debit.ref'),
+                                          credit_ref,
+                                          sql_normalize_ref('debit.name'),
+                                          credit_ref)]
@@ -21,6 +21,8 @@
 ##############################################################################
 import logging
 
+from bisect import bisect_left
+from collections import OrderedDict
 from itertools import product
 from openerp.osv import orm
 from openerp import pooler
@@ -30,31 +32,238 @@ from openerp.tools.translate import _
 _logger = logging.getLogger(__name__)
 
 
+class DisjointSet(object):
+    """ Disjoint-set (union-find) of move line ids
+
+    Used to merge the matched lines in groups: every union is done
+    in near-constant time and lines matched transitively end in the
+    same group.
+    """
+
+    def __init__(self):
+        # keep the insertion order so the groups are built
+        # in the order the lines have been matched
+        self._parents = OrderedDict()
+        self._sizes = {}
+
+    def __len__(self):
+        return len(self._parents)
+
+    def find(self, item):
+        """ Return the root of the set of the item, add it if unknown """
+        parents = self._parents
+        if item not in parents:
+            parents[item] = item
+            self._sizes[item] = 1
+            return item
+        while parents[item] != item:
+            # path halving
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+        return item
+
+    def union(self, *items):
+        """ Merge the sets of all the items, return the new root """
+        roots = [self.find(item) for item in items]
+        if not roots:
+            return None
+        root = max(roots, key=self._sizes.get)
+        for other in roots:
+            if other != root:
+                self._parents[other] = root
+                self._sizes[root] += self._sizes.pop(other)
+        return root
+
+    def groups(self):
+        """ Return the list of sets of items """
+        groups = OrderedDict()
+        for item in self._parents:
+            groups.setdefault(self.find(item), set()).add(item)
+        return groups.values()
+
+
+def _subset_sums(amounts):
+    """ Return the sums of all the subsets of amounts as a list of
+    tuples (sum, positions) sorted by sum """
+    sums = [(0, ())]
+    for position, amount in enumerate(amounts):
+        sums += [(total + amount, positions + (position,))
+                 for total, positions in sums]
+    sums.sort()
+    return sums
+
+
+def subset_sum(amounts, target, tolerance=0, max_nodes=100000,
+               mitm_limit=24):
+    """ Find a subset of amounts whose sum is ``target`` more or less
+    ``tolerance``
+
+    The amounts must be positive integers (as instance amounts in
+    cents). Up to ``mitm_limit`` amounts, the subsets are searched by
+    meet-in-the-middle: the sums of the subsets of each half are
+    enumerated and sorted, then each sum of the first half is completed
+    by a binary search in the second one. Above, a depth-first search
+    on the amounts sorted in decreasing order is stopped after
+    ``max_nodes`` nodes.
+
+    :return: list of the positions of the amounts of the subset
+             (the smallest one with the meet-in-the-middle search),
+             or None
+    """
+    if target <= 0 or not amounts:
+        return None
+    low, high = target - tolerance, target + tolerance
+    # a single amount is the most frequent case
+    for position, amount in enumerate(amounts):
+        if low <= amount <= high:
+            return [position]
+    if len(amounts) <= mitm_limit:
+        half = len(amounts) // 2
+        first = _subset_sums(amounts[:half])
+        second = _subset_sums(amounts[half:])
+        second_totals = [total for total, __ in second]
+        best = None
+        for total, positions in first:
+            if total > high:
+                break
+            idx = bisect_left(second_totals, low - total)
+            while idx < len(second) and second_totals[idx] + total <= high:
+                found = positions + tuple(half + position
+                                          for position in second[idx][1])
+                if found and (best is None or len(found) < len(best)):
+                    best = found
+                idx += 1
+        return sorted(best) if best else None
+    order = sorted(range(len(amounts)), key=lambda pos: -amounts[pos])
+    ordered = [amounts[pos] for pos in order]
+    # remaining[i] is the sum of the amounts from i to the end
+    remaining = [0] * (len(ordered) + 1)
+    for idx in xrange(len(ordered) - 1, -1, -1):
+        remaining[idx] = remaining[idx + 1] + ordered[idx]
+    nodes = [0]
+
+    def search(start, total, chosen):
+        nodes[0] += 1
+        if nodes[0] > max_nodes:
+            return None
+        for idx in xrange(start, len(ordered)):
+            new_total = total + ordered[idx]
+            if new_total + remaining[idx + 1] < low:
+                # even with all the next amounts, the sum is too small
+                return None
+            if new_total > high:
+                continue
+            chosen.append(idx)
+            if new_total >= low:
+                return list(chosen)
+            found = search(idx + 1, new_total, chosen)
+            if found:
+                return found
+            chosen.pop()
+            if nodes[0] > max_nodes:
+                return None
+        return None
+
+    found = search(0, 0, [])
+    return sorted(order[idx] for idx in found) if found else None
+
+
 class easy_reconcile_advanced(orm.AbstractModel):
     _name = 'easy.reconcile.advanced'
     _inherit = 'easy.reconcile.base'
 
-    def _query_debit(self, cr, uid, rec, context=None):
-        """Select all move (debit>0) as candidate. """
+    # look up the opposite lines in a hash index of their matchers
+    # rather than comparing every line, see `_use_opposites_index()`
+    _opposites_index = True
+
+    # the matchers require the equality of the partners, so the lines
+    # can be reconciled by buckets of partners, see `_get_shards()`
+    _partner_shardable = False
+
+    # bounds of the search of the debit lines paid by a credit line
+    # in the amount matching, see `subset_sum()`
+    _subset_max_nodes = 100000
+    _subset_mitm_limit = 24
+
+    def _query_lines(self, cr, uid, rec, column, context=None):
+        """ Build the query selecting the candidate move lines having an
+        amount in ``column`` ('debit' or 'credit')
+
+        :return: tuple (query, params)
+        """
+        assert column in ('debit', 'credit')
         select = self._select(rec)
         sql_from = self._from(rec)
         where, params = self._where(rec)
-        where += " AND account_move_line.debit > 0 "
+        where += " AND account_move_line.%s > 0 " % column
         where2, params2 = self._get_filter(cr, uid, rec, context=context)
-        query = ' '.join((select, sql_from, where, where2))
-        cr.execute(query, params + params2)
-        return cr.dictfetchall()
+        where3, params3 = self._shard_where(rec, context=context)
+        where4, params4 = self._incremental_where(rec, context=context)
+        query = ' '.join((select, sql_from, where, where2, where3, where4))
+        return query, params + params2 + params3 + params4
+
+    def _query_debit(self, cr, uid, rec, context=None):
+        """Select all move (debit>0) as candidate.
+
+        Unlike the credit lines, the debit lines are all loaded in memory:
+        they are the opposite lines indexed and looked up for every credit
+        line, so the memory used grows with the number of debit lines.
+
+        :return: list of `MoveLineRow`
+        """
+        query, params = self._query_lines(
+            cr, uid, rec, 'debit', context=context)
+        return list(self._fetch_lines(cr, query, params, context=context))
 
     def _query_credit(self, cr, uid, rec, context=None):
-        """Select all move (credit>0) as candidate. """
-        select = self._select(rec)
-        sql_from = self._from(rec)
-        where, params = self._where(rec)
-        where += " AND account_move_line.credit > 0 "
-        where2, params2 = self._get_filter(cr, uid, rec, context=context)
-        query = ' '.join((select, sql_from, where, where2))
-        cr.execute(query, params + params2)
-        return cr.dictfetchall()
+        """Select all move (credit>0) as candidate.
+
+        :return: iterator of `MoveLineRow`, the lines are fetched from
+                 a server-side cursor while they are consumed
+        """
+        query, params = self._query_lines(
+            cr, uid, rec, 'credit', context=context)
+        return self._fetch_lines(cr, query, params, context=context)
+
+    def _shard_where(self, rec, context=None):
+        """ Restrict the queries to the bucket of partners given by
+        ``reconcile_shard`` in the context, a tuple (index, count).
+        """
+        if not (context and context.get('reconcile_shard')):
+            return '', []
+        index, count = context['reconcile_shard']
+        where = ("AND account_move_line.partner_id IS NOT NULL "
+                 "AND mod(account_move_line.partner_id, %s) = %s ")
+        return where, [count, index]
+
+    def _incremental_where(self, rec, context=None):
+        """ In an incremental run, restrict the queries to the partners
+        having lines created or modified since the previous run.
+
+        Only the methods matching on the partner can be restricted,
+        the other ones always compare all the lines.
+        """
+        if not self._partner_shardable:
+            return '', []
+        return self._changed_where(rec, 'partner_id', context=context)
+
+    def _get_shards(self, cr, uid, rec, context=None):
+        """ Return the buckets of partners to reconcile one after the other
+
+        The number of buckets is configured on the company. The buckets
+        are reconciled in the current process, one after the other: the
+        sharding bounds the memory used by the lines of an account, it
+        does not reconcile the buckets in parallel. The profiles of
+        different accounts are run in parallel by
+        `account.easy.reconcile.run_reconcile_parallel()`.
+
+        :return: list of tuples (index, count), or [None] when the
+                 lines are not sharded
+        """
+        count = rec.journal_id.company_id.reconciliation_shards
+        if not (self._partner_shardable and count > 1):
+            return [None]
+        return [(index, count) for index in range(count)]
 
     def _matchers(self, cr, uid, rec, move_line, context=None):
         """
@@ -221,6 +430,83 @@ class easy_reconcile_advanced(orm.AbstractModel):
                 self._compare_opposite(
                     cr, uid, rec, move_line, op, matchers, context=context)]
 
+    def _use_opposites_index(self, cr, uid, rec, context=None):
+        """ Return True when the opposite move lines can be looked up
+        in a hash index instead of being scanned for each move line.
+
+        The index relies on the equality semantics of the base
+        `_compare_values()`, so it is disabled when the method sets
+        `_opposites_index` to False or when one of the comparison
+        or search methods is overridden.
+        """
+        if not self._opposites_index:
+            return False
+        for name in ('_compare_values',
+                     '_compare_matcher_values',
+                     '_compare_matchers',
+                     '_compare_opposite',
+                     '_search_opposites'):
+            method = getattr(type(self), name)
+            base_method = getattr(easy_reconcile_advanced, name)
+            if (getattr(method, '__func__', method) is not
+                    getattr(base_method, '__func__', base_method)):
+                return False
+        return True
+
+    @staticmethod
+    def _matcher_index_keys(matchers):
+        """ Generate the keys of the opposites index for the matchers
+
+        A matcher with several values produces one key per value,
+        empty values are never valid matchers so they are dropped.
+
+        :param matchers: iterable of ('matcher key', value(s))
+        :return: list of tuples of ('matcher key', value)
+        """
+        choices = []
+        for key, values in matchers:
+            if not isinstance(values, (list, tuple)):
+                values = values,
+            values = [(key, value) for value in values if value]
+            if not values:
+                return []
+            choices.append(values)
+        return list(product(*choices))
+
+    def _index_opposites(self, cr, uid, rec, opposite_move_lines,
+                         context=None):
+        """ Build a hash index of the opposite move lines keyed by
+        the values of their `_opposite_matchers()`
+
+        :param list opposite_move_lines: list of dict of move lines values
+        :return: dict with the matcher values as keys and lists of
+                 (position, move line) as values
+        """
+        index = {}
+        for position, opposite in enumerate(opposite_move_lines):
+            opp_matchers = self._opposite_matchers(
+                cr, uid, rec, opposite, context=context)
+            for key in self._matcher_index_keys(opp_matchers):
+                index.setdefault(key, []).append((position, opposite))
+        return index
+
+    def _search_opposites_indexed(self, cr, uid, rec, move_line, index,
+                                  context=None):
+        """Search the opposite move lines for a move line in the index
+        built by `_index_opposites()`
+
+        :param dict move_line: the move line for which we search opposites
+        :param dict index: index of the opposite move lines
+        :return: list of matching lines, in the same order as
+                 `_search_opposites()` would return them
+        """
+        matchers = self._matchers(cr, uid, rec, move_line, context=context)
+        found = {}
+        for key in self._matcher_index_keys(matchers):
+            for position, opposite in index.get(key, ()):
+                found[position] = opposite
+        return [found[position] for position in sorted(found)]
+
     def _action_rec(self, cr, uid, rec, context=None):
         # we use a new cursor to be able to commit the reconciliation
         # often. We have to create it here and not later to avoid problems
@@ -232,18 +518,65 @@ class easy_reconcile_advanced(orm.AbstractModel):
         ctx['commit_every'] = (
             rec.journal_id.company_id.reconciliation_commit_every
         )
+        if (ctx.get('reconcile_simulation') or
+                ctx.get('reconcile_no_commit')):
+            # nothing to commit, or the caller controls the transaction
+            ctx['commit_every'] = 0
+        # full reconciliations without write-off are done in bulk
+        # at each commit
+        ctx['reconcile_batch'] = []
+        ctx['reconcile_period_stops'] = {}
         if ctx['commit_every']:
             new_cr = pooler.get_db(cr.dbname).cursor()
         else:
             new_cr = cr
         try:
-            credit_lines = self._query_credit(new_cr, uid, rec, context=ctx)
-            debit_lines = self._query_debit(new_cr, uid, rec, context=ctx)
-            result = self._rec_auto_lines_advanced(
-                new_cr, uid, rec, credit_lines, debit_lines, context=ctx)
+            reconciled_ids, partial_ids = [], []
+            use_sql = self._use_sql_matching(new_cr, uid, rec, context=ctx)
+            for shard in self._get_shards(new_cr, uid, rec, context=ctx):
+                if shard:
+                    _logger.info("Reconcile the partners of the shard %d/%d",
+                                 shard[0] + 1, shard[1])
+                shard_ctx = dict(ctx, reconcile_shard=shard)
+                checkpoint_id = self._find_checkpoint(
+                    new_cr, uid, rec, context=shard_ctx)
+                if checkpoint_id:
+                    shard_reconciled_ids, shard_partial_ids = \
+                        self._resume_checkpoint(
+                            new_cr, uid, rec, checkpoint_id,
+                            context=shard_ctx)
+                elif use_sql:
+                    shard_reconciled_ids, shard_partial_ids = \
+                        self._rec_auto_lines_sql(
+                            new_cr, uid, rec, context=shard_ctx)
+                else:
+                    credit_lines = self._query_credit(
+                        new_cr, uid, rec, context=shard_ctx)
+                    debit_lines = self._query_debit(
+                        new_cr, uid, rec, context=shard_ctx)
+                    shard_reconciled_ids, shard_partial_ids = \
+                        self._rec_auto_lines_advanced(
+                            new_cr, uid, rec, credit_lines, debit_lines,
+                            context=shard_ctx)
+                    # release the lines of the shard before loading the next
+                    del credit_lines, debit_lines
+                reconciled_ids += shard_reconciled_ids
+                partial_ids += shard_partial_ids
+                if ctx['commit_every']:
+                    with self._stats_timing('commit', context=ctx):
+                        new_cr.commit()
+            # the checkpoints are kept until the history of the run of
+            # the profile is written, see `account.easy.reconcile`
+            result = reconciled_ids, partial_ids
         finally:
             if ctx['commit_every']:
-                new_cr.commit()
+                with self._stats_timing('commit', context=ctx):
+                    new_cr.commit()
+                stats = ctx.get('reconcile_stats')
+                if stats is not None:
+                    # the statements of the caller's cursor are
+                    # counted by the caller
+                    stats.count_statements(new_cr, 0)
                 new_cr.close()
         return result
 
@@ -255,44 +588,278 @@ class easy_reconcile_advanced(orm.AbstractModel):
         """
         return False
 
+    @staticmethod
+    def _log_groups_stats(reconcile_groups):
+        """ Log statistics about the size of the groups to reconcile """
+        if not reconcile_groups:
+            return
+        sizes = [len(group) for group in reconcile_groups]
+        _logger.info("Groups of lines: %d lines in %d groups, "
+                     "size min %d / avg %.1f / max %d",
+                     sum(sizes), len(sizes), min(sizes),
+                     float(sum(sizes)) / len(sizes), max(sizes))
+
+    def _sql_matchers(self, rec):
+        """ SQL counterpart of the `_matchers()` / `_opposite_matchers()`
+        used by the SQL matching engine, see `_use_sql_matching()`.
+
+        Can be inherited by the methods whose matchers are equalities
+        which can be expressed in SQL. Return the list of the conditions
+        joining a credit line (aliased ``credit``) with its opposite
+        debit lines (aliased ``debit``), which must also exclude the
+        credit lines skipped by `_skip_line()`. As instance:
+        ["debit.partner_id = credit.partner_id",
+         "lower(btrim(credit.ref, E' \\t\\r\\n')) <> ''",
+         "lower(btrim(debit.ref, E' \\t\\r\\n')) = "
+         "lower(btrim(credit.ref, E' \\t\\r\\n'))"]
+
+        The references are normalized with `sql_normalize_ref()`, which
+        is the counterpart of the `normalize_ref()` of the matchers.
+
+        A method which inherits `_matchers()` or `_opposite_matchers()`
+        must inherit this method too, or return None to use the
+        matching in Python.
+
+        :return: list of SQL conditions or None when the method has
+                 no SQL matchers
+        """
+        return None
+
+    def _use_sql_matching(self, cr, uid, rec, context=None):
+        """ Return True when the lines are matched by a SQL join
+        instead of the `_matchers()` in Python: the method has
+        `_sql_matchers()` and the company enables the SQL matching.
+        """
+        company = rec.journal_id.company_id
+        if not company.reconciliation_sql_matching:
+            return False
+        return self._sql_matchers(rec) is not None
+
+    def _query_matches(self, cr, uid, rec, context=None):
+        """ Join the credit lines with their opposite debit lines
+        using the `_sql_matchers()`
+
+        The candidate queries are used as sub-queries so PostgreSQL
+        can use the functional indexes on the expressions of the
+        matchers (as instance ``sql_normalize_ref('ref')``).
+
+        :return: list of tuples (credit line id, debit line id)
+        """
+        credit_query, credit_params = self._query_lines(
+            cr, uid, rec, 'credit', context=context)
+        debit_query, debit_params = self._query_lines(
+            cr, uid, rec, 'debit', context=context)
+        query = ("SELECT credit.id, debit.id "
+                 "FROM (%s) AS credit "
+                 "JOIN (%s) AS debit ON %s "
+                 "ORDER BY credit.id, debit.id" %
+                 (credit_query, debit_query,
+                  ' AND '.join(self._sql_matchers(rec))))
+        with self._stats_timing('query', context=context):
+            cr.execute(query, credit_params + debit_params)
+            matches = cr.fetchall()
+        stats = (context or {}).get('reconcile_stats')
+        if stats is not None:
+            stats.rows_fetched += len(matches)
+        return matches
+
+    def _use_amount_matching(self, cr, uid, rec, context=None):
+        """ Return True when the groups of matched lines are split on
+        their amounts, see `_split_groups_by_amount()` """
+        return rec.journal_id.company_id.reconciliation_amount_matching
+
+    def _split_group_by_amount(self, rec, group, candidates, lines_by_id,
+                               to_cents, tolerance):
+        """ Split a group of matched lines in the subsets of debit lines
+        paid by each credit line
+
+        See `_split_groups_by_amount()`.
+
+        :return: list of groups
+        """
+        lines = [lines_by_id[lid] for lid in group]
+        balance = to_cents(sum(line['debit'] for line in lines) -
+                           sum(line['credit'] for line in lines))
+        if abs(balance) <= tolerance:
+            # fully reconciled as is
+            return [group]
+        credit_ids = sorted(
+            (lid for lid in group if lines_by_id[lid]['credit'] > 0),
+            key=lambda lid: lines_by_id[lid]['credit'], reverse=True)
+        available = set(lid for lid in group if lines_by_id[lid]['debit'] > 0)
+        groups = []
+        left_credit_ids = []
+        for credit_id in credit_ids:
+            debit_ids = [lid for lid in candidates.get(credit_id, ())
+                         if lid in available]
+            positions = subset_sum(
+                [to_cents(lines_by_id[lid]['debit']) for lid in debit_ids],
+                to_cents(lines_by_id[credit_id]['credit']),
+                tolerance=tolerance,
+                max_nodes=self._subset_max_nodes,
+                mitm_limit=self._subset_mitm_limit)
+            if positions is None:
+                left_credit_ids.append(credit_id)
+                continue
+            subset = [debit_ids[position] for position in positions]
+            available.difference_update(subset)
+            groups.append(set([credit_id] + subset))
+        # the lines left are grouped again on their matches
+        left = DisjointSet()
+        for credit_id in left_credit_ids:
+            debit_ids = [lid for lid in candidates.get(credit_id, ())
+                         if lid in available]
+            if debit_ids:
+                left.union(credit_id, *debit_ids)
+        groups.extend(left.groups())
+        return groups
+
+    def _split_groups_by_amount(self, cr, uid, rec, reconcile_groups,
+                                candidates, lines_by_id, context=None):
+        """ Split the groups of matched lines which are not balanced
+
+        When a partner has many open lines with the same matchers, they
+        all end in one group reconciled partially. In the amount
+        matching, each credit line of such a group, largest first, is
+        reconciled with the subset of its opposite debit lines whose
+        total is its amount, more or less the write-off. So the group
+        gives several full reconciliations, the lines left are grouped
+        again on their matches.
+
+        :param candidates: dict {credit line id: [opposite debit ids]}
+        :return: list of groups of line ids
+        """
+        precision = self.pool['decimal.precision'].precision_get(
+            cr, uid, 'Account')
+        factor = 10 ** precision
+
+        def to_cents(amount):
+            return int(round(amount * factor))
+
+        tolerance = to_cents(rec.write_off)
+        split_groups = []
+        for group in reconcile_groups:
+            split_groups += self._split_group_by_amount(
+                rec, group, candidates, lines_by_id, to_cents, tolerance)
+        return split_groups
+
+    def _rec_auto_lines_sql(self, cr, uid, rec, context=None):
+        """ Reconciliation main loop of the SQL matching engine
+
+        The groups are built from the pairs of lines returned by
+        `_query_matches()`, then only the matched lines are read.
+        """
+        matched = DisjointSet()
+        candidates = None
+        if self._use_amount_matching(cr, uid, rec, context=context):
+            candidates = {}
+        for credit_id, debit_id in self._query_matches(
+                cr, uid, rec, context=context):
+            matched.union(credit_id, debit_id)
+            if candidates is not None:
+                candidates.setdefault(credit_id, []).append(debit_id)
+        reconcile_groups = matched.groups()
+        lines_by_id = {}
+        if reconcile_groups:
+            query = ' '.join((self._select(rec), self._from(rec),
+                              "WHERE account_move_line.id = ANY(%s)"))
+            lines = self._fetch_lines(
+                cr, query, [[lid for group in reconcile_groups
+                             for lid in group]],
+                context=context)
+            lines_by_id = dict((line['id'], line) for line in lines)
+        if candidates is not None:
+            reconcile_groups = self._split_groups_by_amount(
+                cr, uid, rec, reconcile_groups, candidates, lines_by_id,
+                context=context)
+        self._log_groups_stats(reconcile_groups)
+        return self._reconcile_groups(
+            cr, uid, rec, reconcile_groups, lines_by_id, context=context)
+
     def _rec_auto_lines_advanced(self, cr, uid, rec, credit_lines, debit_lines,
                                  context=None):
-        """ Advanced reconciliation main loop """
-        reconciled_ids = []
-        partial_reconciled_ids = []
-        reconcile_groups = []
-        _logger.info("%d credit lines to reconcile", len(credit_lines))
+        """ Advanced reconciliation main loop
+
+        :param credit_lines: iterable of the credit move lines
+        :param list debit_lines: list of the debit move lines
+        """
+        matched = DisjointSet()
+        candidates = None
+        if self._use_amount_matching(cr, uid, rec, context=context):
+            candidates = {}
+        index = None
+        if self._use_opposites_index(cr, uid, rec, context=context):
+            index = self._index_opposites(
+                cr, uid, rec, debit_lines, context=context)
+            _logger.info("%d keys indexed for %d debit lines",
+                         len(index), len(debit_lines))
+        # only the matched lines are kept, the credit lines can be
+        # consumed from an iterator
+        lines_by_id = {}
         for idx, credit_line in enumerate(credit_lines, start=1):
             if idx % 50 == 0:
-                _logger.info("... %d/%d credit lines inspected ...", idx,
-                             len(credit_lines))
+                _logger.info("... %d credit lines inspected ...", idx)
             if self._skip_line(cr, uid, rec, credit_line, context=context):
                 continue
-            opposite_lines = self._search_opposites(
-                cr, uid, rec, credit_line, debit_lines, context=context)
+            if index is not None:
+                opposite_lines = self._search_opposites_indexed(
+                    cr, uid, rec, credit_line, index, context=context)
+            else:
+                opposite_lines = self._search_opposites(
+                    cr, uid, rec, credit_line, debit_lines, context=context)
             if not opposite_lines:
                 continue
             opposite_ids = [l['id'] for l in opposite_lines]
             line_ids = opposite_ids + [credit_line['id']]
-            for group in reconcile_groups:
-                if any([lid in group for lid in opposite_ids]):
-                    _logger.debug("New lines %s matched with an existing "
-                                  "group %s", line_ids, group)
-                    group.update(line_ids)
-                    break
-            else:
-                _logger.debug("New group of lines matched %s", line_ids)
-                reconcile_groups.append(set(line_ids))
-        lines_by_id = dict([(l['id'], l) for l in credit_lines + debit_lines])
+            _logger.debug("New lines matched %s", line_ids)
+            matched.union(*line_ids)
+            if candidates is not None:
+                candidates[credit_line['id']] = opposite_ids
+            lines_by_id[credit_line['id']] = credit_line
+            lines_by_id.update((l['id'], l) for l in opposite_lines)
+        reconcile_groups = matched.groups()
+        if candidates is not None:
+            reconcile_groups = self._split_groups_by_amount(
+                cr, uid, rec, reconcile_groups, candidates, lines_by_id,
+                context=context)
+        self._log_groups_stats(reconcile_groups)
+        return self._reconcile_groups(
+            cr, uid, rec, reconcile_groups, lines_by_id, context=context)
+
+    def _reconcile_groups(self, cr, uid, rec, reconcile_groups, lines_by_id,
+                          context=None):
+        """ Reconcile the groups of matched lines
+
+        :param list reconcile_groups: list of sets of move line ids
+        :param dict lines_by_id: values of the move lines by id
+        :return: tuple of lists: ids of the reconciled lines and ids of
+                 the partially reconciled lines
+        """
+        reconciled_ids = []
+        partial_reconciled_ids = []
         _logger.info("Found %d groups to reconcile", len(reconcile_groups))
+        checkpoint_obj = self.pool['easy.reconcile.checkpoint']
+        checkpoint_id, offset = self._save_checkpoint(
+            cr, uid, rec, reconcile_groups, context=context)
+        groups_lines = [[lines_by_id[lid] for lid in reconcile_group_ids]
+                        for reconcile_group_ids in reconcile_groups]
+        evaluation = self._evaluate_groups(
+            cr, uid, rec, groups_lines, context=context)
         for group_count, reconcile_group_ids in enumerate(reconcile_groups,
                                                           start=1):
             _logger.debug("Reconciling group %d/%d with ids %s",
                           group_count, len(reconcile_groups),
                           reconcile_group_ids)
-            group_lines = [lines_by_id[lid] for lid in reconcile_group_ids]
-            reconciled, full = self._reconcile_lines(
-                cr, uid, rec, group_lines, allow_partial=True, context=context)
+            idx = group_count - 1
+            group_ctx = dict(
+                context,
+                reconcile_evaluation=(evaluation['below_writeoff'][idx],
+                                      evaluation['debit'][idx],
+                                      evaluation['credit'][idx],
+                                      evaluation['date'][idx]))
+            reconciled, full = self._reconcile_group(
+                cr, uid, rec, groups_lines[idx], allow_partial=True,
+                context=group_ctx)
             if reconciled and full:
                 reconciled_ids += reconcile_group_ids
             elif reconciled:
@@ -300,8 +867,125 @@ class easy_reconcile_advanced(orm.AbstractModel):
 
             if (context['commit_every'] and
                     group_count % context['commit_every'] == 0):
-                cr.commit()
+                self._flush_reconcile_batch(cr, uid, rec, context=context)
+                if checkpoint_id:
+                    checkpoint_obj.set_position(
+                        cr, uid, checkpoint_id, offset + group_count,
+                        context=context)
+                with self._stats_timing('commit', context=context):
+                    cr.commit()
                 _logger.info("Commit the reconciliations after %d groups",
                              group_count)
+        self._flush_reconcile_batch(cr, uid, rec, context=context)
+        if checkpoint_id:
+            checkpoint_obj.set_position(
+                cr, uid, checkpoint_id, offset + len(reconcile_groups),
+                context=context)
         _logger.info("Reconciliation is over")
         return reconciled_ids, partial_reconciled_ids
+
+    def _use_checkpoints(self, cr, uid, rec, context=None):
+        """ Return True when the run saves checkpoints: it commits while
+        it goes and it is a run of a method of a profile, given by
+        ``reconcile_method_id`` and ``reconcile_run`` in the context.
+        """
+        if context is None:
+            context = {}
+        return bool(context.get('commit_every') and
+                    context.get('reconcile_method_id') and
+                    context.get('reconcile_run'))
+
+    def _find_checkpoint(self, cr, uid, rec, context=None):
+        """ Return the checkpoint left by the interrupted run on the
+        shard of the context, or False
+
+        The run of the profile has taken over the interrupted run and
+        discarded the checkpoints of another configuration, see
+        `account.easy.reconcile._start_run()`.
+        """
+        if not self._use_checkpoints(cr, uid, rec, context=context):
+            return False
+        return self.pool['easy.reconcile.checkpoint'].find(
+            cr, uid, context['reconcile_method_id'],
+            context.get('reconcile_shard'),
+            run_id=context['reconcile_run']['run_id'], context=context)
+
+    def _save_checkpoint(self, cr, uid, rec, reconcile_groups, context=None):
+        """ Save and commit the groups to reconcile in a checkpoint
+
+        The groups already reconciled by an interrupted run are given
+        by ``reconcile_done_groups`` in the context, they are kept at
+        the beginning of the checkpoint.
+
+        :return: tuple (id of the checkpoint or False, number of groups
+                 already reconciled)
+        """
+        if not self._use_checkpoints(cr, uid, rec, context=context):
+            return False, 0
+        done_groups = context.get('reconcile_done_groups') or []
+        run = context['reconcile_run']
+        checkpoint_obj = self.pool['easy.reconcile.checkpoint']
+        checkpoint_id = checkpoint_obj.save(
+            cr, uid, context['reconcile_method_id'],
+            context.get('reconcile_shard'), run['run_id'],
+            run['start_date'], done_groups + list(reconcile_groups),
+            context=context)
+        checkpoint_obj.set_position(cr, uid, checkpoint_id,
+                                    len(done_groups), context=context)
+        with self._stats_timing('commit', context=context):
+            cr.commit()
+        return checkpoint_id, len(done_groups)
+
+    def _resume_checkpoint(self, cr, uid, rec, checkpoint_id, context=None):
+        """ Resume an interrupted run from its checkpoint
+
+        The matching is not done again: the groups not yet committed are
+        reconciled, without the lines reconciled since. The lines of the
+        groups already committed are returned with the new ones, so the
+        history of the run covers the interrupted run too.
+
+        :return: tuple of lists: ids of the reconciled lines and ids of
+                 the partially reconciled lines
+        """
+        checkpoint = self.pool['easy.reconcile.checkpoint'].load(
+            cr, uid, checkpoint_id, context=context)
+        groups = checkpoint['groups']
+        position = checkpoint['position']
+        _logger.info("Resume the reconciliation run %s after %d/%d groups",
+                     checkpoint['run_id'], position, len(groups))
+        done_groups = groups[:position]
+        reconciled_ids, partial_ids = [], []
+        done_ids = [lid for group in done_groups for lid in group]
+        if done_ids:
+            cr.execute("SELECT id, reconcile_id IS NOT NULL "
+                       "FROM account_move_line "
+                       "WHERE id = ANY(%s) "
+                       "AND (reconcile_id IS NOT NULL "
+                       "     OR reconcile_partial_id IS NOT NULL)",
+                       (done_ids,))
+            for line_id, full in cr.fetchall():
+                if full:
+                    reconciled_ids.append(line_id)
+                else:
+                    partial_ids.append(line_id)
+        todo_groups = groups[position:]
+        lines_by_id = {}
+        if todo_groups:
+            query = ' '.join((self._select(rec), self._from(rec),
+                              "WHERE account_move_line.id = ANY(%s) "
+                              "AND account_move_line.reconcile_id IS NULL"))
+            lines = self._fetch_lines(
+                cr, query, [[lid for group in todo_groups for lid in group]],
+                context=context)
+            lines_by_id = dict((line['id'], line) for line in lines)
+        reconcile_groups = []
+        for group in todo_groups:
+            lines = [lines_by_id[lid] for lid in group if lid in lines_by_id]
+            if (any(line['debit'] > 0 for line in lines) and
+                    any(line['credit'] > 0 for line in lines)):
+                reconcile_groups.append(set(line['id'] for line in lines))
+        ctx = dict(context, reconcile_done_groups=done_groups)
+        more_reconciled_ids, more_partial_ids = self._reconcile_groups(
+            cr, uid, rec, reconcile_groups, lines_by_id, context=ctx)
+        return (reconciled_ids + more_reconciled_ids,
+                partial_ids + more_partial_ids)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2014 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import hashlib
+import json
+
+from openerp.osv import orm, fields
+
+
+class EasyReconcileCheckpoint(orm.Model):
+    """ Progress of a run of an advanced reconciliation method
+
+    A checkpoint is saved when the reconciliation commits while it
+    goes: it keeps the matched groups of lines and the number of groups
+    already committed. When the run stops before its end, the next run
+    of the method resumes from the checkpoint instead of matching the
+    lines again.
+
+    The checkpoints belong to the run of the profile: the checkpoints of
+    the methods already done are kept until the history of the run is
+    written, so the history of the resumed run includes their
+    reconciliations. A checkpoint saved with another configuration of
+    its method is discarded.
+    """
+
+    _name = 'easy.reconcile.checkpoint'
+    _description = 'easy reconcile checkpoint'
+    _rec_name = 'run_id'
+
+    _columns = {
+        'method_id': fields.many2one(
+            'account.easy.reconcile.method', 'Reconciliation Method',
+            required=True, ondelete='cascade', readonly=True),
+        'shard': fields.char('Shard', readonly=True),
+        'run_id': fields.char('Run', required=True, readonly=True),
+        'config_hash': fields.char(
+            'Configuration Hash', readonly=True,
+            help="Hash of the configuration of the method when the "
+                 "checkpoint has been saved"),
+        'start_date': fields.datetime('Start date', readonly=True),
+        'groups': fields.text('Groups', readonly=True),
+        'position': fields.integer(
+            'Committed Groups', readonly=True,
+            help="Number of groups reconciled and committed"),
+    }
+
+    _sql_constraints = [
+        ('method_shard_uniq', 'unique(method_id, shard)',
+         'A reconciliation method has only one checkpoint per shard.'),
+    ]
+
+    @staticmethod
+    def _shard_key(shard):
+        return '%d/%d' % shard if shard else ''
+
+    # fields of the methods changing the groups they match
+    _config_fields = ['name', 'write_off', 'account_lost_id',
+                      'account_profit_id', 'journal_id', 'date_base_on',
+                      'filter', 'analytic_account_id']
+
+    def config_hash(self, cr, uid, method_id, context=None):
+        """ Return the hash of the configuration of a reconciliation
+        method and of the account of its profile """
+        method_obj = self.pool['account.easy.reconcile.method']
+        values = method_obj.read(cr, uid, method_id, self._config_fields,
+                                 context=context, load='_classic_write')
+        method = method_obj.browse(cr, uid, method_id, context=context)
+        config = [(field, values[field]) for field in self._config_fields]
+        config.append(('account_id', method.task_id.account.id))
+        return hashlib.sha1(json.dumps(config)).hexdigest()
+
+    def find(self, cr, uid, method_id, shard, run_id=None, context=None):
+        """ Return the checkpoint of a method and shard
+
+        :param shard: tuple (index, count) or None
+        :param run_id: when given, only a checkpoint of this run is
+                       returned
+        :return: id or False
+        """
+        domain = [('method_id', '=', method_id),
+                  ('shard', '=', self._shard_key(shard))]
+        if run_id:
+            domain.append(('run_id', '=', run_id))
+        ids = self.search(cr, uid, domain, limit=1, context=context)
+        return ids[0] if ids else False
+
+    def save(self, cr, uid, method_id, shard, run_id, start_date,
+             reconcile_groups, context=None):
+        """ Create the checkpoint of a run, replacing any previous one
+
+        :param reconcile_groups: list of groups of move line ids
+        :return: id of the checkpoint
+        """
+        old_id = self.find(cr, uid, method_id, shard, context=context)
+        if old_id:
+            self.unlink(cr, uid, [old_id], context=context)
+        return self.create(
+            cr, uid,
+            {'method_id': method_id,
+             'shard': self._shard_key(shard),
+             'run_id': run_id,
+             'config_hash': self.config_hash(cr, uid, method_id,
+                                             context=context),
+             'start_date': start_date,
+             'groups': json.dumps([sorted(group)
+                                   for group in reconcile_groups]),
+             'position': 0},
+            context=context)
+
+    def set_position(self, cr, uid, checkpoint_id, position, context=None):
+        """ Record the number of groups reconciled, in the transaction
+        committing them """
+        # a plain update, the groups are not read and written again
+        cr.execute("UPDATE easy_reconcile_checkpoint "
+                   "SET position = %s, write_date = now() WHERE id = %s",
+                   (position, checkpoint_id))
+
+    def load(self, cr, uid, checkpoint_id, context=None):
+        """ Return the values of a checkpoint
+
+        :return: dict with 'run_id', 'start_date', 'position' and
+                 'groups' (list of lists of move line ids)
+        """
+        checkpoint = self.browse(cr, uid, checkpoint_id, context=context)
+        return {'run_id': checkpoint.run_id,
+                'start_date': checkpoint.start_date,
+                'position': checkpoint.position,
+                'groups': json.loads(checkpoint.groups or '[]')}
+
+
+class AccountEasyReconcile(orm.Model):
+    """ Resume the interrupted run of a profile from its checkpoints """
+    _inherit = 'account.easy.reconcile'
+
+    def _start_run(self, cr, uid, rec, context=None):
+        """ Take over the run id and the start date of the interrupted
+        run of the profile, after having discarded the checkpoints
+        saved with another configuration of their method """
+        run = super(AccountEasyReconcile, self)._start_run(
+            cr, uid, rec, context=context)
+        method_ids = [method.id for method in rec.reconcile_method]
+        if not method_ids:
+            return run
+        checkpoint_obj = self.pool['easy.reconcile.checkpoint']
+        checkpoint_ids = checkpoint_obj.search(
+            cr, uid, [('method_id', 'in', method_ids)],
+            order='start_date, id', context=context)
+        if not checkpoint_ids:
+            return run
+        hashes = {}
+        stale_ids = []
+        checkpoints = []
+        for checkpoint in checkpoint_obj.browse(cr, uid, checkpoint_ids,
+                                                context=context):
+            method_id = checkpoint.method_id.id
+            if method_id not in hashes:
+                hashes[method_id] = checkpoint_obj.config_hash(
+                    cr, uid, method_id, context=context)
+            if checkpoint.config_hash != hashes[method_id]:
+                stale_ids.append(checkpoint.id)
+            else:
+                checkpoints.append(checkpoint)
+        if checkpoints:
+            # a profile has one run at a time, the checkpoints of
+            # another run than the oldest one can not be resumed
+            run = {'run_id': checkpoints[0].run_id,
+                   'start_date': checkpoints[0].start_date}
+            stale_ids += [checkpoint.id for checkpoint in checkpoints
+                          if checkpoint.run_id != run['run_id']]
+        if stale_ids:
+            checkpoint_obj.unlink(cr, uid, stale_ids, context=context)
+        return run
+
+    def _end_run(self, cr, uid, rec, run, context=None):
+        """ Remove the checkpoints of the run with its history written
+        in the same transaction """
+        super(AccountEasyReconcile, self)._end_run(
+            cr, uid, rec, run, context=context)
+        checkpoint_obj = self.pool['easy.reconcile.checkpoint']
+        checkpoint_ids = checkpoint_obj.search(
+            cr, uid, [('run_id', '=', run['run_id'])], context=context)
+        if checkpoint_ids:
+            checkpoint_obj.unlink(cr, uid, checkpoint_ids, context=context)
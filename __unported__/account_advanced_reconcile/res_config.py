@@ -33,6 +33,23 @@ class AccountConfigSettings(orm.TransientModel):
             string='How often to commit when performing automatic '
             'reconciliation.',
             help="""Leave zero to commit only at the end of the process."""),
+        'reconciliation_shards': fields.related(
+            'company_id',
+            'reconciliation_shards',
+            type='integer',
+            string='Number of partner shards of the advanced '
+            'reconciliation.',
+            help="""Leave zero to reconcile all the partners at once."""),
+        'reconciliation_sql_matching': fields.related(
+            'company_id',
+            'reconciliation_sql_matching',
+            type='boolean',
+            string='Match the lines in SQL in the advanced reconciliation.'),
+        'reconciliation_amount_matching': fields.related(
+            'company_id',
+            'reconciliation_amount_matching',
+            type='boolean',
+            string='Match the amounts in the advanced reconciliation.'),
     }
 
     def onchange_company_id(self, cr, uid, ids, company_id, context=None):
@@ -46,6 +63,15 @@ class AccountConfigSettings(orm.TransientModel):
             result['value']['reconciliation_commit_every'] = (
                 company.reconciliation_commit_every
             )
+            result['value']['reconciliation_shards'] = (
+                company.reconciliation_shards
+            )
+            result['value']['reconciliation_sql_matching'] = (
+                company.reconciliation_sql_matching
+            )
+            result['value']['reconciliation_amount_matching'] = (
+                company.reconciliation_amount_matching
+            )
         return result
 
 
@@ -56,4 +82,21 @@ class Company(orm.Model):
             string='How often to commit when performing automatic '
             'reconciliation.',
             help="""Leave zero to commit only at the end of the process."""),
+        'reconciliation_shards': fields.integer(
+            string='Number of partner shards of the advanced '
+            'reconciliation.',
+            help="""The move lines of an account are loaded and reconciled
+            by buckets of partners, one after the other, which bounds the
+            memory used. Leave zero to reconcile all the partners at once."""),
+        'reconciliation_sql_matching': fields.boolean(
+            string='Match the lines in SQL in the advanced reconciliation.',
+            help="""The methods matching on the partner and the reference
+            find the lines to reconcile with a SQL query instead of
+            comparing them in Python."""),
+        'reconciliation_amount_matching': fields.boolean(
+            string='Match the amounts in the advanced reconciliation.',
+            help="""When many lines of a partner match together, each
+            payment is reconciled with the invoices whose total is its
+            amount (more or less the write-off) instead of reconciling
+            all the lines partially."""),
     }
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2014 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import unittest2
+
+from ..base_advanced_reconciliation import DisjointSet
+
+
+class TestDisjointSet(unittest2.TestCase):
+
+    def test_find_adds_unknown_item(self):
+        dset = DisjointSet()
+        self.assertEqual(dset.find(1), 1)
+        self.assertEqual(len(dset), 1)
+        self.assertEqual(dset.groups(), [set([1])])
+
+    def test_union(self):
+        dset = DisjointSet()
+        dset.union(1, 2)
+        dset.union(3, 4)
+        self.assertEqual(dset.find(1), dset.find(2))
+        self.assertNotEqual(dset.find(1), dset.find(3))
+        self.assertEqual(dset.groups(), [set([1, 2]), set([3, 4])])
+
+    def test_union_transitive(self):
+        dset = DisjointSet()
+        dset.union(1, 2)
+        dset.union(3, 4)
+        dset.union(5)
+        dset.union(2, 3)
+        self.assertEqual(dset.find(1), dset.find(4))
+        self.assertEqual(dset.groups(), [set([1, 2, 3, 4]), set([5])])
+
+    def test_union_many_items(self):
+        dset = DisjointSet()
+        root = dset.union(*range(10))
+        for item in range(10):
+            self.assertEqual(dset.find(item), root)
+        self.assertEqual(len(dset.groups()), 1)
+
+    def test_union_nothing(self):
+        dset = DisjointSet()
+        self.assertIsNone(dset.union())
+        self.assertEqual(dset.groups(), [])
+
+    def test_long_chain(self):
+        # a chain deep enough to fail with a recursive find
+        dset = DisjointSet()
+        for item in xrange(5000):
+            dset.union(item, item + 1)
+        self.assertEqual(dset.find(0), dset.find(5000))
+        self.assertEqual(len(dset.groups()), 1)
+
+    def test_groups_keep_insertion_order(self):
+        dset = DisjointSet()
+        dset.union(7, 8)
+        dset.union(1, 2)
+        dset.union(4)
+        self.assertEqual(dset.groups(),
+                         [set([7, 8]), set([1, 2]), set([4])])
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2014 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import unittest2
+
+from ..base_advanced_reconciliation import subset_sum
+
+
+class TestSubsetSum(unittest2.TestCase):
+
+    def test_nothing_to_find(self):
+        self.assertIsNone(subset_sum([], 10))
+        self.assertIsNone(subset_sum([10], 0))
+        self.assertIsNone(subset_sum([4, 6], 3))
+
+    def test_single_amount(self):
+        self.assertEqual(subset_sum([5, 7, 9], 7), [1])
+
+    def test_smallest_subset(self):
+        # 1 + 2 + 4 and 4 + 3 are both 7
+        self.assertEqual(subset_sum([1, 2, 4, 3], 7), [2, 3])
+
+    def test_tolerance(self):
+        self.assertEqual(subset_sum([100, 205], 300, tolerance=5), [0, 1])
+        self.assertIsNone(subset_sum([100, 205], 300, tolerance=4))
+        self.assertEqual(subset_sum([100, 195], 300, tolerance=5), [0, 1])
+
+    def test_meet_in_the_middle_limit(self):
+        # the only subset is the binary representation of the target
+        amounts = [2 ** power for power in range(24)]
+        target = 2 ** 23 + 2 ** 12 + 2 ** 11 + 5
+        expected = [0, 2, 11, 12, 23]
+        self.assertEqual(subset_sum(amounts, target, mitm_limit=24),
+                         expected)
+        # the same search above the limit is done depth-first
+        self.assertEqual(subset_sum(amounts, target, mitm_limit=23),
+                         expected)
+
+    def test_above_meet_in_the_middle_limit(self):
+        amounts = [2 ** power for power in range(25)]
+        target = 2 ** 24 + 3
+        self.assertEqual(subset_sum(amounts, target), [0, 1, 24])
+
+    def test_node_budget(self):
+        amounts = [2] * 29 + [1]
+        self.assertEqual(subset_sum(amounts, 3), [0, 29])
+        self.assertIsNone(subset_sum(amounts, 3, max_nodes=1))
+
+    def test_no_subset_within_budget(self):
+        # only even amounts: no subset sums to an odd target
+        amounts = [2 * (i + 1) for i in range(40)]
+        self.assertIsNone(subset_sum(amounts, 41, max_nodes=1000))
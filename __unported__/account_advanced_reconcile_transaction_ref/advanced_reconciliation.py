@@ -19,6 +19,8 @@
 ##############################################################################
 
 from openerp.osv import orm
+from openerp.addons.account_easy_reconcile.base_reconciliation import (
+    normalize_ref, sql_normalize_ref)
 
 
 class easy_reconcile_advanced_transaction_ref(orm.TransientModel):
@@ -26,22 +28,31 @@ class easy_reconcile_advanced_transaction_ref(orm.TransientModel):
     _name = 'easy.reconcile.advanced.transaction_ref'
     _inherit = 'easy.reconcile.advanced'
 
+    _partner_shardable = True
+
     def _skip_line(self, cr, uid, rec, move_line, context=None):
         """
         When True is returned on some conditions, the credit move line
         will be skipped for reconciliation. Can be inherited to
         skip on some conditions. ie: ref or partner_id is empty.
         """
-        return not (move_line.get('transaction_ref') and
+        return not (normalize_ref(move_line.get('transaction_ref')) and
                     move_line.get('partner_id'))
 
     def _matchers(self, cr, uid, rec, move_line, context=None):
         return (('partner_id', move_line['partner_id']),
-                ('ref', move_line['transaction_ref'].lower().strip()))
+                ('ref', normalize_ref(move_line['transaction_ref'])))
 
     def _opposite_matchers(self, cr, uid, rec, move_line, context=None):
         yield ('partner_id', move_line['partner_id'])
-        yield ('ref', (move_line['transaction_ref'] or '').lower().strip())
+        yield ('ref', normalize_ref(move_line['transaction_ref']))
+
+    def _sql_matchers(self, rec):
+        credit_ref = sql_normalize_ref('credit.transaction_ref')
+        return ["debit.partner_id = credit.partner_id",
+                "%s <> ''" % credit_ref,
+                "%s = %s" % (sql_normalize_ref('debit.transaction_ref'),
+                             credit_ref)]
 
 
 class easy_reconcile_advanced_transaction_ref_vs_ref(orm.TransientModel):
@@ -49,18 +60,28 @@ class easy_reconcile_advanced_transaction_ref_vs_ref(orm.TransientModel):
     _name = 'easy.reconcile.advanced.trans_ref_vs_ref'
     _inherit = 'easy.reconcile.advanced'
 
+    _partner_shardable = True
+
     def _skip_line(self, cr, uid, rec, move_line, context=None):
         """
         When True is returned on some conditions, the credit move line
         will be skipped for reconciliation. Can be inherited to
         skip on some conditions. ie: ref or partner_id is empty.
         """
-        return not (move_line.get('ref') and move_line.get('partner_id'))
+        return not (normalize_ref(move_line.get('ref')) and
+                    move_line.get('partner_id'))
 
     def _matchers(self, cr, uid, rec, move_line, context=None):
         return (('partner_id', move_line['partner_id']),
-                ('ref', move_line['ref'].lower().strip()))
+                ('ref', normalize_ref(move_line['ref'])))
 
     def _opposite_matchers(self, cr, uid, rec, move_line, context=None):
         yield ('partner_id', move_line['partner_id'])
-        yield ('ref', (move_line['transaction_ref'] or '').lower().strip())
+        yield ('ref', normalize_ref(move_line['transaction_ref']))
+
+    def _sql_matchers(self, rec):
+        credit_ref = sql_normalize_ref('credit.ref')
+        return ["debit.partner_id = credit.partner_id",
+                "%s <> ''" % credit_ref,
+                "%s = %s" % (sql_normalize_ref('debit.transaction_ref'),
+                             credit_ref)]
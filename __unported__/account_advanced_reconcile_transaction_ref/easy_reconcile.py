@@ -20,6 +20,8 @@
 ##############################################################################
 
 from openerp.osv import orm
+from openerp.addons.account_easy_reconcile.base_reconciliation import (
+    sql_normalize_ref)
 
 
 class account_easy_reconcile_method(orm.Model):
@@ -36,3 +38,16 @@ class account_easy_reconcile_method(orm.Model):
              'Advanced. Partner and Transaction Ref. vs Ref.'),
         ]
         return methods
+
+
+class account_easy_reconcile(orm.Model):
+
+    _inherit = 'account.easy.reconcile'
+
+    def _reconcile_indexes(self, cr):
+        indexes = super(account_easy_reconcile, self)._reconcile_indexes(cr)
+        indexes += [
+            ('account_move_line_easy_rec_norm_transaction_ref_idx',
+             sql_normalize_ref('transaction_ref')),
+        ]
+        return indexes
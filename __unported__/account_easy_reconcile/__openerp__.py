@@ -22,7 +22,8 @@
 {
     "name": "Easy Reconcile",
     "version": "1.3.1",
-    "depends": ["account"],
+    "depends": ["account",
+                "account_period_cache"],
     "author": "Akretion,Camptocamp",
     "description": """
 Easy Reconcile
@@ -51,12 +52,34 @@ You may be interested to install also the
 This latter add more complex reconciliations,
 allows multiple lines and partial.
 
+Indexes
+-------
+
+The reconciliations use partial indexes on the unreconciled Journal
+items. They are created by the installation only when the table of the
+Journal items is small, since a plain CREATE INDEX locks the writes on
+the table during the whole update. On a bigger database, the update
+logs the ``CREATE INDEX CONCURRENTLY`` statements: run them manually
+with psql after the update. ``check_reconcile_indexes`` reports the
+missing or invalid indexes with the statement to run.
+
+Metrics
+-------
+
+The cron "Export the metrics of the reconciliations" (inactive by
+default) writes the metrics of the last run of the profiles in the
+Prometheus text format, in the file ``easy_reconcile_<database>.prom``
+of the directory set by the option ``easy_reconcile_metrics_dir`` of
+the configuration file of the server.
+
 """,
     "website": "http://www.akretion.com/",
     "category": "Finance",
     "demo_xml": [],
     "data": ["easy_reconcile.xml",
              "easy_reconcile_history_view.xml",
+             "easy_reconcile_simulation_view.xml",
+             "easy_reconcile_data.xml",
              "security/ir_rule.xml",
              "security/ir.model.access.csv"],
     'license': 'AGPL-3',
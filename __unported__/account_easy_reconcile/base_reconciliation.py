@@ -19,8 +19,142 @@
 #
 ##############################################################################
 
+import time
+from contextlib import contextmanager
+from itertools import count, izip
+from openerp import netsvc
 from openerp.osv import fields, orm
-from operator import itemgetter, attrgetter
+
+# names of the server-side cursors
+_cursor_names = count()
+
+# characters stripped from the references compared by the matchers:
+# the same in Python and in SQL, where btrim() strips only the spaces
+# by default while strip() strips all the whitespace
+REF_STRIP_CHARS = ' \t\r\n'
+
+
+def normalize_ref(value):
+    """ Normalize a reference compared by the matchers in Python,
+    as `sql_normalize_ref()` does in SQL """
+    return (value or '').strip(REF_STRIP_CHARS).lower()
+
+
+def sql_normalize_ref(expression):
+    """ Normalize a reference compared by the matchers in SQL,
+    as `normalize_ref()` does in Python """
+    return "lower(btrim(%s, E' \\t\\r\\n'))" % expression
+
+
+class ReconcileStats(object):
+    """ Counters and timings of the run of a reconciliation method
+
+    An instance given as ``reconcile_stats`` in the context is filled
+    by the reconciliation methods. The time is split in phases:
+    'query' (fetching the candidate lines), 'write' (evaluating and
+    creating the reconciliations), 'commit' and 'matching', the
+    remaining time.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.total_time = 0.
+        self.timings = {'query': 0., 'matching': 0., 'write': 0.,
+                        'commit': 0.}
+        self.groups = 0
+        self.full = 0
+        self.partial = 0
+        self.writeoff_amount = 0.
+        self.sql_statements = 0
+        self.rows_fetched = 0
+
+    @contextmanager
+    def timing(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[phase] += time.time() - start
+
+    def add_group(self, reconciled, full):
+        """ Count a group of lines given to `_reconcile_lines()` """
+        self.groups += 1
+        if reconciled and full:
+            self.full += 1
+        elif reconciled:
+            self.partial += 1
+
+    def count_statements(self, cr, start_count):
+        """ Add the statements executed on a cursor since its
+        ``sql_log_count`` was ``start_count`` """
+        self.sql_statements += getattr(cr, 'sql_log_count', 0) - start_count
+
+    def stop(self):
+        self.total_time = time.time() - self.start
+        self.timings['matching'] = max(
+            self.total_time - self.timings['query'] -
+            self.timings['write'] - self.timings['commit'],
+            0.)
+
+
+@contextmanager
+def _no_timing():
+    yield
+
+
+class MoveLineRow(tuple):
+    """ Compact row of a move lines query
+
+    A tuple which also gives its values by column name, like the dicts
+    returned by `cr.dictfetchall()`, so ``line['id']`` or
+    ``line.get('ref')`` still work with a fraction of the memory.
+    Use `move_line_row_class()` to get the class for a list of columns.
+    """
+
+    __slots__ = ()
+    _fields = ()
+    _positions = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return tuple.__getitem__(self, self._positions[key])
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def get(self, key, default=None):
+        if key in self._positions:
+            return tuple.__getitem__(self, self._positions[key])
+        return default
+
+    def keys(self):
+        return list(self._fields)
+
+    def iteritems(self):
+        return izip(self._fields, tuple.__iter__(self))
+
+    def items(self):
+        return zip(self._fields, tuple.__iter__(self))
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+
+_row_classes = {}
+
+
+def move_line_row_class(fields):
+    """ Return the `MoveLineRow` class for the columns ``fields`` """
+    fields = tuple(fields)
+    if fields not in _row_classes:
+        _row_classes[fields] = type(
+            'MoveLineRow', (MoveLineRow,),
+            {'__slots__': (),
+             '_fields': fields,
+             '_positions': dict((name, pos)
+                                for pos, name in enumerate(fields))})
+    return _row_classes[fields]
 
 
 class EasyReconcileBase(orm.AbstractModel):
@@ -31,6 +165,9 @@ class EasyReconcileBase(orm.AbstractModel):
 
     _inherit = 'easy.reconcile.options'
 
+    # number of rows fetched at once by `_fetch_lines()`
+    _fetch_size = 10000
+
     _columns = {
         'account_id': fields.many2one(
             'account.account', 'Account', required=True),
@@ -93,6 +230,83 @@ class EasyReconcileBase(orm.AbstractModel):
             params.append(tuple([l.id for l in rec.partner_ids]))
         return where, params
 
+    def _fetch_lines(self, cr, query, params, context=None):
+        """ Execute a move lines query in a server-side cursor and
+        yield the rows as `MoveLineRow`
+
+        The rows are fetched by chunks of ``reconcile_fetch_size`` rows
+        (from the context, default is `_fetch_size`), so the memory used
+        does not depend on the number of lines of the account.
+        The cursor is tied to the transaction, the rows must be consumed
+        before the next commit.
+        """
+        if context is None:
+            context = {}
+        size = context.get('reconcile_fetch_size') or self._fetch_size
+        named_cr = cr._cnx.cursor('easy_reconcile_%d' % next(_cursor_names))
+        named_cr.itersize = size
+        try:
+            with self._stats_timing('query', context=context):
+                named_cr.execute(query, params)
+            row_class = None
+            while True:
+                with self._stats_timing('query', context=context):
+                    rows = named_cr.fetchmany(size)
+                if not rows:
+                    break
+                stats = context.get('reconcile_stats')
+                if stats is not None:
+                    stats.rows_fetched += len(rows)
+                if row_class is None:
+                    row_class = move_line_row_class(
+                        desc[0] for desc in named_cr.description)
+                for row in rows:
+                    yield row_class(row)
+        finally:
+            named_cr.close()
+
+    def _changed_where(self, rec, key_field, context=None):
+        """ In an incremental run, restrict the lines to the ones sharing
+        their ``key_field`` with the lines created or modified since
+        ``reconcile_since`` (from the context).
+
+        The lines of the other keys have already been compared in the
+        previous runs, a new match involves at least one changed line.
+        """
+        since = (context or {}).get('reconcile_since')
+        if not since:
+            return '', []
+        where = ("AND account_move_line.%(key)s IN ("
+                 " SELECT changed.%(key)s FROM account_move_line changed"
+                 " WHERE changed.account_id = %%s"
+                 " AND changed.reconcile_id IS NULL"
+                 " AND changed.%(key)s IS NOT NULL"
+                 " AND COALESCE(changed.write_date, changed.create_date)"
+                 "     >= %%s) " % {'key': key_field})
+        return where, [rec.account_id.id, since]
+
+    def _stats_timing(self, phase, context=None):
+        """ Return a context manager which adds the time spent in its
+        block to the ``phase`` of the ``reconcile_stats`` of the context
+        """
+        stats = (context or {}).get('reconcile_stats')
+        if stats is None:
+            return _no_timing()
+        return stats.timing(phase)
+
+    def _reconcile_group(self, cr, uid, rec, lines, allow_partial=False,
+                         context=None):
+        """ Call `_reconcile_lines()` and count the group in the
+        ``reconcile_stats`` of the context """
+        with self._stats_timing('write', context=context):
+            reconciled, full = self._reconcile_lines(
+                cr, uid, rec, lines, allow_partial=allow_partial,
+                context=context)
+        stats = (context or {}).get('reconcile_stats')
+        if stats is not None:
+            stats.add_group(reconciled, full)
+        return reconciled, full
+
     def _get_filter(self, cr, uid, rec, context):
         ml_obj = self.pool.get('account.move.line')
         where = ''
@@ -108,50 +322,104 @@ class EasyReconcileBase(orm.AbstractModel):
                               writeoff_limit, context=None):
         precision = self.pool.get('decimal.precision').precision_get(
             cr, uid, 'Account')
-        keys = ('debit', 'credit')
-        sums = reduce(
-            lambda line, memo:
-                dict((key, value + memo[key])
-                     for key, value
-                     in line.iteritems()
-                     if key in keys), lines)
-        debit, credit = sums['debit'], sums['credit']
+        debit = sum(line['debit'] for line in lines)
+        credit = sum(line['credit'] for line in lines)
         writeoff_amount = round(debit - credit, precision)
         return bool(writeoff_limit >= abs(writeoff_amount)), debit, credit
 
-    def _get_rec_date(self, cr, uid, rec, lines,
-                      based_on='end_period_last_credit', context=None):
-        period_obj = self.pool['account.period']
-
-        def last_period(mlines):
-            period_ids = [ml['period_id'] for ml in mlines]
-            periods = period_obj.browse(
-                cr, uid, period_ids, context=context)
-            return max(periods, key=attrgetter('date_stop'))
+    def _period_stops(self, cr, uid, period_ids, context=None):
+        """ Return the table of the end dates of the periods
 
-        def last_date(mlines):
-            return max(mlines, key=itemgetter('date'))
+        The table is kept as ``reconcile_period_stops`` in the context
+        when it is there, so each period is read once per run.
 
-        def credit(mlines):
-            return [l for l in mlines if l['credit'] > 0]
-
-        def debit(mlines):
-            return [l for l in mlines if l['debit'] > 0]
+        :return: dict {period_id: date_stop}
+        """
+        if context is None:
+            context = {}
+        stops = context.get('reconcile_period_stops')
+        if stops is None:
+            stops = {}
+        missing = set(period_ids).difference(stops)
+        missing.discard(None)
+        if missing:
+            cr.execute("SELECT id, date_stop FROM account_period "
+                       "WHERE id IN %s", (tuple(missing),))
+            stops.update(cr.fetchall())
+        return stops
 
+    @staticmethod
+    def _rec_date_from_columns(based_on, debits, credits, dates, stops):
+        """ Compute the reconciliation date of a group of lines given
+        as columns: ``debits``, ``credits``, ``dates`` and ``stops``
+        (end dates of the periods) have one value per line.
+        """
         if based_on == 'end_period_last_credit':
-            return last_period(credit(lines)).date_stop
+            return max(stop for stop, credit in izip(stops, credits)
+                       if credit > 0)
         if based_on == 'end_period':
-            return last_period(lines).date_stop
+            return max(stops)
         elif based_on == 'newest':
-            return last_date(lines)['date']
+            return max(dates)
         elif based_on == 'newest_credit':
-            return last_date(credit(lines))['date']
+            return max(date for date, credit in izip(dates, credits)
+                       if credit > 0)
         elif based_on == 'newest_debit':
-            return last_date(debit(lines))['date']
+            return max(date for date, debit in izip(dates, debits)
+                       if debit > 0)
         # reconcilation date will be today
         # when date is None
         return None
 
+    def _get_rec_date(self, cr, uid, rec, lines,
+                      based_on='end_period_last_credit', context=None):
+        period_stops = self._period_stops(
+            cr, uid, [line['period_id'] for line in lines], context=context)
+        return self._rec_date_from_columns(
+            based_on,
+            [line['debit'] for line in lines],
+            [line['credit'] for line in lines],
+            [line['date'] for line in lines],
+            [period_stops[line['period_id']] for line in lines])
+
+    def _evaluate_groups(self, cr, uid, rec, groups, context=None):
+        """ Evaluate the write-off and the reconciliation date of all
+        the groups of lines of a run in one pass
+
+        The lines are turned in columns (amounts, dates, periods) and
+        the end dates of all the periods are read at once. The period
+        table is kept in the context for the next evaluations.
+
+        :param list groups: list of lists of move lines
+        :return: dict of lists with one value per group: 'debit',
+                 'credit', 'writeoff' (rounded difference),
+                 'below_writeoff' and 'date'
+        """
+        precision = self.pool.get('decimal.precision').precision_get(
+            cr, uid, 'Account')
+        period_stops = self._period_stops(
+            cr, uid,
+            set(line['period_id'] for lines in groups for line in lines),
+            context=context)
+        based_on = rec.date_base_on
+        limit = rec.write_off
+        result = {'debit': [], 'credit': [], 'writeoff': [],
+                  'below_writeoff': [], 'date': []}
+        for lines in groups:
+            debits = [line['debit'] for line in lines]
+            credits = [line['credit'] for line in lines]
+            debit, credit = sum(debits), sum(credits)
+            writeoff = round(debit - credit, precision)
+            result['debit'].append(debit)
+            result['credit'].append(credit)
+            result['writeoff'].append(writeoff)
+            result['below_writeoff'].append(limit >= abs(writeoff))
+            result['date'].append(self._rec_date_from_columns(
+                based_on, debits, credits,
+                [line['date'] for line in lines],
+                [period_stops[line['period_id']] for line in lines]))
+        return result
+
     def _reconcile_lines(self, cr, uid, rec, lines, allow_partial=False,
                          context=None):
         """ Try to reconcile given lines
@@ -165,24 +433,48 @@ class EasyReconcileBase(orm.AbstractModel):
                  have been reconciled or not,
                  the second is wether the reconciliation is full (True)
                  or partial (False)
+
+        With ``reconcile_simulation`` in the context, the write-off and
+        the date are evaluated but nothing is reconciled.
+        The evaluation can be given as ``reconcile_evaluation`` in the
+        context, a tuple (below write-off, debit, credit, date) as
+        computed by `_evaluate_groups()`.
         """
         if context is None:
             context = {}
         ml_obj = self.pool.get('account.move.line')
         writeoff = rec.write_off
         line_ids = [l['id'] for l in lines]
-        below_writeoff, sum_debit, sum_credit = self._below_writeoff_limit(
-            cr, uid, rec, lines, writeoff, context=context)
-        date = self._get_rec_date(
-            cr, uid, rec, lines, rec.date_base_on, context=context)
+        evaluation = context.get('reconcile_evaluation')
+        if evaluation:
+            below_writeoff, sum_debit, sum_credit, date = evaluation
+        else:
+            below_writeoff, sum_debit, sum_credit = \
+                self._below_writeoff_limit(
+                    cr, uid, rec, lines, writeoff, context=context)
+            date = None
+        stats = context.get('reconcile_stats')
+        if below_writeoff and stats is not None:
+            stats.writeoff_amount += abs(sum_debit - sum_credit)
+        if context.get('reconcile_simulation'):
+            return self._simulate_reconcile_lines(
+                cr, uid, rec, lines, below_writeoff, allow_partial,
+                date=date, context=context)
+        if below_writeoff and self._can_batch_reconcile(
+                cr, uid, rec, sum_debit, sum_credit, context=context):
+            context['reconcile_batch'].append(line_ids)
+            return True, True
+        if not evaluation:
+            date = self._get_rec_date(
+                cr, uid, rec, lines, rec.date_base_on, context=context)
         rec_ctx = dict(context, date_p=date)
         if below_writeoff:
             if sum_credit < sum_debit:
                 writeoff_account_id = rec.account_profit_id.id
             else:
                 writeoff_account_id = rec.account_lost_id.id
-            period_id = self.pool.get('account.period').find(
-                cr, uid, dt=date, context=context)[0]
+            period_id = self._get_writeoff_period(
+                cr, uid, date, context=context)
             if rec.analytic_account_id:
                 rec_ctx['analytic_id'] = rec.analytic_account_id.id
             ml_obj.reconcile(
@@ -202,3 +494,179 @@ class EasyReconcileBase(orm.AbstractModel):
                 context=rec_ctx)
             return True, False
         return False, False
+
+    def _simulate_reconcile_lines(self, cr, uid, rec, lines, below_writeoff,
+                                  allow_partial, date=None, context=None):
+        """ Evaluate the reconciliation of lines without reconciling them
+
+        The lines fully reconciled in the simulation are kept in
+        ``reconcile_simulated_ids`` of the context, the groups having one
+        of them are not reconciled again by the next methods.
+
+        :return: same as `_reconcile_lines()`
+        """
+        simulated_ids = context.setdefault('reconcile_simulated_ids', set())
+        line_ids = [l['id'] for l in lines]
+        if simulated_ids.intersection(line_ids):
+            return False, False
+        if below_writeoff:
+            if date is None:
+                date = self._get_rec_date(
+                    cr, uid, rec, lines, rec.date_base_on, context=context)
+            self._get_writeoff_period(cr, uid, date, context=context)
+            simulated_ids.update(line_ids)
+            return True, True
+        elif allow_partial:
+            return True, False
+        return False, False
+
+    def _get_writeoff_period(self, cr, uid, date, context=None):
+        """ Return the period of the write-off for a reconciliation date
+
+        The periods are kept in memory by account_period_cache.
+        """
+        return self.pool['account.period'].find(
+            cr, uid, dt=date, context=context)[0]
+
+    def _can_batch_reconcile(self, cr, uid, rec, sum_debit, sum_credit,
+                             context=None):
+        """ Return True when a full reconciliation can be delayed
+        in the ``reconcile_batch`` of the context.
+
+        Only the reconciliations which do not generate a write-off move
+        are batched, the others still use `account.move.line.reconcile`.
+        """
+        if context is None or context.get('reconcile_batch') is None:
+            return False
+        account = rec.account_id
+        if account.currency_id:
+            # a write-off may be generated for the secondary currency
+            return False
+        currency_obj = self.pool['res.currency']
+        return currency_obj.is_zero(cr, uid, account.company_id.currency_id,
+                                    sum_debit - sum_credit)
+
+    def _flush_reconcile_batch(self, cr, uid, rec, context=None):
+        """ Reconcile the groups of lines collected in the
+        ``reconcile_batch`` of the context, then empty it.
+        """
+        if context is None:
+            return
+        batch = context.get('reconcile_batch')
+        if batch:
+            with self._stats_timing('write', context=context):
+                self._bulk_reconcile(cr, uid, rec, batch, context=context)
+            del batch[:]
+
+    def _bulk_reconcile(self, cr, uid, rec, groups, context=None):
+        """ Fully reconcile groups of move lines without write-off
+
+        Replace `account.move.line.reconcile` by a few SQL statements
+        for all the groups: create the `account.move.reconcile` records
+        and write their `reconcile_id` on the move lines, recompute the
+        stored fields, trigger the workflows (paid invoices) and mark
+        the partners without anything left to reconcile as reconciled.
+
+        The groups which do not pass the checks of the ORM (lines not
+        valid or already reconciled, on different accounts or companies,
+        account not reconcilable, different partners on a receivable or
+        payable account) are given to `account.move.line.reconcile` so
+        the usual error is raised.
+
+        The reconciliations are inserted in SQL: an override of
+        `account.move.reconcile.create` is not called for them.
+
+        :param list groups: list of lists of move line ids
+        """
+        ml_obj = self.pool['account.move.line']
+        rec_obj = self.pool['account.move.reconcile']
+        partner_obj = self.pool['res.partner']
+        seq_obj = self.pool['ir.sequence']
+        all_ids = tuple(lid for group in groups for lid in group)
+        cr.execute("SELECT l.id, l.state, l.reconcile_id, l.partner_id, "
+                   "       l.account_id, l.company_id, a.reconcile, a.type "
+                   "FROM account_move_line l "
+                   "INNER JOIN account_account a ON a.id = l.account_id "
+                   "WHERE l.id IN %s", (all_ids,))
+        lines = dict((row[0], row[1:]) for row in cr.fetchall())
+        valid_groups = []
+        for group in groups:
+            states = set(lines[lid][0] for lid in group)
+            reconciled = any(lines[lid][1] for lid in group)
+            partners = set(lines[lid][2] for lid in group)
+            accounts = set(lines[lid][3] for lid in group)
+            companies = set(lines[lid][4] for lid in group)
+            reconcilable = all(lines[lid][5] for lid in group)
+            check_partner = any(lines[lid][6] in ('receivable', 'payable')
+                                for lid in group)
+            if (states != set(['valid']) or reconciled or
+                    len(accounts) > 1 or len(companies) > 1 or
+                    not reconcilable or
+                    (check_partner and len(partners) > 1)):
+                ml_obj.reconcile(cr, uid, group, type='auto', context=context)
+            else:
+                valid_groups.append(group)
+        if not valid_groups:
+            return
+
+        # the ids are taken from the sequence of the table before the
+        # insertion, so each group knows its reconciliation
+        cr.execute("SELECT nextval('account_move_reconcile_id_seq') "
+                   "FROM generate_series(1, %s)", (len(valid_groups),))
+        reconcile_ids = [row[0] for row in cr.fetchall()]
+        # no parameters are given to execute() as the values are
+        # already escaped by mogrify()
+        values = []
+        for reconcile_id in reconcile_ids:
+            name = seq_obj.get(
+                cr, uid, 'account.reconcile', context=context) or '/'
+            values.append(cr.mogrify(
+                "(%s, %s, 'auto', %s, now() AT TIME ZONE 'UTC', "
+                "%s, now() AT TIME ZONE 'UTC')",
+                (reconcile_id, name, uid, uid)))
+        cr.execute("INSERT INTO account_move_reconcile "
+                   "(id, name, type, create_uid, create_date, "
+                   " write_uid, write_date) "
+                   "VALUES %s" % ', '.join(values))
+
+        values = [cr.mogrify("(%s, %s)", (lid, reconcile_id))
+                  for group, reconcile_id in zip(valid_groups, reconcile_ids)
+                  for lid in group]
+        cr.execute("UPDATE account_move_line "
+                   "SET reconcile_id = v.reconcile_id, "
+                   "    reconcile_partial_id = NULL, "
+                   "    write_uid = %d, "
+                   "    write_date = now() AT TIME ZONE 'UTC' "
+                   "FROM (VALUES %s) AS v (line_id, reconcile_id) "
+                   "WHERE account_move_line.id = v.line_id" %
+                   (uid, ', '.join(values)))
+
+        line_ids = [lid for group in valid_groups for lid in group]
+        todo = ml_obj._store_get_values(
+            cr, uid, line_ids, ['reconcile_id', 'reconcile_partial_id'],
+            context)
+        todo += rec_obj._store_get_values(
+            cr, uid, reconcile_ids, ['line_id'], context)
+        todo.sort()
+        done = set()
+        for dummy, model, ids, fields_to_recompute in todo:
+            key = (model, tuple(fields_to_recompute), tuple(ids))
+            if key in done:
+                continue
+            done.add(key)
+            self.pool[model]._store_set_values(
+                cr, uid, ids, fields_to_recompute, context)
+
+        wf_service = netsvc.LocalService("workflow")
+        for line_id in line_ids:
+            wf_service.trg_trigger(uid, 'account.move.line', line_id, cr)
+
+        # as account.move.line.reconcile, with the partner of the first
+        # line of each group
+        partner_ids = set(lines[group[0]][2] for group in valid_groups
+                          if lines[group[0]][2])
+        for partner_id in partner_ids:
+            if not partner_obj.has_something_to_reconcile(
+                    cr, uid, partner_id, context=context):
+                partner_obj.mark_as_reconciled(
+                    cr, uid, [partner_id], context=context)
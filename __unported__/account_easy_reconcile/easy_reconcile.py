@@ -19,8 +19,72 @@
 #
 ##############################################################################
 
+import logging
+import multiprocessing
+import os
+import re
+import threading
+import uuid
+
+from openerp import pooler, sql_db, tools
+from openerp.modules.registry import RegistryManager
 from openerp.osv import fields, orm
 from openerp.tools.translate import _
+from .base_reconciliation import ReconcileStats, sql_normalize_ref
+
+
+_logger = logging.getLogger(__name__)
+
+# registries and connection pool inherited by a worker process: they
+# are kept referenced so the worker never closes their connections,
+# which would end the sessions of the parent process
+_inherited = []
+
+
+def init_worker_process():
+    """ Initialize a worker process forked by a `multiprocessing.Pool`
+
+    The process is forked from a threaded server: its registries hold
+    the database connections of the parent and the locks may have been
+    held by other threads at the time of the fork. The worker drops the
+    registries and the connection pool and gets new locks, so
+    `pooler.get_db_and_pool` loads a registry with connections of its
+    own. The inherited connections are never used nor closed.
+    """
+    _inherited.append((RegistryManager.registries, sql_db._Pool))
+    RegistryManager.registries = {}
+    RegistryManager.registries_lock = threading.RLock()
+    sql_db._Pool = None
+    # the locks of the logging module are not reinitialized by the fork
+    # in Python 2
+    logging._lock = threading.RLock()
+    for handler_ref in logging._handlerList:
+        handler = handler_ref()
+        if handler is not None:
+            handler.createLock()
+
+
+def _run_reconcile_worker(args):
+    """ Run the reconciliation profiles in a worker process,
+    with its own cursor
+
+    :return: tuple with the ids of the profiles and the error message
+             if the run failed
+    """
+    dbname, uid, ids, context = args
+    db, pool = pooler.get_db_and_pool(dbname, pooljobs=False)
+    cr = db.cursor()
+    try:
+        pool['account.easy.reconcile'].run_reconcile(
+            cr, uid, ids, context=context)
+        cr.commit()
+    except Exception as exc:
+        cr.rollback()
+        _logger.exception("Reconciliation of the profiles %s failed", ids)
+        return ids, unicode(exc)
+    finally:
+        cr.close()
+    return ids, None
 
 
 class EasyReconcileOptions(orm.AbstractModel):
@@ -133,28 +197,165 @@ class AccountEasyReconcile(orm.Model):
     _name = 'account.easy.reconcile'
     _description = 'account easy reconcile'
 
-    def _get_total_unrec(self, cr, uid, ids, name, arg, context=None):
-        obj_move_line = self.pool.get('account.move.line')
-        res = {}
-        for task in self.browse(cr, uid, ids, context=context):
-            res[task.id] = len(obj_move_line.search(
-                cr, uid,
-                [('account_id', '=', task.account.id),
-                 ('reconcile_id', '=', False),
-                 ('reconcile_partial_id', '=', False)],
-                context=context))
-        return res
+    # above this estimated number of move lines, the indexes are not
+    # created by the update of the module, see `init()`
+    _index_create_max_rows = 100000
 
-    def _get_partial_rec(self, cr, uid, ids, name, arg, context=None):
-        obj_move_line = self.pool.get('account.move.line')
+    def _reconcile_indexes(self, cr):
+        """ Indexes of account_move_line used by the reconciliations
+
+        All of them are partial indexes on the unreconciled lines, the
+        ones filtered by every reconciliation query and by the counters
+        of the profiles. Can be inherited to add the indexes needed by
+        a reconciliation method.
+
+        :return: list of tuples (index name, indexed expressions)
+        """
+        return [
+            ('account_move_line_easy_rec_account_partner_idx',
+             'account_id, partner_id'),
+            ('account_move_line_easy_rec_account_partial_idx',
+             'account_id, reconcile_partial_id'),
+            ('account_move_line_easy_rec_norm_ref_idx',
+             sql_normalize_ref('ref')),
+            ('account_move_line_easy_rec_norm_name_idx',
+             sql_normalize_ref('name')),
+        ]
+
+    def _reconcile_index_statement(self, name, expressions):
+        """ Statement creating an index of `_reconcile_indexes()`
+        without locking the writes on account_move_line. It cannot run
+        in a transaction, so it has to be run manually (psql). """
+        return ("CREATE INDEX CONCURRENTLY %s ON account_move_line (%s) "
+                "WHERE reconcile_id IS NULL;" % (name, expressions))
+
+    def init(self, cr):
+        """ Create the missing indexes of `_reconcile_indexes()`
+
+        A plain CREATE INDEX locks the writes on the table until the end
+        of the update of the module, so the indexes are created only on
+        a small account_move_line. Otherwise, the statements creating
+        them concurrently are logged and must be run manually.
+        """
+        cr.execute("SELECT indexname FROM pg_indexes "
+                   "WHERE tablename = 'account_move_line'")
+        existing = set(row[0] for row in cr.fetchall())
+        missing = [(name, expressions) for name, expressions
+                   in self._reconcile_indexes(cr) if name not in existing]
+        if not missing:
+            return
+        cr.execute("SELECT reltuples FROM pg_class "
+                   "WHERE relname = 'account_move_line'")
+        row = cr.fetchone()
+        if row and row[0] > self._index_create_max_rows:
+            _logger.warning(
+                "The indexes used by the reconciliations are missing, "
+                "create them with:\n%s",
+                '\n'.join(self._reconcile_index_statement(name, expressions)
+                          for name, expressions in missing))
+            return
+        for name, expressions in missing:
+            _logger.info("Create the index %s on account_move_line", name)
+            cr.execute("CREATE INDEX %s ON account_move_line (%s) "
+                       "WHERE reconcile_id IS NULL" % (name, expressions))
+
+    def check_reconcile_indexes(self, cr, uid, ids=None, bloat_ratio=0.5,
+                                context=None):
+        """ Health check of the indexes of `_reconcile_indexes()`
+
+        Report the indexes which are missing or invalid, never used, or
+        bloated: their leaf pages are filled below ``bloat_ratio``
+        (measured only when the ``pgstattuple`` extension is installed).
+        The problems are logged as warnings, so it can be used in a cron.
+
+        :return: list of dicts with the name, size, number of scans,
+                 leaf density and the problem found for each index
+        """
+        cr.execute("SELECT 1 FROM pg_extension WHERE extname = 'pgstattuple'")
+        has_pgstattuple = bool(cr.fetchone())
+        report = []
+        for name, expressions in self._reconcile_indexes(cr):
+            cr.execute("SELECT i.indisvalid, pg_relation_size(c.oid), "
+                       "       s.idx_scan "
+                       "FROM pg_class c "
+                       "JOIN pg_index i ON i.indexrelid = c.oid "
+                       "LEFT JOIN pg_stat_user_indexes s "
+                       "       ON s.indexrelid = c.oid "
+                       "WHERE c.relname = %s", (name,))
+            row = cr.fetchone()
+            status = {'name': name, 'size': 0, 'scans': 0,
+                      'leaf_density': None, 'problem': False}
+            report.append(status)
+            if not row:
+                status['problem'] = 'missing'
+                status['fix'] = self._reconcile_index_statement(
+                    name, expressions)
+                continue
+            valid, status['size'], status['scans'] = row
+            if not valid:
+                # a CREATE INDEX CONCURRENTLY which failed
+                status['problem'] = 'invalid'
+                status['fix'] = ("DROP INDEX CONCURRENTLY %s; %s" %
+                                 (name, self._reconcile_index_statement(
+                                     name, expressions)))
+                continue
+            if has_pgstattuple:
+                cr.execute("SELECT avg_leaf_density FROM pgstatindex(%s)",
+                           (name,))
+                status['leaf_density'] = cr.fetchone()[0]
+                if status['leaf_density'] < bloat_ratio * 100:
+                    status['problem'] = 'bloated'
+                    continue
+            if not status['scans']:
+                status['problem'] = 'unused'
+        for status in report:
+            if status.get('fix'):
+                _logger.warning("Reconciliation index %s is %s, run: %s",
+                                status['name'], status['problem'],
+                                status['fix'])
+            elif status['problem']:
+                _logger.warning("Reconciliation index %s is %s",
+                                status['name'], status['problem'])
+        return report
+
+    def _count_move_lines(self, cr, uid, account_ids, context=None):
+        """ Count the unreconciled and partially reconciled lines of
+        the accounts with one grouped query
+
+        The record rules of the move lines apply as in a search.
+
+        :return: dict {account_id: (unreconciled, partially reconciled)}
+        """
+        if not account_ids:
+            return {}
+        ml_obj = self.pool.get('account.move.line')
+        query = ml_obj._where_calc(
+            cr, uid, [('account_id', 'in', list(set(account_ids))),
+                      ('reconcile_id', '=', False)],
+            context=context)
+        ml_obj._apply_ir_rules(cr, uid, query, 'read', context=context)
+        from_clause, where_clause, where_params = query.get_sql()
+        cr.execute('SELECT "account_move_line".account_id, '
+                   '  sum(CASE WHEN "account_move_line".reconcile_partial_id '
+                   '      IS NULL THEN 1 ELSE 0 END), '
+                   '  sum(CASE WHEN "account_move_line".reconcile_partial_id '
+                   '      IS NOT NULL THEN 1 ELSE 0 END) '
+                   'FROM %s WHERE %s '
+                   'GROUP BY "account_move_line".account_id' %
+                   (from_clause, where_clause),
+                   where_params)
+        return dict((row[0], (row[1], row[2])) for row in cr.fetchall())
+
+    def _get_counts(self, cr, uid, ids, names, arg, context=None):
+        tasks = self.read(cr, uid, ids, ['account'], context=context,
+                          load='_classic_write')
+        counts = self._count_move_lines(
+            cr, uid, [task['account'] for task in tasks], context=context)
         res = {}
-        for task in self.browse(cr, uid, ids, context=context):
-            res[task.id] = len(obj_move_line.search(
-                cr, uid,
-                [('account_id', '=', task.account.id),
-                 ('reconcile_id', '=', False),
-                 ('reconcile_partial_id', '!=', False)],
-                context=context))
+        for task in tasks:
+            unreconciled, partial = counts.get(task['account'], (0, 0))
+            res[task['id']] = {'unreconciled_count': unreconciled,
+                               'reconciled_partial_count': partial}
         return res
 
     def _last_history(self, cr, uid, ids, name, args, context=None):
@@ -173,11 +374,15 @@ class AccountEasyReconcile(orm.Model):
         'reconcile_method': fields.one2many(
             'account.easy.reconcile.method', 'task_id', 'Method'),
         'unreconciled_count': fields.function(
-            _get_total_unrec, type='integer', string='Unreconciled Items'),
+            _get_counts,
+            type='integer',
+            string='Unreconciled Items',
+            multi='counts'),
         'reconciled_partial_count': fields.function(
-            _get_partial_rec,
+            _get_counts,
             type='integer',
-            string='Partially Reconciled Items'),
+            string='Partially Reconciled Items',
+            multi='counts'),
         'history_ids': fields.one2many(
             'easy.reconcile.history',
             'easy_reconcile_id',
@@ -191,6 +396,12 @@ class AccountEasyReconcile(orm.Model):
                 relation='easy.reconcile.history',
                 readonly=True),
         'company_id': fields.many2one('res.company', 'Company'),
+        'incremental': fields.boolean(
+            'Incremental',
+            help="When checked, a run only compares the items created or "
+                 "modified since the previous run with the open items. "
+                 "Use the full reconciliation to compare all the "
+                 "items."),
     }
 
     def _prepare_run_transient(self, cr, uid, rec_method, context=None):
@@ -207,6 +418,30 @@ class AccountEasyReconcile(orm.Model):
                 'date_base_on': rec_method.date_base_on,
                 'filter': rec_method.filter}
 
+    def _get_reconcile_since(self, cr, uid, rec, context=None):
+        """ Return the date from which the lines are reconciled
+        in an incremental run, False for a full run.
+
+        The run is incremental when the profile is and the previous run
+        is known, unless ``reconcile_full`` is in the context. The
+        lines changed since the start of the previous run are then
+        compared with the open lines.
+        """
+        if context is None:
+            context = {}
+        if not rec.incremental or context.get('reconcile_full'):
+            return False
+        last = rec.last_history
+        if not last:
+            return False
+        return last.start_date or last.date
+
+    def run_full_reconcile(self, cr, uid, ids, context=None):
+        """ Run the reconciliation on all the open lines, even on
+        the incremental profiles """
+        ctx = dict(context or {}, reconcile_full=True)
+        return self.run_reconcile(cr, uid, ids, context=ctx)
+
     def run_reconcile(self, cr, uid, ids, context=None):
         def find_reconcile_ids(fieldname, move_line_ids):
             if not move_line_ids:
@@ -219,10 +454,18 @@ class AccountEasyReconcile(orm.Model):
             res = cr.fetchall()
             return [row[0] for row in res]
 
+        if context is None:
+            context = {}
         for rec in self.browse(cr, uid, ids, context=context):
             all_ml_rec_ids = []
             all_ml_partial_ids = []
+            run = self._start_run(cr, uid, rec, context=context)
+            ctx = dict(context,
+                       reconcile_run=run,
+                       reconcile_since=self._get_reconcile_since(
+                           cr, uid, rec, context=context))
 
+            metrics = []
             for method in rec.reconcile_method:
                 rec_model = self.pool.get(method.name)
                 auto_rec_id = rec_model.create(
@@ -231,8 +474,16 @@ class AccountEasyReconcile(orm.Model):
                         cr, uid, method, context=context),
                     context=context)
 
+                stats = ReconcileStats()
+                sql_count = getattr(cr, 'sql_log_count', 0)
                 ml_rec_ids, ml_partial_ids = rec_model.automatic_reconcile(
-                    cr, uid, auto_rec_id, context=context)
+                    cr, uid, auto_rec_id,
+                    context=dict(ctx, reconcile_stats=stats,
+                                 reconcile_method_id=method.id))
+                stats.count_statements(cr, sql_count)
+                stats.stop()
+                metrics.append(self._prepare_stats_line(
+                    cr, uid, method, stats, context=context))
 
                 all_ml_rec_ids += ml_rec_ids
                 all_ml_partial_ids += ml_partial_ids
@@ -247,11 +498,245 @@ class AccountEasyReconcile(orm.Model):
                 uid,
                 {'easy_reconcile_id': rec.id,
                  'date': fields.datetime.now(),
+                 'start_date': run['start_date'],
+                 'run_id': run['run_id'],
+                 'incremental': bool(ctx['reconcile_since']),
+                 'metric_ids': [(0, 0, vals) for vals in metrics],
                  'reconcile_ids': [(4, rid) for rid in reconcile_ids],
                  'reconcile_partial_ids': [(4, rid) for rid in partial_ids]},
                 context=context)
+            self._end_run(cr, uid, rec, run, context=context)
+        return True
+
+    def _start_run(self, cr, uid, rec, context=None):
+        """ Identify a run of a profile, its id and start date are
+        written in its history
+
+        Can be inherited to take over an interrupted run, see
+        account_advanced_reconcile.
+
+        :return: dict with 'run_id' and 'start_date'
+        """
+        return {'run_id': uuid.uuid4().hex,
+                'start_date': fields.datetime.now()}
+
+    def _end_run(self, cr, uid, rec, run, context=None):
+        """ Called in the transaction writing the history of a run,
+        once all its methods are done """
+
+    def _prepare_stats_line(self, cr, uid, method, stats, context=None):
+        """ Values of the metrics of a method for the history
+        or the simulation, from its `ReconcileStats` """
+        method_obj = self.pool['account.easy.reconcile.method']
+        names = dict(method_obj._get_all_rec_method(cr, uid, context=context))
+        return {'sequence': method.sequence,
+                'name': names.get(method.name, method.name),
+                'method': method.name,
+                'groups': stats.groups,
+                'full': stats.full,
+                'partial': stats.partial,
+                'writeoff_amount': stats.writeoff_amount,
+                'query_time': stats.timings['query'],
+                'matching_time': stats.timings['matching'],
+                'write_time': stats.timings['write'],
+                'commit_time': stats.timings['commit'],
+                'total_time': stats.total_time,
+                'sql_statements': stats.sql_statements,
+                'rows_fetched': stats.rows_fetched}
+
+    def simulate_reconcile(self, cr, uid, ids, context=None):
+        """ Simulate a run of the profile and open the report
+
+        The methods find the groups of lines and evaluate the
+        write-off as in a real run, but nothing is reconciled.
+        """
+        if isinstance(ids, (tuple, list)):
+            assert len(ids) == 1, "Only 1 id expected"
+            ids = ids[0]
+        if context is None:
+            context = {}
+        rec = self.browse(cr, uid, ids, context=context)
+        ctx = dict(context,
+                   reconcile_simulation=True,
+                   reconcile_simulated_ids=set(),
+                   reconcile_since=self._get_reconcile_since(
+                       cr, uid, rec, context=context))
+        lines = []
+        for method in rec.reconcile_method:
+            rec_model = self.pool.get(method.name)
+            auto_rec_id = rec_model.create(
+                cr, uid,
+                self._prepare_run_transient(
+                    cr, uid, method, context=context),
+                context=context)
+            stats = ReconcileStats()
+            sql_count = getattr(cr, 'sql_log_count', 0)
+            rec_model.automatic_reconcile(
+                cr, uid, auto_rec_id,
+                context=dict(ctx, reconcile_stats=stats))
+            stats.count_statements(cr, sql_count)
+            stats.stop()
+            lines.append(self._prepare_stats_line(
+                cr, uid, method, stats, context=context))
+        simulation_id = self.pool['easy.reconcile.simulation'].create(
+            cr, uid,
+            {'easy_reconcile_id': rec.id,
+             'date': fields.datetime.now(),
+             'line_ids': [(0, 0, vals) for vals in lines]},
+            context=context)
+        return {
+            'name': _('Reconciliation Simulation'),
+            'view_mode': 'form',
+            'view_type': 'form',
+            'res_model': 'easy.reconcile.simulation',
+            'res_id': simulation_id,
+            'type': 'ir.actions.act_window',
+            'target': 'new',
+        }
+
+    def _parallel_reconcile_tasks(self, cr, uid, ids, context=None):
+        """ Partition the profiles for `run_reconcile_parallel`
+
+        The profiles working on the same account are kept together so
+        the same move lines are never reconciled by 2 processes. The
+        tasks are sorted by number of unreconciled lines, largest first,
+        so the longest runs start first.
+
+        :return: list of lists of profile ids
+        """
+        by_account = {}
+        for rec in self.browse(cr, uid, ids, context=context):
+            by_account.setdefault(rec.account.id, []).append(rec.id)
+        if not by_account:
+            return []
+        cr.execute("SELECT account_id, count(*) FROM account_move_line "
+                   "WHERE account_id IN %s AND reconcile_id IS NULL "
+                   "GROUP BY account_id", (tuple(by_account),))
+        weights = dict(cr.fetchall())
+        accounts = sorted(by_account,
+                          key=lambda account_id: weights.get(account_id, 0),
+                          reverse=True)
+        return [by_account[account_id] for account_id in accounts]
+
+    def run_reconcile_parallel(self, cr, uid, ids=None, processes=None,
+                               context=None):
+        """ Run the reconciliation profiles in a pool of worker processes
+
+        Each worker process runs `run_reconcile` on the profiles of one
+        account at a time with its own cursor, and commits. So each
+        profile gets its history as with `run_reconcile`.
+        Can be used in a cron.
+
+        :param ids: profiles to run, all the profiles when empty
+        :param processes: number of worker processes, the number of
+                          CPUs by default, with 1 the profiles are run
+                          in the current process
+        """
+        if not ids:
+            ids = self.search(cr, uid, [], context=context)
+        elif isinstance(ids, (int, long)):
+            ids = [ids]
+        tasks = self._parallel_reconcile_tasks(cr, uid, ids, context=context)
+        if not tasks:
+            return True
+        processes = min(processes or multiprocessing.cpu_count(), len(tasks))
+        _logger.info("Run %d reconciliation profiles in %d processes",
+                     len(ids), processes)
+        args = [(cr.dbname, uid, task_ids, context) for task_ids in tasks]
+        if processes == 1:
+            results = map(_run_reconcile_worker, args)
+        else:
+            workers = multiprocessing.Pool(processes,
+                                           initializer=init_worker_process)
+            try:
+                results = workers.map(_run_reconcile_worker, args,
+                                      chunksize=1)
+            finally:
+                workers.close()
+                workers.join()
+        errors = [(task_ids, msg) for task_ids, msg in results if msg]
+        if errors:
+            names = [rec.name for rec in self.browse(
+                cr, uid, [rid for task_ids, dummy in errors
+                          for rid in task_ids],
+                context=context)]
+            raise orm.except_orm(
+                _('Error'),
+                _('The reconciliation failed on the profiles: %s\n%s') %
+                (', '.join(names),
+                 '\n'.join(msg for dummy, msg in errors)))
         return True
 
+    def _export_metrics(self, cr, uid, ids=None, context=None):
+        """ Export the metrics of the last run of the profiles in the
+        Prometheus text format
+
+        Used by the cron "Export the metrics of the reconciliations".
+        The file ``easy_reconcile_<database>.prom`` is replaced
+        atomically in the directory given by the option
+        ``easy_reconcile_metrics_dir`` of the configuration file of the
+        server, usually the directory of the textfile collector of the
+        node exporter. Nothing is written when the option is not set.
+
+        :param ids: profiles to export, all the profiles when empty
+        :return: the metrics as text
+        """
+        if not ids:
+            ids = self.search(cr, uid, [], context=context)
+        elif isinstance(ids, (int, long)):
+            ids = [ids]
+        history_ids = [rec.last_history.id
+                       for rec in self.browse(cr, uid, ids, context=context)
+                       if rec.last_history]
+        metrics = self.pool['easy.reconcile.history'].prometheus_metrics(
+            cr, uid, history_ids, context=context)
+        directory = tools.config.get('easy_reconcile_metrics_dir')
+        if not directory:
+            _logger.warning("The metrics of the reconciliations are not "
+                            "exported, the option easy_reconcile_metrics_dir "
+                            "is not set in the configuration file")
+            return metrics
+        filename = 'easy_reconcile_%s.prom' % re.sub(r'[^\w.-]', '_',
+                                                      cr.dbname)
+        path = os.path.join(directory, filename)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write(metrics.encode('utf-8'))
+        os.rename(tmp_path, path)
+        return metrics
+
+    def run_reconcile_background(self, cr, uid, ids, context=None):
+        """ Run the reconciliation of the profiles in a background job
+
+        The job has a chunk per account, as in `run_reconcile_parallel`.
+        A chunk which is retried after a failure resumes from the
+        checkpoint of its advanced methods.
+
+        :return: action showing the progress of the job
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        tasks = self._parallel_reconcile_tasks(cr, uid, ids, context=context)
+        names = [rec.name for rec in self.browse(cr, uid, ids,
+                                                 context=context)]
+        job_obj = self.pool.get('account.job')
+        if job_obj is None:
+            raise orm.except_orm(
+                _('Error'),
+                _('The module account_job_queue must be installed to run '
+                  'the reconciliation in the background.'))
+        job_id = job_obj.enqueue(
+            cr, uid, _('Reconciliation of %s') % ', '.join(names),
+            self._name, 'run_reconcile_chunk',
+            [{'ids': task_ids} for task_ids in tasks],
+            context=context)
+        return job_obj.open_job(cr, uid, job_id, context=context)
+
+    def run_reconcile_chunk(self, cr, uid, payload, context=None):
+        """ Chunk of a job created by `run_reconcile_background` """
+        self.run_reconcile(cr, uid, payload['ids'], context=context)
+        return payload['ids']
+
     def _no_history(self, cr, uid, rec, context=None):
         """ Raise an `osv.except_osv` error, supposed to
         be called when there is no history on the reconciliation
@@ -19,10 +19,26 @@
 #
 ##############################################################################
 
+import calendar
+import time
+
 from openerp.osv import orm, fields
+from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
 from openerp.tools.translate import _
 
 
+def _prometheus_labels(labels):
+    """ Format the labels of a sample of the Prometheus text format
+
+    :param labels: list of tuples (name, value)
+    """
+    def escape(value):
+        return (unicode(value or '').replace('\\', '\\\\')
+                .replace('"', '\\"').replace('\n', '\\n'))
+    return ','.join('%s="%s"' % (name, escape(value))
+                    for name, value in labels)
+
+
 class EasyReconcileHistory(orm.Model):
     """ Store an history of the runs per profile
     Each history stores the list of reconciliations done"""
@@ -31,36 +47,52 @@ class EasyReconcileHistory(orm.Model):
     _rec_name = 'easy_reconcile_id'
     _order = 'date DESC'
 
-    def _reconcile_line_ids(self, cr, uid, ids, name, args, context=None):
-        result = {}
-        for history in self.browse(cr, uid, ids, context=context):
-            result[history.id] = {}
-            move_line_ids = []
-            for reconcile in history.reconcile_ids:
-                move_line_ids += [line.id
-                                  for line
-                                  in reconcile.line_id]
-            result[history.id]['reconcile_line_ids'] = move_line_ids
-
-            move_line_ids = []
-            for reconcile in history.reconcile_partial_ids:
-                move_line_ids += [line.id
-                                  for line
-                                  in reconcile.line_partial_ids]
-            result[history.id]['partial_line_ids'] = move_line_ids
+    def _reconcile_line_ids(self, cr, uid, ids, names, args, context=None):
+        result = dict((history_id, {'reconcile_line_ids': [],
+                                    'partial_line_ids': []})
+                      for history_id in ids)
+        if not ids:
+            return result
+        queries = (
+            ('reconcile_line_ids', 'account_move_reconcile_history_rel',
+             'reconcile_id'),
+            ('partial_line_ids', 'account_move_reconcile_history_partial_rel',
+             'reconcile_partial_id'),
+        )
+        for field, relation, line_column in queries:
+            if field not in names:
+                continue
+            cr.execute("SELECT rel.easy_reconcile_history_id, line.id "
+                       "FROM " + relation + " rel "
+                       "JOIN account_move_line line "
+                       "ON line." + line_column +
+                       " = rel.account_move_reconcile_id "
+                       "WHERE rel.easy_reconcile_history_id IN %s "
+                       "ORDER BY line.id",
+                       (tuple(ids),))
+            for history_id, line_id in cr.fetchall():
+                result[history_id][field].append(line_id)
         return result
 
     _columns = {
         'easy_reconcile_id': fields.many2one(
             'account.easy.reconcile', 'Reconcile Profile', readonly=True),
         'date': fields.datetime('Run date', readonly=True),
+        'start_date': fields.datetime('Start date', readonly=True),
+        'run_id': fields.char('Run', readonly=True),
+        'incremental': fields.boolean('Incremental', readonly=True),
+        'metric_ids': fields.one2many(
+            'easy.reconcile.history.metric', 'history_id',
+            string='Metrics', readonly=True),
         'reconcile_ids': fields.many2many(
             'account.move.reconcile',
             'account_move_reconcile_history_rel',
+            'easy_reconcile_history_id', 'account_move_reconcile_id',
             string='Reconciliations', readonly=True),
         'reconcile_partial_ids': fields.many2many(
             'account.move.reconcile',
             'account_move_reconcile_history_partial_rel',
+            'easy_reconcile_history_id', 'account_move_reconcile_id',
             string='Partial Reconciliations', readonly=True),
         'reconcile_line_ids':
         fields.function(
@@ -98,14 +130,17 @@ class EasyReconcileHistory(orm.Model):
         """
         assert rec_type in ('full', 'partial'), \
             "rec_type must be 'full' or 'partial'"
-        history = self.browse(cr, uid, history_id, context=context)
+        # the domain goes through the relation tables of the history
+        # instead of listing the ids of the move lines
         if rec_type == 'full':
-            field = 'reconcile_line_ids'
+            domain = [('reconcile_id.easy_reconcile_history_ids',
+                       'in', [history_id])]
             name = _('Reconciliations')
         else:
-            field = 'partial_line_ids'
+            domain = [('reconcile_partial_id.'
+                       'easy_reconcile_history_partial_ids',
+                       'in', [history_id])]
             name = _('Partial Reconciliations')
-        move_line_ids = [line.id for line in getattr(history, field)]
         return {
             'name': name,
             'view_mode': 'tree,form',
@@ -115,7 +150,7 @@ class EasyReconcileHistory(orm.Model):
             'type': 'ir.actions.act_window',
             'nodestroy': True,
             'target': 'current',
-            'domain': unicode([('id', 'in', move_line_ids)]),
+            'domain': unicode(domain),
         }
 
     def open_reconcile(self, cr, uid, history_ids, context=None):
@@ -145,3 +180,115 @@ class EasyReconcileHistory(orm.Model):
             history_ids = history_ids[0]
         return self._open_move_lines(
             cr, uid, history_ids, rec_type='partial', context=None)
+
+    # metrics of the methods exported in the Prometheus format:
+    # (name, type, help, field of the metric, extra labels)
+    _prometheus_metrics = [
+        ('easy_reconcile_phase_seconds', 'gauge',
+         'Time spent in each phase of the last run of a method',
+         [('query_time', {'phase': 'query'}),
+          ('matching_time', {'phase': 'matching'}),
+          ('write_time', {'phase': 'write'}),
+          ('commit_time', {'phase': 'commit'})]),
+        ('easy_reconcile_duration_seconds', 'gauge',
+         'Duration of the last run of a method',
+         [('total_time', {})]),
+        ('easy_reconcile_sql_statements', 'gauge',
+         'SQL statements executed by the last run of a method',
+         [('sql_statements', {})]),
+        ('easy_reconcile_rows_fetched', 'gauge',
+         'Rows fetched by the last run of a method',
+         [('rows_fetched', {})]),
+        ('easy_reconcile_groups', 'gauge',
+         'Groups of items found by the last run of a method',
+         [('groups', {})]),
+        ('easy_reconcile_reconciliations', 'gauge',
+         'Reconciliations created by the last run of a method',
+         [('full', {'type': 'full'}),
+          ('partial', {'type': 'partial'})]),
+    ]
+
+    def prometheus_metrics(self, cr, uid, ids, context=None):
+        """ Return the metrics of the histories in the Prometheus text
+        exposition format
+
+        The samples are labelled with the profile and the method, so
+        the histories should be of distinct profiles (usually the last
+        history of each profile).
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        histories = self.browse(cr, uid, ids, context=context)
+        output = []
+        for name, metric_type, help_text, samples in self._prometheus_metrics:
+            output.append('# HELP %s %s' % (name, help_text))
+            output.append('# TYPE %s %s' % (name, metric_type))
+            for history in histories:
+                for metric in history.metric_ids:
+                    for field, extra_labels in samples:
+                        labels = [('profile', history.easy_reconcile_id.name),
+                                  ('method', metric.method)]
+                        labels += sorted(extra_labels.iteritems())
+                        output.append('%s{%s} %r' % (
+                            name, _prometheus_labels(labels),
+                            float(metric[field] or 0)))
+        name = 'easy_reconcile_last_run_timestamp_seconds'
+        output.append('# HELP %s Date of the last run of a profile' % name)
+        output.append('# TYPE %s gauge' % name)
+        for history in histories:
+            run_date = time.strptime(history.date,
+                                     DEFAULT_SERVER_DATETIME_FORMAT)
+            output.append('%s{%s} %d' % (
+                name,
+                _prometheus_labels([('profile',
+                                     history.easy_reconcile_id.name)]),
+                calendar.timegm(run_date)))
+        return '\n'.join(output) + '\n'
+
+
+class EasyReconcileHistoryMetric(orm.Model):
+    """ Metrics of one reconciliation method in a run """
+
+    _name = 'easy.reconcile.history.metric'
+    _description = 'easy reconcile history metric'
+    _order = 'sequence'
+
+    _columns = {
+        'history_id': fields.many2one(
+            'easy.reconcile.history', 'History',
+            required=True, ondelete='cascade'),
+        'sequence': fields.integer('Sequence', readonly=True),
+        'name': fields.char('Method', readonly=True),
+        'method': fields.char('Method Model', readonly=True),
+        'groups': fields.integer('Groups', readonly=True),
+        'full': fields.integer('Full Reconciliations', readonly=True),
+        'partial': fields.integer('Partial Reconciliations', readonly=True),
+        'writeoff_amount': fields.float('Write-off Total', readonly=True),
+        'query_time': fields.float('Query Time (s)', readonly=True),
+        'matching_time': fields.float('Matching Time (s)', readonly=True),
+        'write_time': fields.float('Write Time (s)', readonly=True),
+        'commit_time': fields.float('Commit Time (s)', readonly=True),
+        'total_time': fields.float('Total Time (s)', readonly=True),
+        'sql_statements': fields.integer('SQL Statements', readonly=True),
+        'rows_fetched': fields.integer('Rows Fetched', readonly=True),
+    }
+
+
+class AccountMoveReconcile(orm.Model):
+    """ Inverse relations of the reconciliations of the history, used
+    in the domains opening the reconciled items of a history """
+
+    _inherit = 'account.move.reconcile'
+
+    _columns = {
+        'easy_reconcile_history_ids': fields.many2many(
+            'easy.reconcile.history',
+            'account_move_reconcile_history_rel',
+            'account_move_reconcile_id', 'easy_reconcile_history_id',
+            string='Reconciliation History', readonly=True),
+        'easy_reconcile_history_partial_ids': fields.many2many(
+            'easy.reconcile.history',
+            'account_move_reconcile_history_partial_rel',
+            'account_move_reconcile_id', 'easy_reconcile_history_id',
+            string='Partial Reconciliation History', readonly=True),
+    }
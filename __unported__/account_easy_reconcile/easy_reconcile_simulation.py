@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Author: Guewen Baconnier
+#    Copyright 2012 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+
+from openerp.osv import orm, fields
+
+
+class EasyReconcileSimulation(orm.TransientModel):
+    """ Report of a simulated run of a reconciliation profile
+
+    Shows, per method, what a real run would reconcile and the time
+    it would take, without reconciling anything.
+    """
+
+    _name = 'easy.reconcile.simulation'
+    _rec_name = 'easy_reconcile_id'
+
+    _columns = {
+        'easy_reconcile_id': fields.many2one(
+            'account.easy.reconcile', 'Reconcile Profile', readonly=True),
+        'date': fields.datetime('Simulation date', readonly=True),
+        'line_ids': fields.one2many(
+            'easy.reconcile.simulation.line', 'simulation_id',
+            string='Methods', readonly=True),
+    }
+
+
+class EasyReconcileSimulationLine(orm.TransientModel):
+    """ Result of the simulation of one reconciliation method """
+
+    _name = 'easy.reconcile.simulation.line'
+    _order = 'sequence'
+
+    _columns = {
+        'simulation_id': fields.many2one(
+            'easy.reconcile.simulation', 'Simulation',
+            required=True, ondelete='cascade'),
+        'sequence': fields.integer('Sequence', readonly=True),
+        'name': fields.char('Method', readonly=True),
+        'method': fields.char('Method Model', readonly=True),
+        'groups': fields.integer('Groups', readonly=True),
+        'full': fields.integer('Full Reconciliations', readonly=True),
+        'partial': fields.integer('Partial Reconciliations', readonly=True),
+        'writeoff_amount': fields.float('Write-off Total', readonly=True),
+        'query_time': fields.float('Query Time (s)', readonly=True),
+        'matching_time': fields.float('Matching Time (s)', readonly=True),
+        'write_time': fields.float('Write Time (s)', readonly=True),
+        'commit_time': fields.float('Commit Time (s)', readonly=True),
+        'total_time': fields.float('Total Time (s)', readonly=True),
+        'sql_statements': fields.integer('SQL Statements', readonly=True),
+        'rows_fetched': fields.integer('Rows Fetched', readonly=True),
+    }
@@ -19,6 +19,11 @@
 #
 ##############################################################################
 
+import math
+from collections import defaultdict, deque
+from itertools import groupby
+from operator import itemgetter
+
 from openerp.osv.orm import AbstractModel, TransientModel
 
 
@@ -30,34 +35,89 @@ class EasyReconcileSimple(AbstractModel):
     # field name used as key for matching the move lines
     _key_field = None
 
-    def rec_auto_lines_simple(self, cr, uid, rec, lines, context=None):
-        if self._key_field is None:
-            raise ValueError("_key_field has to be defined")
-        count = 0
+    def _rec_auto_bucket_simple(self, cr, uid, rec, lines, context=None):
+        """ Pair the debit and credit lines of a bucket of lines sharing
+        the same key.
+
+        Each line is paired with the oldest waiting opposite line having
+        the closest amount within the write-off, otherwise it waits for
+        the next lines. The waiting lines are queued per amount, and the
+        amounts are indexed per slots of the write-off width, so a line
+        looks only in its own slot and in the 2 adjacent ones.
+
+        :return: list of reconciled ids
+        """
+        precision = self.pool['decimal.precision'].precision_get(
+            cr, uid, 'Account')
+        writeoff = round(rec.write_off or 0., precision)
+
+        def slot(amount):
+            if not writeoff:
+                return amount
+            return int(math.floor(amount / writeoff))
+
+        queues = {'debit': defaultdict(deque),
+                  'credit': defaultdict(deque)}
+        slots = {'debit': defaultdict(set),
+                 'credit': defaultdict(set)}
         res = []
-        while (count < len(lines)):
-            for i in xrange(count + 1, len(lines)):
-                if lines[count][self._key_field] != lines[i][self._key_field]:
-                    break
-                check = False
-                if lines[count]['credit'] > 0 and lines[i]['debit'] > 0:
-                    credit_line = lines[count]
-                    debit_line = lines[i]
-                    check = True
-                elif lines[i]['credit'] > 0 and lines[count]['debit'] > 0:
-                    credit_line = lines[i]
-                    debit_line = lines[count]
-                    check = True
-                if not check:
-                    continue
-                reconciled, dummy = self._reconcile_lines(
+        for line in lines:
+            if line['credit'] > 0:
+                side, opposite = 'credit', 'debit'
+            elif line['debit'] > 0:
+                side, opposite = 'debit', 'credit'
+            else:
+                continue
+            amount = round(line[side], precision)
+            line_slot = slot(amount)
+            if writeoff:
+                near_slots = (line_slot - 1, line_slot, line_slot + 1)
+            else:
+                near_slots = (line_slot,)
+            candidates = [
+                opp_amount for near_slot in near_slots
+                for opp_amount in slots[opposite].get(near_slot, ())
+                if abs(round(opp_amount - amount, precision)) <= writeoff]
+            paired = False
+            if candidates:
+                opp_amount = min(candidates,
+                                 key=lambda opp: abs(opp - amount))
+                queue = queues[opposite][opp_amount]
+                opposite_line = queue.popleft()
+                if side == 'credit':
+                    credit_line, debit_line = line, opposite_line
+                else:
+                    credit_line, debit_line = opposite_line, line
+                reconciled, dummy = self._reconcile_group(
                     cr, uid, rec, [credit_line, debit_line],
                     allow_partial=False, context=context)
                 if reconciled:
                     res += [credit_line['id'], debit_line['id']]
-                    del lines[i]
-                    break
-            count += 1
+                    paired = True
+                    if not queue:
+                        del queues[opposite][opp_amount]
+                        slots[opposite][slot(opp_amount)].discard(
+                            opp_amount)
+                else:
+                    queue.appendleft(opposite_line)
+            if not paired:
+                queues[side][amount].append(line)
+                slots[side][line_slot].add(amount)
+        return res
+
+    def rec_auto_lines_simple(self, cr, uid, rec, lines, context=None):
+        """ Reconcile the lines by pairs of 1 debit and 1 credit sharing
+        the same value for the `_key_field`.
+
+        :param lines: iterable of move lines (dict or `MoveLineRow`),
+                      sorted by `_key_field`
+        """
+        if self._key_field is None:
+            raise ValueError("_key_field has to be defined")
+        res = []
+        for dummy, bucket in groupby(lines, key=itemgetter(self._key_field)):
+            res += self._rec_auto_bucket_simple(
+                cr, uid, rec, bucket, context=context)
         return res, []  # empty list for partial, only full rec in "simple" rec
 
     def _simple_order(self, rec, *args, **kwargs):
@@ -71,15 +131,21 @@ class EasyReconcileSimple(AbstractModel):
         where += " AND account_move_line.%s IS NOT NULL " % self._key_field
 
         where2, params2 = self._get_filter(cr, uid, rec, context=context)
+        where3, params3 = self._changed_where(
+            rec, self._key_field, context=context)
         query = ' '.join((
             select,
             self._from(rec),
-            where, where2,
+            where, where2, where3,
             self._simple_order(rec)))
 
-        cr.execute(query, params + params2)
-        lines = cr.dictfetchall()
-        return self.rec_auto_lines_simple(cr, uid, rec, lines, context)
+        lines = self._fetch_lines(cr, query, params + params2 + params3,
+                                  context=context)
+        ctx = dict(context or {}, reconcile_batch=[],
+                   reconcile_period_stops={})
+        result = self.rec_auto_lines_simple(cr, uid, rec, lines, ctx)
+        self._flush_reconcile_batch(cr, uid, rec, context=ctx)
+        return result
 
 
 class EasyReconcileSimpleName(TransientModel):
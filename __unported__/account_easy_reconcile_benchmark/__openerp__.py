@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2014 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+{'name': 'Easy Reconcile Benchmark',
+ 'version': '1.0',
+ 'author': 'Camptocamp',
+ 'maintainer': 'Camptocamp',
+ 'category': 'Finance',
+ 'complexity': 'expert',
+ 'depends': ['account_easy_reconcile'],
+ 'description': """
+Easy Reconcile Benchmark
+========================
+
+Measure the throughput of the reconciliation methods on generated
+journal items.
+
+For each scenario, a synthetic ledger of open journal items is
+generated on a reconcilable account: invoices and their payments,
+with a configurable number of lines, skew of the partners (a few
+partners get most of the lines), rate of payments using the reference
+of another invoice and ratio of invoices paid in several payments.
+Each reconciliation method is run on the ledger and the following
+figures are recorded:
+
+ - number of lines and lines reconciled per second
+ - groups, full and partial reconciliations
+ - time spent in queries, matching and writes
+ - peak memory of the process during the run
+ - number of SQL statements executed
+
+Each run is done in a savepoint which is rolled back afterwards,
+nothing stays in the database. The journal items are generated on an
+account created for the run, so the real items are never reconciled.
+The sequences are switched to 'no gap' during the run, so their
+numbers are rolled back too; they stay locked until the end of the
+run. The peak memory is measured for each run (Linux only).
+
+The benchmark is run with a script, from the directory of the server::
+
+    python account_easy_reconcile_benchmark/scripts/run_benchmark.py \\
+        -c openerp-server.conf -d benchmark_db \\
+        --output /tmp/reconcile_benchmark.json \\
+        --baseline /tmp/reconcile_baseline.json
+
+The results are written in a JSON file. When the results of a
+previous run are given as baseline, the runs slower than the
+baseline by more than the tolerance are reported as regressions and
+the script exits with the status 1.
+
+Do not install this module on a production database.
+ """,
+ 'website': 'http://www.camptocamp.com',
+ 'data': [],
+ 'test': [],
+ 'installable': False,
+ 'images': [],
+ 'auto_install': False,
+ 'license': 'AGPL-3',
+ }
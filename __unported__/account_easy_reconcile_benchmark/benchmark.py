@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2014 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import logging
+import time
+
+from openerp import SUPERUSER_ID
+from openerp.osv import fields, orm
+from openerp.tools.translate import _
+from openerp.addons.account_easy_reconcile.base_reconciliation import (
+    ReconcileStats)
+from .ledger import SyntheticLedger
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_SCENARIOS = [
+    {'name': 'uniform',
+     'lines': 10000,
+     'partners': 500,
+     'partner_skew': 0.,
+     'ref_collision_rate': 0.,
+     'partial_ratio': 0.},
+    {'name': 'skewed_partners',
+     'lines': 10000,
+     'partners': 500,
+     'partner_skew': 1.2,
+     'ref_collision_rate': 0.02,
+     'partial_ratio': 0.1},
+    {'name': 'ref_collisions',
+     'lines': 10000,
+     'partners': 100,
+     'partner_skew': 0.5,
+     'ref_collision_rate': 0.3,
+     'partial_ratio': 0.1},
+    {'name': 'partial_payments',
+     'lines': 10000,
+     'partners': 100,
+     'partner_skew': 0.5,
+     'ref_collision_rate': 0.02,
+     'partial_ratio': 0.5},
+]
+
+
+def _read_memory_status(key):
+    """ Read a memory figure of the process from /proc (Linux), in
+    kilobytes, None when it is not available """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1])
+    except (IOError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _reset_peak_memory():
+    """ Reset the peak resident set size of the process (Linux 4.0+)
+
+    The maximum resident set size of getrusage() is the peak of the
+    whole life of the process, so it can not measure a run alone.
+
+    :return: True if the peak has been reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except IOError:
+        return False
+    return True
+
+
+class EasyReconcileBenchmark(orm.AbstractModel):
+    """ Run the reconciliation methods on synthetic ledgers
+
+    See the description of the module. Each run is done in a savepoint
+    rolled back afterwards, on an account created for the run. It is
+    started by the script ``scripts/run_benchmark.py``, not through
+    RPC.
+    """
+
+    _name = 'easy.reconcile.benchmark'
+    _description = 'Benchmark of the reconciliation methods'
+
+    # number of journal items inserted per statement
+    _insert_chunk = 1000
+
+    def _benchmark_environment(self, cr, uid, context=None):
+        """ Create the account and find the journal and period used for
+        the items, must be called in the savepoint of the run
+
+        The items are generated on a new account, copied from a
+        receivable account of the company, so the reconciliations of
+        the benchmark never touch the real items.
+
+        :return: dict with 'company_id', 'account_id', 'journal_id',
+                 'period_id' and 'date'
+        """
+        user = self.pool['res.users'].browse(cr, uid, uid, context=context)
+        company_id = user.company_id.id
+        account_obj = self.pool['account.account']
+        account_ids = account_obj.search(
+            cr, uid,
+            [('company_id', '=', company_id),
+             ('type', '=', 'receivable'),
+             ('reconcile', '=', True)],
+            limit=1, context=context)
+        journal_ids = self.pool['account.journal'].search(
+            cr, uid,
+            [('company_id', '=', company_id),
+             ('type', '=', 'general')],
+            limit=1, context=context)
+        if not account_ids or not journal_ids:
+            raise orm.except_orm(
+                _('Error'),
+                _('The benchmark needs a reconcilable receivable account '
+                  'and a general journal in the company of the user.'))
+        template = account_obj.browse(cr, uid, account_ids[0],
+                                      context=context)
+        account_id = account_obj.create(
+            cr, uid,
+            {'name': 'Reconciliation Benchmark',
+             'code': 'BENCH-%d' % template.id,
+             'type': 'receivable',
+             'reconcile': True,
+             'user_type': template.user_type.id,
+             'parent_id': template.parent_id.id,
+             'company_id': company_id},
+            context=context)
+        date = fields.date.context_today(self, cr, uid, context=context)
+        period_ids = self.pool['account.period'].find(
+            cr, uid, dt=date, context=context)
+        return {'company_id': company_id,
+                'account_id': account_id,
+                'journal_id': journal_ids[0],
+                'period_id': period_ids[0],
+                'date': date}
+
+    def _transactional_sequences(self, cr, uid, context=None):
+        """ Make the numbers of the sequences rolled back with the run
+
+        The standard sequences use PostgreSQL sequences, whose numbers
+        are consumed even when the transaction is rolled back, so the
+        reconciliations and the write-off moves of the benchmark would
+        leave gaps in the real numbering. Switched to 'no_gap' in the
+        savepoint, they are rolled back with it. The sequences stay
+        locked until the end of the run.
+        """
+        cr.execute("UPDATE ir_sequence SET implementation = 'no_gap' "
+                   "WHERE implementation = 'standard'")
+
+    def _create_partners(self, cr, uid, count, context=None):
+        partner_obj = self.pool['res.partner']
+        partner_ids = []
+        for number in xrange(count):
+            partner_ids.append(partner_obj.create(
+                cr, uid, {'name': 'Benchmark Partner %d' % number},
+                context=context))
+        return partner_ids
+
+    def _insert_lines(self, cr, uid, env, partner_ids, lines, context=None):
+        """ Insert a chunk of generated items in one journal entry """
+        cr.execute("INSERT INTO account_move "
+                   "(name, ref, journal_id, period_id, date, state, "
+                   " company_id, create_uid, create_date, write_uid, "
+                   " write_date) "
+                   "VALUES ('BENCH', 'BENCH', %s, %s, %s, 'posted', %s, "
+                   "        %s, now(), %s, now()) "
+                   "RETURNING id",
+                   (env['journal_id'], env['period_id'], env['date'],
+                    env['company_id'], uid, uid))
+        move_id = cr.fetchone()[0]
+        values = ','.join(
+            cr.mogrify("(%s, %s, %s, %s, %s, %s, %s, %s, 'valid', %s, %s, "
+                       " %s, %s, false, 'normal', %s, now(), %s, now())",
+                       (line['name'], line['ref'], move_id,
+                        env['account_id'], env['journal_id'],
+                        env['period_id'], env['date'], env['date'],
+                        line['debit'], line['credit'],
+                        partner_ids[line['partner']], env['company_id'],
+                        uid, uid))
+            for line in lines)
+        cr.execute("INSERT INTO account_move_line "
+                   "(name, ref, move_id, account_id, journal_id, period_id, "
+                   " date, date_created, state, debit, credit, partner_id, "
+                   " company_id, blocked, centralisation, create_uid, "
+                   " create_date, write_uid, write_date) "
+                   "VALUES " + values)
+
+    def _insert_ledger(self, cr, uid, scenario, env, context=None):
+        """ Generate and insert the items of a scenario
+
+        :return: number of inserted items
+        """
+        ledger = SyntheticLedger(
+            lines=scenario.get('lines', 10000),
+            partners=scenario.get('partners', 100),
+            partner_skew=scenario.get('partner_skew', 1.),
+            ref_collision_rate=scenario.get('ref_collision_rate', 0.05),
+            partial_ratio=scenario.get('partial_ratio', 0.1),
+            seed=scenario.get('seed', 42))
+        partner_ids = self._create_partners(
+            cr, SUPERUSER_ID, ledger.partners, context=context)
+        count = 0
+        chunk = []
+        for line in ledger:
+            chunk.append(line)
+            if len(chunk) == self._insert_chunk:
+                self._insert_lines(cr, uid, env, partner_ids, chunk,
+                                   context=context)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            self._insert_lines(cr, uid, env, partner_ids, chunk,
+                               context=context)
+            count += len(chunk)
+        return count
+
+    def _run_method(self, cr, uid, method_name, env, lines, context=None):
+        """ Run a reconciliation method on the account of the benchmark
+
+        :return: dict of the measures of the run
+        """
+        rec_model = self.pool[method_name]
+        rec_id = rec_model.create(
+            cr, uid,
+            {'account_id': env['account_id'],
+             'journal_id': env['journal_id']},
+            context=context)
+        stats = ReconcileStats()
+        # the run must stay in the transaction rolled back afterwards
+        ctx = dict(context, reconcile_stats=stats, reconcile_no_commit=True)
+        sql_count = getattr(cr, 'sql_log_count', 0)
+        memory = _read_memory_status('VmRSS')
+        peak_reset = _reset_peak_memory()
+        start = time.time()
+        reconciled_ids, partial_ids = rec_model.automatic_reconcile(
+            cr, uid, rec_id, context=ctx)
+        elapsed = time.time() - start
+        stats.stop()
+        peak_memory = None
+        if peak_reset:
+            peak_memory = _read_memory_status('VmHWM')
+        memory_growth = None
+        if peak_memory is not None and memory is not None:
+            memory_growth = peak_memory - memory
+        return {'method': method_name,
+                'lines': lines,
+                'reconciled_lines': len(reconciled_ids),
+                'partial_lines': len(partial_ids),
+                'groups': stats.groups,
+                'full': stats.full,
+                'partial': stats.partial,
+                'time': elapsed,
+                'lines_per_second': lines / elapsed if elapsed else 0.,
+                'query_time': stats.timings['query'],
+                'matching_time': stats.timings['matching'],
+                'write_time': stats.timings['write'],
+                'peak_memory_kb': peak_memory,
+                'memory_growth_kb': memory_growth,
+                'sql_statements': (getattr(cr, 'sql_log_count', 0) -
+                                   sql_count)}
+
+    @staticmethod
+    def _compare_results(results, baseline, tolerance):
+        """ Return the runs which regressed compared to a baseline
+
+        A run regresses when it reconciles fewer lines per second or
+        executes more SQL statements than the same scenario and method
+        of the baseline, by more than the tolerance (a ratio).
+        """
+        previous = dict(((res['scenario'], res['method']), res)
+                        for res in baseline.get('results', []))
+        regressions = []
+        for result in results:
+            base = previous.get((result['scenario'], result['method']))
+            if not base:
+                continue
+            if (result['lines_per_second'] <
+                    base['lines_per_second'] * (1 - tolerance)):
+                regressions.append(
+                    {'scenario': result['scenario'],
+                     'method': result['method'],
+                     'measure': 'lines_per_second',
+                     'baseline': base['lines_per_second'],
+                     'value': result['lines_per_second']})
+            if (result['sql_statements'] >
+                    base['sql_statements'] * (1 + tolerance)):
+                regressions.append(
+                    {'scenario': result['scenario'],
+                     'method': result['method'],
+                     'measure': 'sql_statements',
+                     'baseline': base['sql_statements'],
+                     'value': result['sql_statements']})
+        return regressions
+
+    def _run_benchmark(self, cr, uid, scenarios=None, methods=None,
+                       baseline=None, tolerance=0.2, context=None):
+        """ Run the reconciliation methods on the scenarios
+
+        :param scenarios: list of dicts with a 'name' and the arguments
+                          of `SyntheticLedger`, `DEFAULT_SCENARIOS`
+                          when empty
+        :param methods: names of the models of the reconciliation
+                        methods, all the available methods when empty
+        :param baseline: report of a previous run to compare with
+        :param tolerance: ratio of slowdown allowed before a run is
+                          reported as a regression
+        :return: report, dict with the 'results' of the runs and the
+                 'regressions' found
+        """
+        if context is None:
+            context = {}
+        if not scenarios:
+            scenarios = DEFAULT_SCENARIOS
+        if not methods:
+            method_obj = self.pool['account.easy.reconcile.method']
+            methods = [name for name, __ in
+                       method_obj._get_all_rec_method(cr, uid,
+                                                      context=context)]
+        results = []
+        for scenario in scenarios:
+            for method_name in methods:
+                cr.execute("SAVEPOINT easy_reconcile_benchmark")
+                try:
+                    self._transactional_sequences(cr, uid, context=context)
+                    env = self._benchmark_environment(cr, uid,
+                                                      context=context)
+                    lines = self._insert_ledger(cr, uid, scenario, env,
+                                                context=context)
+                    result = self._run_method(cr, uid, method_name, env,
+                                              lines, context=context)
+                finally:
+                    cr.execute("ROLLBACK TO SAVEPOINT "
+                               "easy_reconcile_benchmark")
+                result['scenario'] = scenario['name']
+                _logger.info("Benchmark %s on %s: %d lines, "
+                             "%.1f lines/s, %d SQL statements",
+                             method_name, scenario['name'], lines,
+                             result['lines_per_second'],
+                             result['sql_statements'])
+                results.append(result)
+        regressions = []
+        if baseline:
+            regressions = self._compare_results(results, baseline,
+                                                tolerance)
+            for regression in regressions:
+                _logger.warning("Benchmark regression of %(method)s on "
+                                "%(scenario)s: %(measure)s is %(value)s, "
+                                "was %(baseline)s", regression)
+        return {'date': fields.datetime.now(),
+                'database': cr.dbname,
+                'scenarios': scenarios,
+                'results': results,
+                'regressions': regressions}
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2014 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import random
+from bisect import bisect_right
+
+
+class SyntheticLedger(object):
+    """ Generator of the open journal items of a benchmark scenario
+
+    The items are invoices (debit) followed by their payments (credit)
+    with the same partner. The generation is seeded so a scenario always
+    gives the same items.
+
+    :param lines: number of items to generate
+    :param partners: number of partners
+    :param partner_skew: exponent of the Zipf distribution of the
+                         partners, 0 gives the same number of items to
+                         all the partners, 1 or more gives most of the
+                         items to a few partners
+    :param ref_collision_rate: ratio of the payments using the reference
+                               of another invoice
+    :param partial_ratio: ratio of the invoices paid in 2 payments
+    :param seed: seed of the random generator
+    """
+
+    def __init__(self, lines=10000, partners=100, partner_skew=1.,
+                 ref_collision_rate=0.05, partial_ratio=0.1, seed=42):
+        self.lines = lines
+        self.partners = max(partners, 1)
+        self.partner_skew = partner_skew
+        self.ref_collision_rate = ref_collision_rate
+        self.partial_ratio = partial_ratio
+        self.seed = seed
+        self._cumulative_weights = []
+        total = 0.
+        for rank in xrange(1, self.partners + 1):
+            total += 1. / (rank ** partner_skew)
+            self._cumulative_weights.append(total)
+
+    def _partner(self, rand):
+        """ Return the index of a partner, drawn with the skew """
+        total = self._cumulative_weights[-1]
+        index = bisect_right(self._cumulative_weights, rand.random() * total)
+        return min(index, self.partners - 1)
+
+    def _payments(self, rand, amount):
+        if rand.random() < self.partial_ratio:
+            first = round(amount * rand.uniform(0.2, 0.8), 2)
+            return [first, round(amount - first, 2)]
+        return [amount]
+
+    def __iter__(self):
+        """ Yield the items as dicts with the keys: 'partner' (index of
+        the partner), 'ref', 'name', 'debit' and 'credit' """
+        rand = random.Random(self.seed)
+        count = 0
+        invoice = 0
+        while count < self.lines:
+            invoice += 1
+            partner = self._partner(rand)
+            ref = 'BENCH%08d' % invoice
+            amount = round(rand.uniform(10., 5000.), 2)
+            yield {'partner': partner, 'ref': ref, 'name': ref,
+                   'debit': amount, 'credit': 0.}
+            count += 1
+            for payment in self._payments(rand, amount):
+                if count >= self.lines:
+                    break
+                payment_ref = ref
+                if invoice > 1 and rand.random() < self.ref_collision_rate:
+                    payment_ref = 'BENCH%08d' % rand.randint(1, invoice - 1)
+                yield {'partner': partner, 'ref': payment_ref,
+                       'name': payment_ref, 'debit': 0., 'credit': payment}
+                count += 1
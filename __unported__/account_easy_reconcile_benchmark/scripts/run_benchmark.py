@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2014 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+""" Run the benchmark of the reconciliation methods on a database
+
+Usage (from the directory of the server, so ``openerp`` is importable)::
+
+    python <path of the addon>/scripts/run_benchmark.py \\
+        -c openerp-server.conf -d benchmark_db \\
+        --output /tmp/reconcile_benchmark.json \\
+        --baseline /tmp/reconcile_baseline.json
+
+The exit status is 1 when regressions are found compared to the
+baseline.
+"""
+
+import argparse
+import json
+import sys
+
+import openerp
+from openerp import SUPERUSER_ID
+from openerp.modules.registry import RegistryManager
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the reconciliation methods")
+    parser.add_argument('-c', '--config',
+                        help="configuration file of the server")
+    parser.add_argument('-d', '--database', required=True,
+                        help="database where the benchmark is run, "
+                             "with account_easy_reconcile_benchmark "
+                             "installed")
+    parser.add_argument('--scenarios',
+                        help="JSON file with the list of the scenarios, "
+                             "the default scenarios when omitted")
+    parser.add_argument('--method', dest='methods', action='append',
+                        help="model of a reconciliation method to run, "
+                             "can be repeated, all when omitted")
+    parser.add_argument('--output',
+                        help="JSON file where the results are written")
+    parser.add_argument('--baseline',
+                        help="JSON file of the results of a previous run "
+                             "to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="ratio of slowdown allowed before a run is "
+                             "reported as a regression (default: 0.2)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = baseline = None
+    if args.scenarios:
+        with open(args.scenarios) as scenarios_file:
+            scenarios = json.load(scenarios_file)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    openerp.tools.config.parse_config(
+        ['-c', args.config] if args.config else [])
+    registry = RegistryManager.get(args.database)
+    cr = registry.db.cursor()
+    try:
+        report = registry['easy.reconcile.benchmark']._run_benchmark(
+            cr, SUPERUSER_ID, scenarios=scenarios, methods=args.methods,
+            baseline=baseline, tolerance=args.tolerance)
+    finally:
+        # every run is rolled back, nothing has to be kept
+        cr.rollback()
+        cr.close()
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    return 1 if report['regressions'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2014 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import unittest2
+
+from ..benchmark import EasyReconcileBenchmark
+
+
+def _result(scenario='uniform', method='easy.reconcile.simple.name',
+            lines_per_second=1000., sql_statements=100):
+    return {'scenario': scenario,
+            'method': method,
+            'lines_per_second': lines_per_second,
+            'sql_statements': sql_statements}
+
+
+class TestCompareResults(unittest2.TestCase):
+
+    def compare(self, results, baseline, tolerance=0.2):
+        return EasyReconcileBenchmark._compare_results(
+            results, {'results': baseline}, tolerance)
+
+    def test_no_regression(self):
+        regressions = self.compare(
+            [_result(lines_per_second=900., sql_statements=110)],
+            [_result()])
+        self.assertEqual(regressions, [])
+
+    def test_slower(self):
+        regressions = self.compare([_result(lines_per_second=700.)],
+                                   [_result()])
+        self.assertEqual(regressions,
+                         [{'scenario': 'uniform',
+                           'method': 'easy.reconcile.simple.name',
+                           'measure': 'lines_per_second',
+                           'baseline': 1000.,
+                           'value': 700.}])
+
+    def test_more_sql_statements(self):
+        regressions = self.compare([_result(sql_statements=150)],
+                                   [_result()])
+        self.assertEqual([reg['measure'] for reg in regressions],
+                         ['sql_statements'])
+        self.assertEqual(regressions[0]['value'], 150)
+
+    def test_tolerance(self):
+        results = [_result(lines_per_second=850.)]
+        self.assertEqual(self.compare(results, [_result()], 0.2), [])
+        self.assertEqual(len(self.compare(results, [_result()], 0.1)), 1)
+
+    def test_matched_on_scenario_and_method(self):
+        baseline = [_result(scenario='skewed_partners',
+                            lines_per_second=5000.),
+                    _result(method='easy.reconcile.simple.partner',
+                            lines_per_second=5000.),
+                    _result()]
+        regressions = self.compare([_result(lines_per_second=900.)],
+                                   baseline)
+        self.assertEqual(regressions, [])
+
+    def test_not_in_baseline(self):
+        regressions = self.compare([_result(lines_per_second=1.)], [])
+        self.assertEqual(regressions, [])
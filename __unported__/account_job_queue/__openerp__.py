@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2014 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+{'name': 'Accounting Job Queue',
+ 'version': '1.0',
+ 'author': 'Camptocamp',
+ 'maintainer': 'Camptocamp',
+ 'category': 'Hidden/Dependency',
+ 'complexity': 'normal',
+ 'depends': ['account',
+             'account_easy_reconcile',
+             ],
+ 'description': """
+Accounting Job Queue
+====================
+
+Run long accounting tasks (reconciliations, bank statement imports and
+completions) in the background instead of in the request of the user.
+
+A job is stored in the database and split in chunks (as instance a
+number of statement lines). A cron starts worker processes which take
+the pending chunks, each chunk is run and committed in its own
+transaction by the user who created the job. The chunks of a job are
+run one after the other, the chunks of different jobs run in parallel.
+A chunk which fails is retried, the job fails when a chunk fails more
+than the maximum number of retries.
+
+A worker holds a PostgreSQL advisory lock on the chunk it runs, taken
+with ``pg_try_advisory_lock`` when it claims the chunk, so two workers
+never claim the same chunk. When the worker is gone (process killed,
+server restarted), PostgreSQL releases the lock and the next run of the
+cron runs the chunk again.
+A chunk which is only slow is never run twice.
+
+The modules using the jobs do not depend on this one: their background
+actions are available when it is installed. This module adds the button
+running a reconciliation profile in the background, the modules
+account_statement_completion_job and account_statement_import_job,
+installed automatically, add the buttons of the bank statements.
+
+The user only creates the job and follows its progress in
+Accounting > Periodical Processing > Background Jobs.
+
+The methods run by the jobs have the signature
+``method(cr, uid, payload, context=None)`` where the payload is a
+JSON-serializable value. A chunk can add chunks to its job with
+``add_chunks``, the id of the job is in the context (``job_id``).
+ """,
+ 'website': 'http://www.camptocamp.com',
+ 'data': ['job_view.xml',
+          'job_data.xml',
+          'easy_reconcile_view.xml',
+          'security/ir.model.access.csv'],
+ 'test': [],
+ 'installable': False,
+ 'images': [],
+ 'auto_install': False,
+ 'license': 'AGPL-3',
+ }
@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2014 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import json
+import logging
+import multiprocessing
+import time
+import traceback
+
+from psycopg2.extensions import TransactionRollbackError
+
+from openerp import SUPERUSER_ID, pooler
+from openerp.osv import fields, orm
+from openerp.tools.translate import _
+from openerp.addons.account_easy_reconcile.easy_reconcile import (
+    init_worker_process)
+
+_logger = logging.getLogger(__name__)
+
+
+def _process_chunks_worker(args):
+    """ Claim and run the pending chunks one after the other, each with
+    a new cursor, until there is none left or the deadline is passed
+
+    :return: number of chunks run
+    """
+    dbname, deadline = args
+    db, pool = pooler.get_db_and_pool(dbname, pooljobs=False)
+    job_obj = pool['account.job']
+    count = 0
+    while time.time() < deadline:
+        cr = db.cursor()
+        try:
+            chunk_id = job_obj._claim_chunk(cr, SUPERUSER_ID)
+            if not chunk_id:
+                break
+            try:
+                pool['account.job.chunk'].run(cr, SUPERUSER_ID, chunk_id)
+            except Exception:
+                _logger.exception("Chunk %d of a job could not be run",
+                                  chunk_id)
+                cr.rollback()
+            finally:
+                job_obj._release_chunk(cr, SUPERUSER_ID, chunk_id)
+            count += 1
+        finally:
+            cr.close()
+    return count
+
+
+class AccountJob(orm.Model):
+    """ Task run in the background, split in chunks """
+
+    _name = 'account.job'
+    _description = 'Accounting Background Job'
+    _order = 'id DESC'
+
+    # seconds after which `process_jobs` stops taking new chunks
+    _process_max_time = 600
+
+    def _get_progress(self, cr, uid, ids, names, arg, context=None):
+        result = dict((job_id, {'chunk_count': 0,
+                                'chunk_done': 0,
+                                'progress': 0.})
+                      for job_id in ids)
+        if not ids:
+            return result
+        cr.execute("SELECT job_id, count(*), "
+                   "       count(CASE WHEN state = 'done' THEN 1 END) "
+                   "FROM account_job_chunk "
+                   "WHERE job_id IN %s "
+                   "GROUP BY job_id",
+                   (tuple(ids),))
+        for job_id, count, done in cr.fetchall():
+            result[job_id] = {'chunk_count': count,
+                              'chunk_done': done,
+                              'progress': 100. * done / count}
+        return result
+
+    _columns = {
+        'name': fields.char('Name', required=True, readonly=True),
+        'model': fields.char('Model', required=True, readonly=True),
+        'method': fields.char('Method', required=True, readonly=True),
+        'context': fields.text('Context', readonly=True),
+        'user_id': fields.many2one('res.users', 'User', readonly=True),
+        'company_id': fields.many2one('res.company', 'Company',
+                                      readonly=True),
+        'state': fields.selection(
+            [('pending', 'Pending'),
+             ('running', 'Running'),
+             ('done', 'Done'),
+             ('failed', 'Failed')],
+            string='State', readonly=True, required=True),
+        'max_retries': fields.integer(
+            'Maximum Retries',
+            help="Number of times a failed chunk is run again before "
+                 "the job fails."),
+        'date_started': fields.datetime('Start date', readonly=True),
+        'date_done': fields.datetime('End date', readonly=True),
+        'chunk_ids': fields.one2many('account.job.chunk', 'job_id',
+                                     string='Chunks', readonly=True),
+        'chunk_count': fields.function(
+            _get_progress, string='Chunks', type='integer',
+            multi='progress'),
+        'chunk_done': fields.function(
+            _get_progress, string='Chunks Done', type='integer',
+            multi='progress'),
+        'progress': fields.function(
+            _get_progress, string='Progress', type='float',
+            multi='progress'),
+    }
+
+    _defaults = {
+        'state': 'pending',
+        'max_retries': 3,
+        'user_id': lambda self, cr, uid, context: uid,
+        'company_id': lambda self, cr, uid, context: self.pool[
+            'res.users'].browse(cr, uid, uid,
+                                context=context).company_id.id,
+    }
+
+    def enqueue(self, cr, uid, name, model, method, payloads, context=None):
+        """ Create a job running ``method`` of ``model`` on each payload
+
+        :param payloads: list of JSON-serializable values, one per chunk
+        :return: id of the job
+        """
+        if context is None:
+            context = {}
+        job_context = dict((key, context[key]) for key in ('lang', 'tz')
+                           if context.get(key))
+        return self.create(
+            cr, uid,
+            {'name': name,
+             'model': model,
+             'method': method,
+             'context': json.dumps(job_context),
+             'chunk_ids': [(0, 0, {'sequence': sequence,
+                                   'payload': json.dumps(payload)})
+                           for sequence, payload in enumerate(payloads)]},
+            context=context)
+
+    def add_chunks(self, cr, uid, job_id, payloads, context=None):
+        """ Add chunks at the end of a job, as instance from one of
+        its chunks """
+        cr.execute("SELECT COALESCE(max(sequence), -1) "
+                   "FROM account_job_chunk WHERE job_id = %s", (job_id,))
+        start = cr.fetchone()[0] + 1
+        chunk_obj = self.pool['account.job.chunk']
+        for sequence, payload in enumerate(payloads, start=start):
+            chunk_obj.create(cr, SUPERUSER_ID,
+                             {'job_id': job_id,
+                              'sequence': sequence,
+                              'payload': json.dumps(payload)},
+                             context=context)
+        return True
+
+    def open_job(self, cr, uid, job_id, context=None):
+        """ Return the action showing the progress of a job """
+        return {
+            'name': _('Background Job'),
+            'view_mode': 'form',
+            'view_type': 'form',
+            'res_model': 'account.job',
+            'res_id': job_id,
+            'type': 'ir.actions.act_window',
+            'auto_refresh': 5,
+            'target': 'current',
+        }
+
+    def _update_state(self, cr, uid, job_id, context=None):
+        """ Compute the state of a job from the states of its chunks """
+        cr.execute("SELECT state, count(*) FROM account_job_chunk "
+                   "WHERE job_id = %s GROUP BY state", (job_id,))
+        counts = dict(cr.fetchall())
+        if counts.get('failed'):
+            state = 'failed'
+        elif not (counts.get('pending') or counts.get('running')):
+            state = 'done'
+        elif counts.get('running') or counts.get('done'):
+            state = 'running'
+        else:
+            state = 'pending'
+        date_done = 'now()' if state in ('done', 'failed') else 'NULL'
+        cr.execute("UPDATE account_job "
+                   "SET state = %s, date_done = " + date_done + ", "
+                   "    write_date = now() "
+                   "WHERE id = %s",
+                   (state, job_id))
+        return state
+
+    # The session running a chunk holds an advisory lock on it, from
+    # its claim until the chunk is done or failed. The lock is released
+    # by PostgreSQL when the session ends, so a running chunk whose lock
+    # is free has lost its worker (killed process, server restarted).
+    # The keys of the locks are the oid of account_job_chunk and the id
+    # of the chunk. The lock is also what makes a claim exclusive, the
+    # rows are not locked.
+
+    def _requeue_lost_chunks(self, cr, uid, context=None):
+        """ Run again the running chunks whose worker is gone """
+        cr.execute("SELECT id FROM account_job_chunk "
+                   "WHERE state = 'running'")
+        locked_ids = []
+        for chunk_id, in cr.fetchall():
+            cr.execute("SELECT pg_try_advisory_lock("
+                       "    'account_job_chunk'::regclass::int, %s)",
+                       (chunk_id,))
+            if cr.fetchone()[0]:
+                locked_ids.append(chunk_id)
+        chunk_ids = locked_ids
+        try:
+            if chunk_ids:
+                cr.execute("UPDATE account_job_chunk "
+                           "SET state = 'pending', attempts = attempts + 1 "
+                           "WHERE id IN %s AND state = 'running'",
+                           (tuple(chunk_ids),))
+                _logger.warning("Chunks %s of jobs are run again, their "
+                                "worker is gone", chunk_ids)
+            cr.commit()
+        except TransactionRollbackError:
+            # a chunk has just been done, the next run will check again
+            cr.rollback()
+            chunk_ids = []
+        finally:
+            for chunk_id in locked_ids:
+                self._release_chunk(cr, uid, chunk_id, context=context)
+        return chunk_ids
+
+    def _claim_chunk(self, cr, uid, context=None):
+        """ Take the next pending chunk and mark it as running
+
+        A job has only one running chunk at a time, its chunks are run
+        in their sequence. The chunk is locked for the session of the
+        cursor until `_release_chunk()` is called, see
+        `_requeue_lost_chunks()`. A chunk locked by another worker is
+        skipped.
+
+        :return: id of the chunk or False
+        """
+        cr.execute("SELECT chunk.id "
+                   "FROM account_job_chunk chunk "
+                   "JOIN account_job job ON job.id = chunk.job_id "
+                   "WHERE job.state IN ('pending', 'running') "
+                   "AND chunk.state = 'pending' "
+                   "AND NOT EXISTS ("
+                   "    SELECT 1 FROM account_job_chunk other "
+                   "    WHERE other.job_id = chunk.job_id "
+                   "    AND (other.state = 'running' "
+                   "         OR (other.state = 'pending' "
+                   "             AND (other.sequence, other.id) < "
+                   "                 (chunk.sequence, chunk.id)))) "
+                   "ORDER BY chunk.job_id")
+        candidate_ids = [row[0] for row in cr.fetchall()]
+        cr.commit()
+        for chunk_id in candidate_ids:
+            cr.execute("SELECT pg_try_advisory_lock("
+                       "    'account_job_chunk'::regclass::int, %s)",
+                       (chunk_id,))
+            if not cr.fetchone()[0]:
+                # claimed by another worker
+                cr.commit()
+                continue
+            try:
+                # the chunk may have been run by another worker since
+                # the candidates have been read
+                cr.execute("UPDATE account_job_chunk "
+                           "SET state = 'running', date_started = now() "
+                           "WHERE id = %s AND state = 'pending' "
+                           "RETURNING job_id",
+                           (chunk_id,))
+                row = cr.fetchone()
+                if row:
+                    cr.execute("UPDATE account_job "
+                               "SET state = 'running', "
+                               "    date_started = COALESCE(date_started, "
+                               "                            now()) "
+                               "WHERE id = %s",
+                               (row[0],))
+                cr.commit()
+            except TransactionRollbackError:
+                # another worker has changed the chunk since the start
+                # of the transaction
+                cr.rollback()
+                row = None
+            if row:
+                return chunk_id
+            self._release_chunk(cr, uid, chunk_id, context=context)
+        return False
+
+    def _release_chunk(self, cr, uid, chunk_id, context=None):
+        """ Release the lock taken on a chunk by `_claim_chunk()`
+
+        The locks of a session are not transactional, it is released
+        at once.
+        """
+        cr.execute("SELECT pg_advisory_unlock("
+                   "    'account_job_chunk'::regclass::int, %s)",
+                   (chunk_id,))
+
+    def process_jobs(self, cr, uid, processes=None, context=None):
+        """ Run the pending chunks of the jobs in worker processes
+
+        Called by a cron. Each worker claims a chunk, runs and commits
+        it with its own cursor and takes the next one until the queue is
+        empty or `_process_max_time` is elapsed.
+
+        :param processes: number of worker processes, the number of
+                          CPUs by default, with 1 the chunks are run
+                          in the current process
+        """
+        self._requeue_lost_chunks(cr, uid, context=context)
+        # a job runs one chunk at a time
+        cr.execute("SELECT count(DISTINCT job_id) FROM account_job_chunk "
+                   "WHERE state = 'pending'")
+        jobs = cr.fetchone()[0]
+        if not jobs:
+            return True
+        processes = min(processes or multiprocessing.cpu_count(), jobs)
+        args = (cr.dbname, time.time() + self._process_max_time)
+        if processes == 1:
+            _process_chunks_worker(args)
+            return True
+        workers = multiprocessing.Pool(processes,
+                                       initializer=init_worker_process)
+        try:
+            workers.map(_process_chunks_worker, [args] * processes,
+                        chunksize=1)
+        finally:
+            workers.close()
+            workers.join()
+        return True
+
+    def retry(self, cr, uid, ids, context=None):
+        """ Run again the failed chunks of failed jobs """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        for job in self.browse(cr, uid, ids, context=context):
+            if job.state != 'failed':
+                continue
+            failed_ids = [chunk.id for chunk in job.chunk_ids
+                          if chunk.state == 'failed']
+            self.pool['account.job.chunk'].write(
+                cr, uid, failed_ids,
+                {'state': 'pending', 'attempts': 0},
+                context=context)
+            self._update_state(cr, uid, job.id, context=context)
+        return True
+
+
+class AccountJobChunk(orm.Model):
+    """ Part of a job run in one transaction """
+
+    _name = 'account.job.chunk'
+    _description = 'Accounting Background Job Chunk'
+    _order = 'job_id, sequence, id'
+
+    _columns = {
+        'job_id': fields.many2one('account.job', 'Job', required=True,
+                                  ondelete='cascade', readonly=True),
+        'sequence': fields.integer('Sequence', readonly=True),
+        'payload': fields.text('Payload', readonly=True),
+        'state': fields.selection(
+            [('pending', 'Pending'),
+             ('running', 'Running'),
+             ('done', 'Done'),
+             ('failed', 'Failed')],
+            string='State', readonly=True, required=True),
+        'attempts': fields.integer('Failed Attempts', readonly=True),
+        'result': fields.text('Result', readonly=True),
+        'error': fields.text('Error', readonly=True),
+        'date_started': fields.datetime('Start date', readonly=True),
+        'date_done': fields.datetime('End date', readonly=True),
+    }
+
+    _defaults = {
+        'state': 'pending',
+        'attempts': 0,
+    }
+
+    def run(self, cr, uid, chunk_id, context=None):
+        """ Run a chunk and commit
+
+        The method of the job is called by the user of the job. When
+        it fails, the transaction is rolled back and the chunk is
+        set back to pending until the maximum of retries is reached.
+        """
+        job_obj = self.pool['account.job']
+        chunk = self.browse(cr, uid, chunk_id, context=context)
+        job = chunk.job_id
+        job_id = job.id
+        attempts = chunk.attempts
+        max_retries = job.max_retries
+        job_context = json.loads(job.context or '{}')
+        job_context['job_id'] = job_id
+        model = self.pool[job.model]
+        method = getattr(model, job.method)
+        try:
+            result = method(cr, job.user_id.id, json.loads(chunk.payload),
+                            context=job_context)
+            self.write(cr, uid, [chunk_id],
+                       {'state': 'done',
+                        'result': json.dumps(result, default=repr),
+                        'error': False,
+                        'date_done': fields.datetime.now()},
+                       context=context)
+            cr.commit()
+        except Exception:
+            cr.rollback()
+            error = traceback.format_exc()
+            attempts += 1
+            _logger.error("Chunk %d of the job %d failed (attempt %d)\n%s",
+                          chunk_id, job_id, attempts, error)
+            self.write(cr, uid, [chunk_id],
+                       {'state': ('pending' if attempts <= max_retries
+                                  else 'failed'),
+                        'attempts': attempts,
+                        'error': error},
+                       context=context)
+            cr.commit()
+        job_obj._update_state(cr, uid, job_id, context=context)
+        cr.commit()
+        return True
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2014 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+{'name': 'Period lookup cache',
+ 'version': '1.0',
+ 'author': 'Camptocamp',
+ 'maintainer': 'Camptocamp',
+ 'category': 'Hidden/Dependency',
+ 'complexity': 'easy',
+ 'depends': ['account'],
+ 'description': """
+Period lookup cache
+===================
+
+Keep the periods of each company in memory so finding the period
+of a date (``account.period.find``) does not query the database.
+
+The bank statement imports, the completion and the reconciliation
+look up a period for each line they handle. With this module, the
+periods of a company are read once, kept in an interval table and
+each lookup is a search in memory.
+
+The cache is cleared when a period is created, modified or deleted,
+the other server processes are notified like for the other caches
+of the ORM.
+The periods found are filtered by the record rules of the user, as
+with the standard lookup. The periods allowed to a user and the
+company of the user are kept in the cache too, until the access
+rights, the record rules or the user change.
+ """,
+ 'website': 'http://www.camptocamp.com',
+ 'data': [],
+ 'test': [],
+ 'installable': False,
+ 'images': [],
+ 'auto_install': False,
+ 'license': 'AGPL-3',
+ }
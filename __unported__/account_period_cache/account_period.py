@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2014 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+
+from bisect import bisect_right
+
+from openerp import tools
+from openerp.osv import fields, orm
+from openerp.tools import DEFAULT_SERVER_DATE_FORMAT
+
+
+class PeriodIntervals(object):
+    """ Interval table of the periods of a company
+
+    The periods are sorted on their start date and each position keeps
+    the latest end date of the periods up to it, so a lookup bisects
+    the start dates and walks back only while a period can still
+    contain the date.
+    """
+
+    def __init__(self, periods):
+        """
+        :param periods: list of (id, date_start, date_stop, special)
+                        sorted like the periods are searched
+        """
+        self.periods = []
+        self.starts = []
+        self.max_stops = []
+        max_stop = None
+        for period_id, date_start, date_stop, special in periods:
+            self.periods.append((period_id, date_stop, bool(special)))
+            self.starts.append(date_start)
+            if max_stop is None or date_stop > max_stop:
+                max_stop = date_stop
+            self.max_stops.append(max_stop)
+
+    def restrict(self, ids):
+        """ Return the table of the periods whose id is in ``ids`` """
+        return PeriodIntervals(
+            (period_id, date_start, date_stop, special)
+            for date_start, (period_id, date_stop, special)
+            in zip(self.starts, self.periods)
+            if period_id in ids)
+
+    def find(self, dt, special=None):
+        """ Return the ids of the periods containing a date
+
+        :param dt: date as a string in the server format
+        :param special: when True or False, keep only the periods
+                        with this value in their ``special`` field
+        :return: list of ids, in the order of the periods
+        """
+        found = []
+        idx = bisect_right(self.starts, dt)
+        while idx > 0 and self.max_stops[idx - 1] >= dt:
+            idx -= 1
+            period_id, date_stop, period_special = self.periods[idx]
+            if date_stop < dt:
+                continue
+            if special is None or period_special == special:
+                found.append(period_id)
+        found.reverse()
+        return found
+
+
+class AccountPeriod(orm.Model):
+    """ Find the periods from a table kept in memory
+
+    The periods of a company are read once and kept in the cache of
+    the ORM, which is cleared when a period or a fiscal year changes.
+    The periods allowed by the record rules of a user and the default
+    company of the user are kept in the cache too, so a lookup does
+    not query the database. They are cleared with the caches of the
+    access rights and of the record rules, which also happens when a
+    user is modified.
+    """
+    _inherit = 'account.period'
+
+    def __init__(self, pool, cr):
+        super(AccountPeriod, self).__init__(pool, cr)
+        self.pool['ir.model.access'].register_cache_clearing_method(
+            self._name, 'clear_caches')
+
+    @tools.ormcache(skiparg=3)
+    def _period_intervals(self, cr, uid, company_id):
+        cr.execute("SELECT id, date_start, date_stop, special "
+                   "FROM account_period "
+                   "WHERE company_id = %s "
+                   "ORDER BY date_start, special DESC, id",
+                   (company_id,))
+        return PeriodIntervals(cr.fetchall())
+
+    @tools.ormcache()
+    def _user_period_intervals(self, cr, uid, company_id):
+        """ Table of the periods of a company allowed by the record
+        rules of the user """
+        intervals = self._period_intervals(cr, uid, company_id)
+        rule_obj = self.pool['ir.rule']
+        if not rule_obj._compute_domain(cr, uid, self._name, 'read'):
+            return intervals
+        allowed_ids = self.search(cr, uid, [('company_id', '=', company_id)])
+        return intervals.restrict(set(allowed_ids))
+
+    @tools.ormcache()
+    def _user_company_id(self, cr, uid):
+        user = self.pool['res.users'].browse(cr, uid, uid)
+        return user.company_id.id
+
+    def find(self, cr, uid, dt=None, context=None):
+        if context is None:
+            context = {}
+        if not dt:
+            dt = fields.date.context_today(self, cr, uid, context=context)
+        elif not isinstance(dt, basestring):
+            dt = dt.strftime(DEFAULT_SERVER_DATE_FORMAT)
+        # a datetime is looked up on its date
+        dt = dt[:10]
+        company_id = (context.get('company_id') or
+                      self._user_company_id(cr, uid))
+        intervals = self._user_period_intervals(cr, uid, company_id)
+        result = []
+        if context.get('account_period_prefer_normal', True):
+            # look for non-special periods first, like the standard find
+            result = intervals.find(dt, special=False)
+        if not result:
+            result = intervals.find(dt)
+        if not result:
+            # let the standard method raise its warning
+            return super(AccountPeriod, self).find(cr, uid, dt=dt,
+                                                   context=context)
+        return result
+
+    # the caches are cleared after the changes, otherwise a concurrent
+    # lookup could fill them again with the periods before the changes
+
+    def create(self, cr, uid, vals, context=None):
+        res = super(AccountPeriod, self).create(cr, uid, vals,
+                                                context=context)
+        self.clear_caches()
+        return res
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(AccountPeriod, self).write(cr, uid, ids, vals,
+                                               context=context)
+        self.clear_caches()
+        return res
+
+    def unlink(self, cr, uid, ids, context=None):
+        res = super(AccountPeriod, self).unlink(cr, uid, ids,
+                                                context=context)
+        self.clear_caches()
+        return res
+
+
+class AccountFiscalyear(orm.Model):
+    """ The company of the periods is the one of their fiscal year """
+    _inherit = 'account.fiscalyear'
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(AccountFiscalyear, self).write(cr, uid, ids, vals,
+                                                   context=context)
+        if 'company_id' in vals:
+            self.pool['account.period'].clear_caches()
+        return res
+
+    def unlink(self, cr, uid, ids, context=None):
+        res = super(AccountFiscalyear, self).unlink(cr, uid, ids,
+                                                    context=context)
+        self.pool['account.period'].clear_caches()
+        return res
+
+
+class IrRule(orm.Model):
+    """ The periods allowed to the users depend on the record rules """
+    _inherit = 'ir.rule'
+
+    def clear_cache(self, cr, uid):
+        super(IrRule, self).clear_cache(cr, uid)
+        self.pool['account.period'].clear_caches()
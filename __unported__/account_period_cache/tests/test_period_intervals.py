@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2014 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import unittest2
+
+from ..account_period import PeriodIntervals
+
+
+class TestPeriodIntervals(unittest2.TestCase):
+
+    def setUp(self):
+        # opening period, 12 months, closing period, like a fiscal year
+        periods = [(1, '2014-01-01', '2014-01-01', True)]
+        for month in range(1, 13):
+            stop = '2014-%02d-28' % month
+            periods.append((month + 1, '2014-%02d-01' % month, stop, False))
+        periods.append((14, '2014-12-31', '2014-12-31', True))
+        self.intervals = PeriodIntervals(sorted(
+            periods, key=lambda p: (p[1], not p[3], p[0])))
+
+    def test_find_normal_period(self):
+        self.assertEqual(self.intervals.find('2014-03-15'), [4])
+
+    def test_find_bounds_included(self):
+        self.assertEqual(self.intervals.find('2014-03-01'), [4])
+        self.assertEqual(self.intervals.find('2014-03-28'), [4])
+
+    def test_find_between_periods(self):
+        self.assertEqual(self.intervals.find('2014-03-30'), [])
+
+    def test_find_outside(self):
+        self.assertEqual(self.intervals.find('2013-12-31'), [])
+        self.assertEqual(self.intervals.find('2015-01-01'), [])
+
+    def test_find_special(self):
+        self.assertEqual(self.intervals.find('2014-01-01'), [1, 2])
+        self.assertEqual(self.intervals.find('2014-01-01', special=False),
+                         [2])
+        self.assertEqual(self.intervals.find('2014-01-01', special=True),
+                         [1])
+        self.assertEqual(self.intervals.find('2014-12-31', special=False),
+                         [])
+        self.assertEqual(self.intervals.find('2014-12-31'), [14])
+
+    def test_find_long_period_overlapping(self):
+        """ A period which starts before shorter ones and ends after
+        them is found after the shorter ones have been passed """
+        intervals = PeriodIntervals([
+            (1, '2014-01-01', '2014-12-31', False),
+            (2, '2014-02-01', '2014-02-28', False),
+            (3, '2014-03-01', '2014-03-31', False),
+        ])
+        self.assertEqual(intervals.find('2014-02-10'), [1, 2])
+        self.assertEqual(intervals.find('2014-04-10'), [1])
+        self.assertEqual(intervals.find('2015-01-01'), [])
+
+    def test_find_empty(self):
+        self.assertEqual(PeriodIntervals([]).find('2014-01-01'), [])
+
+    def test_restrict(self):
+        intervals = self.intervals.restrict(set([1, 3, 4]))
+        self.assertEqual(intervals.find('2014-01-01'), [1])
+        self.assertEqual(intervals.find('2014-02-10'), [3])
+        self.assertEqual(intervals.find('2014-03-10'), [4])
+        self.assertEqual(intervals.find('2014-04-10'), [])
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2014 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import threading
+from collections import defaultdict, deque
+
+
+class LabelMatcher(object):
+    """ Aho-Corasick automaton finding labels in texts
+
+    All the labels are compiled once in a trie whose states are linked
+    to the longest suffix which is also a state, so a text is scanned in
+    a single pass whatever the number of labels. The matching is case
+    insensitive.
+    """
+
+    def __init__(self, labels):
+        """
+        :param labels: iterable of (label, value), a value is returned
+                       by `find` when its label is in the text
+        """
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [set()]
+        for label, value in labels:
+            label = label.lower()
+            if not label:
+                continue
+            state = 0
+            for char in label:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(set())
+                    self.goto[state][char] = next_state
+                state = next_state
+            self.output[state].add(value)
+        # breadth-first, so the failure state of a state is always
+        # computed before the state itself
+        queue = deque(self.goto[0].itervalues())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].iteritems():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[next_state] = fail
+                self.output[next_state] |= self.output[fail]
+
+    def find(self, text):
+        """ Return the set of the values whose label is in the text """
+        found = set()
+        if not text:
+            return found
+        state = 0
+        for char in text.lower():
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.output[state]:
+                found |= self.output[state]
+        return found
+
+
+class NameIndex(object):
+    """ Inverted index of names on their trigrams
+
+    Each name is indexed on its trigram which is the least frequent in
+    all the names, a name contained in a text necessarily has this
+    trigram in the text. So only a handful of names are candidates for
+    a text and they are verified exactly. The names shorter than a
+    trigram are candidates for every text. The matching is case
+    insensitive and the index can be updated name by name, it can be
+    shared by threads.
+    """
+
+    def __init__(self, names=()):
+        """
+        :param names: iterable of (key, name)
+        """
+        self.names = {}
+        self.keys = {}
+        self.postings = defaultdict(set)
+        self.counts = defaultdict(int)
+        self.short = set()
+        self._lock = threading.Lock()
+        names = [(key, name.lower()) for key, name in names if name]
+        # count all the names first, so the trigrams chosen do not
+        # depend on the order of the names
+        for key, name in names:
+            self.names[key] = name
+            for trigram in self._trigrams(name):
+                self.counts[trigram] += 1
+        for key, name in names:
+            self._index(key, name)
+
+    @staticmethod
+    def _trigrams(text):
+        return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+    def _index(self, key, name):
+        trigrams = self._trigrams(name)
+        if not trigrams:
+            self.short.add(key)
+            return
+        trigram = min(trigrams, key=lambda t: (self.counts[t], t))
+        self.keys[key] = trigram
+        self.postings[trigram].add(key)
+
+    def add(self, key, name):
+        """ Index a name, replacing the previous name of the key """
+        with self._lock:
+            self._remove(key)
+            if not name:
+                return
+            name = name.lower()
+            self.names[key] = name
+            for trigram in self._trigrams(name):
+                self.counts[trigram] += 1
+            self._index(key, name)
+
+    def remove(self, key):
+        """ Remove the name of a key from the index """
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        name = self.names.pop(key, None)
+        if name is None:
+            return
+        for trigram in self._trigrams(name):
+            self.counts[trigram] -= 1
+        trigram = self.keys.pop(key, None)
+        if trigram is None:
+            self.short.discard(key)
+        else:
+            self.postings[trigram].discard(key)
+
+    def find(self, text):
+        """ Return the set of the keys whose name is in the text """
+        if not text:
+            return set()
+        text = text.lower()
+        with self._lock:
+            candidates = set(self.short)
+            for trigram in self._trigrams(text):
+                keys = self.postings.get(trigram)
+                if keys:
+                    candidates |= keys
+            return set(key for key in candidates
+                       if self.names[key] in text)
@@ -19,8 +19,16 @@
 #
 ##########################################################################
 
+import threading
+
+from openerp import pooler, tools
 from openerp.osv import orm, fields
 
+from .label_matcher import LabelMatcher, NameIndex
+
+# keys of the advisory lock of the transactions changing partner names
+NAME_INDEX_LOCK = "'res_partner_name_index_seq'::regclass::int, 0"
+
 
 class ResPartner(orm.Model):
     """Add a bank label on the partner so that we can use it to match
@@ -28,6 +36,14 @@ class ResPartner(orm.Model):
     """
     _inherit = 'res.partner'
 
+    # index of the names of all the partners, shared by the transactions
+    # of the process, see `_partner_name_index()`
+    _name_index = None
+    # value of res_partner_name_index_seq up to which the changes of
+    # names are in the index, None when the index has to be rebuilt
+    _name_index_version = None
+    _name_index_lock = threading.Lock()
+
     _columns = {
         'bank_statement_label': fields.char(
             'Bank Statement Label', size=100,
@@ -37,3 +53,182 @@ class ResPartner(orm.Model):
                  "long as you use this method/rules in your statement "
                  "profile)."),
     }
+
+    @tools.ormcache(skiparg=2)
+    def _bank_label_matcher(self, cr, uid):
+        """Return the labels of the partners compiled in a `LabelMatcher`
+        finding the ids of the partners. It is kept in the cache of the ORM
+        until a label changes."""
+        partner_ids = self.search(
+            cr, uid, [('bank_statement_label', '!=', False)])
+        labels = []
+        for partner in self.read(cr, uid, partner_ids,
+                                 ['bank_statement_label']):
+            for label in partner['bank_statement_label'].split(';'):
+                labels.append((label.strip(), partner['id']))
+        return LabelMatcher(labels)
+
+    def _auto_init(self, cr, context=None):
+        res = super(ResPartner, self)._auto_init(cr, context=context)
+        cr.execute("SELECT 1 FROM pg_class WHERE relkind = 'S' "
+                   "AND relname = 'res_partner_name_index_seq'")
+        if not cr.fetchone():
+            cr.execute("CREATE SEQUENCE res_partner_name_index_seq")
+            # last_value does not change on the first nextval
+            cr.execute("SELECT nextval('res_partner_name_index_seq')")
+        # version of the last change of the name of a partner, not a
+        # field of the ORM
+        cr.execute("SELECT 1 FROM information_schema.columns "
+                   "WHERE table_name = 'res_partner' "
+                   "AND column_name = 'name_index_version'")
+        if not cr.fetchone():
+            cr.execute("ALTER TABLE res_partner "
+                       "ADD COLUMN name_index_version integer")
+            cr.execute("CREATE INDEX res_partner_name_index_version_index "
+                       "ON res_partner (name_index_version)")
+        return res
+
+    # The index is shared by all the transactions of the process, it is
+    # never changed by what a transaction could roll back: names are only
+    # added, keyed on (partner id, name). A name rolled back or the
+    # previous name of a partner only gives a candidate which is verified
+    # on the database by the caller.
+    #
+    # A transaction changing names takes a shared advisory lock held until
+    # its end, then increments res_partner_name_index_seq and writes the
+    # new value in the name_index_version column of the partners. When no
+    # such transaction is running, all the versions up to the value of
+    # the sequence are committed: the processes add the names of the
+    # partners changed since the version of their index. While names are
+    # being changed, the index is used as it is, the names of the running
+    # transactions are not committed yet.
+
+    def _partner_name_index(self, cr, uid):
+        """Return the `NameIndex` of the names of all the partners, its
+        keys are tuples (partner id, name). The record rules, the active
+        flag and the current name have to be checked on the partners it
+        finds."""
+        cr.execute("SELECT last_value FROM res_partner_name_index_seq")
+        version = cr.fetchone()[0]
+        with self._name_index_lock:
+            index = self._name_index
+            index_version = self._name_index_version
+        if index is not None and index_version == version:
+            return index
+        # read the committed names with a new transaction, the one of
+        # the cursor may be older than the version
+        new_cr = pooler.get_db(cr.dbname).cursor()
+        try:
+            new_cr.execute("SELECT pg_try_advisory_lock(%s)" %
+                           NAME_INDEX_LOCK)
+            complete = new_cr.fetchone()[0]
+            if complete:
+                new_cr.execute("SELECT last_value "
+                               "FROM res_partner_name_index_seq")
+                version = new_cr.fetchone()[0]
+                new_cr.execute("SELECT pg_advisory_unlock(%s)" %
+                               NAME_INDEX_LOCK)
+            new_cr.commit()
+            if complete and index is not None and index_version is not None:
+                new_cr.execute("SELECT id, name FROM res_partner "
+                               "WHERE name_index_version > %s",
+                               (index_version,))
+                rows = new_cr.fetchall()
+            elif complete:
+                new_cr.execute("SELECT id, name FROM res_partner")
+                rows = new_cr.fetchall()
+        finally:
+            new_cr.close()
+        if not complete:
+            if index is not None:
+                return index
+            # names are being changed by running transactions, maybe
+            # this one: build the index with the names it sees, it is
+            # rebuilt once the names are committed
+            cr.execute("SELECT id, name FROM res_partner")
+            rows = cr.fetchall()
+            version = None
+        elif index is not None and index_version is not None:
+            for partner_id, name in rows:
+                index.add((partner_id, name), name)
+            with self._name_index_lock:
+                if self._name_index is index:
+                    self._name_index_version = version
+            return index
+        index = NameIndex(((partner_id, name), name)
+                          for partner_id, name in rows)
+        with self._name_index_lock:
+            self._name_index = index
+            self._name_index_version = version
+        return index
+
+    def _update_name_index(self, cr, ids, name):
+        """Add the new name of partners in the index of the process and
+        let the other processes add it in theirs."""
+        if not ids:
+            return
+        cr.execute("SELECT pg_advisory_xact_lock_shared(%s)" %
+                   NAME_INDEX_LOCK)
+        cr.execute("SELECT nextval('res_partner_name_index_seq')")
+        version = cr.fetchone()[0]
+        cr.execute("UPDATE res_partner SET name_index_version = %s "
+                   "WHERE id IN %s",
+                   (version, tuple(ids)))
+        with self._name_index_lock:
+            index = self._name_index
+        if index is None or not name:
+            return
+        for partner_id in ids:
+            index.add((partner_id, name), name)
+
+    def clear_caches(self):
+        with self._name_index_lock:
+            self._name_index = None
+        return super(ResPartner, self).clear_caches()
+
+    def _has_bank_label(self, cr, ids):
+        """Return True if one of the partners has a bank label, inactive
+        ones included"""
+        if not ids:
+            return False
+        cr.execute("SELECT 1 FROM res_partner "
+                   "WHERE id IN %s AND bank_statement_label <> '' LIMIT 1",
+                   (tuple(ids),))
+        return bool(cr.fetchone())
+
+    # The caches are cleared after the changes, otherwise a concurrent
+    # completion could fill them again with the labels before the
+    # changes. Only the changes of partners with a label clear them.
+
+    def create(self, cr, uid, vals, context=None):
+        partner_id = super(ResPartner, self).create(cr, uid, vals,
+                                                    context=context)
+        if vals.get('bank_statement_label'):
+            self._bank_label_matcher.clear_cache(self)
+        if vals.get('name'):
+            self._update_name_index(cr, [partner_id], vals['name'])
+        return partner_id
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(ResPartner, self).write(cr, uid, ids, vals,
+                                            context=context)
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        if ('bank_statement_label' in vals or
+                (set(vals) & set(['active', 'company_id']) and
+                 self._has_bank_label(cr, ids))):
+            self._bank_label_matcher.clear_cache(self)
+        if vals.get('name'):
+            self._update_name_index(cr, ids, vals['name'])
+        return res
+
+    def unlink(self, cr, uid, ids, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        has_label = self._has_bank_label(cr, ids)
+        res = super(ResPartner, self).unlink(cr, uid, ids, context=context)
+        if has_label:
+            self._bank_label_matcher.clear_cache(self)
+        # the names of the deleted partners stay in the name index, the
+        # partners are not found in the database by the verification
+        return res
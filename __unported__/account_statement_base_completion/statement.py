@@ -29,7 +29,6 @@ import datetime
 import psycopg2
 
 from collections import defaultdict
-import re
 from openerp.tools.translate import _
 from openerp.osv import orm, fields
 from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
@@ -110,6 +109,37 @@ class AccountStatementProfil(orm.Model):
                 return result
         return None
 
+    def _find_values_from_rules_batch(self, cr, uid, calls, lines,
+                                      context=None):
+        """Set-oriented version of `_find_values_from_rules`: each rule is
+        called once with all the lines which have not been matched by the
+        previous rules, so a rule costs a few queries per statement instead
+        of a few queries per line.
+
+        :param calls: list of rules sorted by sequence
+        :param list lines: reads of the account.bank.statement.line
+        :return: tuple with a dict {line_id: values} of the completed lines
+          and a dict {line_id: error message} of the lines in error
+        """
+        rule_obj = self.pool.get('account.statement.completion.rule')
+        results = {}
+        errors = {}
+        for call in calls:
+            if not lines:
+                break
+            found = rule_obj._call_rule_batch(cr, uid, call, lines,
+                                              context=context)
+            for line_id, vals in found.iteritems():
+                if isinstance(vals, Exception):
+                    errors[line_id] = repr(vals)
+                elif vals:
+                    vals['already_completed'] = True
+                    results[line_id] = vals
+            lines = [line for line in lines
+                     if line['id'] not in results and
+                     line['id'] not in errors]
+        return results, errors
+
 
 class AccountStatementCompletionRule(orm.Model):
     """This will represent all the completion method that we can have to
@@ -124,7 +154,13 @@ class AccountStatementCompletionRule(orm.Model):
     _order = "sequence asc"
 
     def _get_functions(self, cr, uid, context=None):
-        """List of available methods for rules. Override this to add you own."""
+        """List of available methods for rules. Override this to add you own.
+
+        A rule may also have a method working on a batch of lines, see
+        `_call_rule_batch`. When a module overrides the method of a rule
+        for one line without overriding its batch method, the rule is
+        called line by line so the override is applied.
+        """
         return [
             ('get_from_ref_and_invoice',
              'From line reference (based on customer invoice number)'),
@@ -140,6 +176,58 @@ class AccountStatementCompletionRule(orm.Model):
         """ Call method which can be inherited """
         return self._get_functions(cr, uid, context=context)
 
+    def _get_batch_method(self, function_name):
+        """Return the batch method of a rule function, or None when there
+        is none or when it is defined by a parent class of the class
+        defining the method for one line: the batch method would bypass
+        the override of the method for one line.
+        """
+        batch_name = '%s_batch' % function_name
+        for cls in type(self).__mro__:
+            if batch_name in vars(cls):
+                return getattr(self, batch_name)
+            if function_name in vars(cls):
+                return None
+        return None
+
+    def _call_rule_batch(self, cr, uid, rule, lines, context=None):
+        """Apply a rule on a batch of lines.
+
+        A rule can be implemented on a batch of lines by a method named
+        like its function suffixed by ``_batch``, with the signature
+        ``(cr, uid, rule_id, lines, context=None)``. It returns a dict
+        {line_id: values} with only the matched lines, or an exception
+        instance as value for the lines in error. Rules without such a
+        method, or whose method for one line is overridden by a module
+        which does not override the batch method, are called line by line.
+
+        :param rule: browse record of the rule
+        :param list lines: reads of the account.bank.statement.line
+        :return: dict {line_id: values or exception}
+        """
+        batch_method = self._get_batch_method(rule.function_to_call)
+        if batch_method is not None:
+            return batch_method(cr, uid, rule.id, lines, context=context)
+        method_to_call = getattr(self, rule.function_to_call)
+        with_rule_id = len(inspect.getargspec(method_to_call).args) == 6
+        res = {}
+        for line in lines:
+            try:
+                if with_rule_id:
+                    vals = method_to_call(cr, uid, rule.id, line, context)
+                else:
+                    vals = method_to_call(cr, uid, line, context)
+            except ErrorTooManyPartner, exc:
+                res[line['id']] = exc
+            except Exception, exc:
+                _logger.exception("Completion rule %s failed on line %s",
+                                  rule.function_to_call, line['id'])
+                res[line['id']] = exc
+            else:
+                if vals:
+                    res[line['id']] = vals
+        return res
+
     _columns = {
         'sequence': fields.integer('Sequence',
                                    help="Lower means parsed first."),
@@ -151,20 +239,21 @@ class AccountStatementCompletionRule(orm.Model):
         'function_to_call': fields.selection(__get_functions, 'Method'),
     }
 
-    def _find_invoice(self, cr, uid, st_line, inv_type, context=None):
-        """Find invoice related to statement line"""
-        inv_obj = self.pool.get('account.invoice')
+    def _get_invoice_number_field(self, inv_type):
+        """Return the invoice types and the number field to search for the
+        given type of completion"""
         if inv_type == 'supplier':
-            type_domain = ('in_invoice', 'in_refund')
-            number_field = 'supplier_invoice_number'
+            return ('in_invoice', 'in_refund'), 'supplier_invoice_number'
         elif inv_type == 'customer':
-            type_domain = ('out_invoice', 'out_refund')
-            number_field = 'number'
-        else:
-            raise orm.except_orm(
-                _('System error'),
-                _('Invalid invoice type for completion: %') % inv_type)
+            return ('out_invoice', 'out_refund'), 'number'
+        raise orm.except_orm(
+            _('System error'),
+            _('Invalid invoice type for completion: %') % inv_type)
 
+    def _find_invoice(self, cr, uid, st_line, inv_type, context=None):
+        """Find invoice related to statement line"""
+        inv_obj = self.pool.get('account.invoice')
+        type_domain, number_field = self._get_invoice_number_field(inv_type)
         inv_id = inv_obj.search(cr, uid,
                                 [(number_field, '=', st_line['ref'].strip()),
                                  ('type', 'in', type_domain)],
@@ -196,12 +285,87 @@ class AccountStatementCompletionRule(orm.Model):
                 partner_id = inv.commercial_partner_id.id
             else:
                 partner_id = inv.partner_id.id
-            res = {'partner_id': partner_id,
-                   'account_id': inv.account_id.id,
-                   'type': inv_type}
-            override_acc = line['master_account_id']
-            if override_acc:
-                res['account_id'] = override_acc
+            res = self._get_invoice_values(partner_id, inv.account_id.id,
+                                           line, inv_type)
+        return res
+
+    def _get_invoice_values(self, partner_id, account_id, line, inv_type):
+        """Statement line values for a line matching an invoice"""
+        res = {'partner_id': partner_id,
+               'account_id': account_id,
+               'type': inv_type}
+        override_acc = line['master_account_id']
+        if override_acc:
+            res['account_id'] = override_acc
+        return res
+
+    def _get_invoice_index(self, cr, uid, numbers, inv_type, context=None):
+        """Load in one query the invoices having one of the given numbers,
+        the record rules of the invoices are applied.
+
+        :param list numbers: invoice numbers to look for
+        :param str inv_type: 'customer' or 'supplier'
+        :return: dict {number: (commercial partner id, account id,
+          number of invoices)}, when more than one invoice has the number,
+          the partner and account are those of one of them
+        """
+        inv_obj = self.pool.get('account.invoice')
+        partner_obj = self.pool.get('res.partner')
+        type_domain, number_field = self._get_invoice_number_field(inv_type)
+        if not numbers:
+            return {}
+        query = inv_obj._where_calc(
+            cr, uid, [(number_field, 'in', list(numbers)),
+                      ('type', 'in', type_domain)],
+            context=context)
+        inv_obj._apply_ir_rules(cr, uid, query, 'read', context=context)
+        from_clause, where_clause, where_params = query.get_sql()
+        cr.execute('SELECT "account_invoice"."%s", '
+                   '       min("account_invoice".partner_id), '
+                   '       min("account_invoice".account_id), '
+                   '       count(*) '
+                   'FROM %s WHERE %s '
+                   'GROUP BY "account_invoice"."%s"' %
+                   (number_field, from_clause, where_clause, number_field),
+                   where_params)
+        rows = cr.fetchall()
+        # FIXME use only commercial_partner_id in 7.1, see _from_invoice
+        commercial = {}
+        if 'commercial_partner_id' in partner_obj._columns:
+            partner_ids = list(set(row[1] for row in rows if row[1]))
+            for partner in partner_obj.read(cr, uid, partner_ids,
+                                            ['commercial_partner_id'],
+                                            context=context):
+                if partner['commercial_partner_id']:
+                    commercial[partner['id']] = \
+                        partner['commercial_partner_id'][0]
+        return dict((number, (commercial.get(partner_id, partner_id),
+                              account_id, count))
+                    for number, partner_id, account_id, count in rows)
+
+    def _from_invoice_batch(self, cr, uid, lines, inv_type, context=None):
+        """Batch version of `_from_invoice`: the invoices of all the lines
+        are loaded at once with `_get_invoice_index`"""
+        lines_by_ref = defaultdict(list)
+        for line in lines:
+            if line['ref'] and line['ref'].strip():
+                lines_by_ref[line['ref'].strip()].append(line)
+        invoices = self._get_invoice_index(cr, uid, lines_by_ref.keys(),
+                                           inv_type, context=context)
+        res = {}
+        for ref, ref_lines in lines_by_ref.iteritems():
+            if ref not in invoices:
+                continue
+            partner_id, account_id, count = invoices[ref]
+            for line in ref_lines:
+                if count > 1:
+                    res[line['id']] = ErrorTooManyPartner(
+                        _('Line named "%s" (Ref:%s) was matched by more '
+                          'than one partner while looking on %s invoices') %
+                        (line['name'], line['ref'], inv_type))
+                else:
+                    res[line['id']] = self._get_invoice_values(
+                        partner_id, account_id, line, inv_type)
         return res
 
     # Should be private but data are initialised with no update XML
@@ -222,6 +386,12 @@ class AccountStatementCompletionRule(orm.Model):
         """
         return self._from_invoice(cr, uid, line, 'supplier', context=context)
 
+    def get_from_ref_and_supplier_invoice_batch(self, cr, uid, rule_id,
+                                                lines, context=None):
+        """Batch version of `get_from_ref_and_supplier_invoice`"""
+        return self._from_invoice_batch(cr, uid, lines, 'supplier',
+                                        context=context)
+
     # Should be private but data are initialised with no update XML
     def get_from_ref_and_invoice(self, cr, uid, line, context=None):
         """Match the partner based on the invoice number and the reference of
@@ -239,6 +409,12 @@ class AccountStatementCompletionRule(orm.Model):
         """
         return self._from_invoice(cr, uid, line, 'customer', context=context)
 
+    def get_from_ref_and_invoice_batch(self, cr, uid, rule_id, lines,
+                                       context=None):
+        """Batch version of `get_from_ref_and_invoice`"""
+        return self._from_invoice_batch(cr, uid, lines, 'customer',
+                                        context=context)
+
     # Should be private but data are initialised with no update XML
     def get_from_label_and_partner_field(self, cr, uid, st_line, context=None):
         """
@@ -258,48 +434,36 @@ class AccountStatementCompletionRule(orm.Model):
             ...}
             """
         partner_obj = self.pool['res.partner']
-        st_obj = self.pool.get('account.bank.statement.line')
         res = {}
-        # As we have to iterate on each partner for each line,
-        #  we memoize the pair to avoid
-        # to redo computation for each line.
-        # Following code can be done by a single SQL query
-        # but this option is not really maintanable
-        if not context.get('label_memoizer'):
-            context['label_memoizer'] = defaultdict(list)
-            partner_ids = partner_obj.search(
-                cr, uid, [('bank_statement_label', '!=', False)],
-                context=context)
-            line_ids = context.get('line_ids', [])
-            for partner in partner_obj.browse(cr, uid, partner_ids,
-                                              context=context):
-                vals = '|'.join(
-                    re.escape(x.strip())
-                    for x in partner.bank_statement_label.split(';'))
-                or_regex = ".*%s.*" % vals
-                sql = ("SELECT id from account_bank_statement_line"
-                       " WHERE id in %s"
-                       " AND name ~* %s")
-                cr.execute(sql, (line_ids, or_regex))
-                pairs = cr.fetchall()
-                for pair in pairs:
-                    context['label_memoizer'][pair[0]].append(partner)
-        if st_line['id'] in context['label_memoizer']:
-            found_partner = context['label_memoizer'][st_line['id']]
-            if len(found_partner) > 1:
-                msg = (_('Line named "%s" (Ref:%s) was matched by more than '
-                         'one partner while looking on partner label: %s') %
-                       (st_line['name'], st_line['ref'],
-                        ','.join([x.name for x in found_partner])))
-                raise ErrorTooManyPartner(msg)
-            res['partner_id'] = found_partner[0].id
-            st_vals = st_obj.get_values_for_line(
-                cr, uid, profile_id=st_line['profile_id'],
-                master_account_id=st_line['master_account_id'],
-                partner_id=found_partner[0].id, line_type=False,
-                amount=st_line['amount'] if st_line['amount'] else 0.0,
-                context=context)
-            res.update(st_vals)
+        # The labels of all the partners are compiled once in an automaton
+        # kept in cache, which finds the partners in a single pass over
+        # the label of the line
+        matcher = partner_obj._bank_label_matcher(cr, uid)
+        found_partner = sorted(matcher.find(st_line['name']))
+        if len(found_partner) > 1:
+            msg = (_('Line named "%s" (Ref:%s) was matched by more than '
+                     'one partner while looking on partner label: %s') %
+                   (st_line['name'], st_line['ref'],
+                    ','.join([x['name'] for x in partner_obj.read(
+                        cr, uid, found_partner, ['name'],
+                        context=context)])))
+            raise ErrorTooManyPartner(msg)
+        if found_partner:
+            res = self._get_partner_line_values(
+                cr, uid, st_line, found_partner[0], context=context)
+        return res
+
+    def _get_partner_line_values(self, cr, uid, st_line, partner_id,
+                                 context=None):
+        """Statement line values for a line matching a partner"""
+        st_obj = self.pool.get('account.bank.statement.line')
+        res = {'partner_id': partner_id}
+        res.update(st_obj.get_values_for_line(
+            cr, uid, profile_id=st_line['profile_id'],
+            master_account_id=st_line['master_account_id'],
+            partner_id=partner_id, line_type=False,
+            amount=st_line['amount'] if st_line['amount'] else 0.0,
+            context=context))
         return res
 
     def get_from_label_and_partner_name(self, cr, uid, st_line, context=None):
@@ -318,34 +482,9 @@ class AccountStatementCompletionRule(orm.Model):
             ...}
             """
         res = {}
-        # We memoize allowed partner
-        if not context.get('partner_memoizer'):
-            context['partner_memoizer'] = tuple(
-                self.pool['res.partner'].search(cr, uid, []))
-        if not context['partner_memoizer']:
-            return res
-        st_obj = self.pool.get('account.bank.statement.line')
-        # The regexp_replace() escapes the name to avoid false positive
-        # example: 'John J. Doe (No 1)' is escaped to 'John J\. Doe \(No 1\)'
-        # See http://stackoverflow.com/a/400316/1504003 for a list of
-        # chars to escape. Postgres is POSIX-ARE, compatible with
-        # POSIX-ERE excepted that '\' must be escaped inside brackets according
-        # to:
-        #  http://www.postgresql.org/docs/9.0/static/functions-matching.html
-        # in chapter 9.7.3.6. Limits and Compatibility
-        sql = """
-        SELECT id FROM (
-            SELECT id,
-                regexp_matches(%s,
-                    regexp_replace(name,'([\.\^\$\*\+\?\(\)\[\{\\\|])', %s,
-                        'g'), 'i') AS name_match
-            FROM res_partner
-            WHERE id IN %s)
-            AS res_patner_matcher
-        WHERE name_match IS NOT NULL"""
-        cr.execute(
-            sql, (st_line['name'], r"\\\1", context['partner_memoizer']))
-        result = cr.fetchall()
+        matches = self._match_partner_names(cr, uid, [st_line],
+                                            context=context)
+        result = matches.get(st_line['id'])
         if not result:
             return res
         if len(result) > 1:
@@ -353,14 +492,68 @@ class AccountStatementCompletionRule(orm.Model):
                 _('Line named "%s" (Ref:%s) was matched by more than one '
                   'partner while looking on partner by name') %
                 (st_line['name'], st_line['ref']))
-        res['partner_id'] = result[0][0]
-        st_vals = st_obj.get_values_for_line(
-            cr, uid, profile_id=st_line['profile_id'],
-            master_account_id=st_line['master_account_id'],
-            partner_id=res['partner_id'], line_type=False,
-            amount=st_line['amount'] if st_line['amount'] else 0.0,
-            context=context)
-        res.update(st_vals)
+        return self._get_partner_line_values(cr, uid, st_line, result[0],
+                                             context=context)
+
+    def _match_partner_names(self, cr, uid, lines, context=None):
+        """Find the partners whose name is contained in the label of the
+        lines, ignoring the case.
+
+        The candidates are given by the name index of the partners, then
+        verified on their current name in the database.
+
+        :param list lines: reads of the account.bank.statement.line
+        :return: dict {line_id: list of partner ids}
+        """
+        partner_obj = self.pool['res.partner']
+        # We memoize allowed partner
+        if not context.get('partner_memoizer'):
+            context['partner_memoizer'] = frozenset(
+                partner_obj.search(cr, uid, []))
+        allowed = context['partner_memoizer']
+        index = partner_obj._partner_name_index(cr, uid)
+        candidates = {}
+        for line in lines:
+            found = set(partner_id for partner_id, __
+                        in index.find(line['name'])) & allowed
+            if found:
+                candidates[line['id']] = found
+        if not candidates:
+            return {}
+        cr.execute("SELECT id, name FROM res_partner WHERE id IN %s",
+                   (tuple(set().union(*candidates.values())),))
+        names = dict((partner_id, name.lower())
+                     for partner_id, name in cr.fetchall())
+        res = {}
+        for line in lines:
+            if line['id'] not in candidates:
+                continue
+            label = line['name'].lower()
+            found = sorted(partner_id for partner_id
+                           in candidates[line['id']]
+                           if names.get(partner_id) and
+                           names[partner_id] in label)
+            if found:
+                res[line['id']] = found
+        return res
+
+    def get_from_label_and_partner_name_batch(self, cr, uid, rule_id, lines,
+                                              context=None):
+        """Batch version of `get_from_label_and_partner_name`"""
+        res = {}
+        matches = self._match_partner_names(cr, uid, lines, context=context)
+        for line in lines:
+            found_partner = matches.get(line['id'])
+            if not found_partner:
+                continue
+            if len(found_partner) > 1:
+                res[line['id']] = ErrorTooManyPartner(
+                    _('Line named "%s" (Ref:%s) was matched by more than one '
+                      'partner while looking on partner by name') %
+                    (line['name'], line['ref']))
+            else:
+                res[line['id']] = self._get_partner_line_values(
+                    cr, uid, line, found_partner[0], context=context)
         return res
 
 
@@ -528,25 +721,93 @@ class AccountStatementLine(orm.Model):
             raise orm.except_orm(_("ORM bypass error"),
                                  sql_err.pgerror)
 
+    # number of lines updated by a query of `_update_lines`
+    _update_chunk_size = 1000
+
     def _update_line(self, cr, uid, vals, context=None):
         """ Do raw update into database because ORM is awfully slow
-            when cheking security.
-        TODO / WARM: sparse fields are skipped by the method. IOW, if your
-        completion rule update an sparse field, the updated value will never
-        be stored in the database. It would be safer to call the update method
-        from the ORM for records updating this kind of fields.
+            when cheking security. See `_update_lines`.
         """
-        cols = self._get_available_columns([vals])
-        vals = self._prepare_insert(vals, cols)
-        tmp_vals = (', '.join(['%s = %%(%s)s' % (i, i) for i in cols]))
-        sql = "UPDATE account_bank_statement_line " \
-              "SET %s where id = %%(id)s;" % tmp_vals
-        try:
-            cr.execute(sql, vals)
-        except psycopg2.Error as sql_err:
-            cr.rollback()
-            raise orm.except_orm(_("ORM bypass error"),
-                                 sql_err.pgerror)
+        return self._update_lines(cr, uid, [vals], context=context)
+
+    def _merge_sparse_fields(self, cr, uid, vals_list, context=None):
+        """ Move the values of the sparse fields in their serialized field,
+        merged with the values already stored for the lines.
+        Return a copy of vals_list
+        """
+        sparse_fields = dict(
+            (k, col) for k, col in self._columns.iteritems()
+            if isinstance(col, fields.sparse))
+        sparse_ids = [vals['id'] for vals in vals_list
+                      if set(vals) & set(sparse_fields)]
+        if not sparse_ids:
+            return vals_list
+        serialization_fields = sorted(set(
+            col.serialization_field for col in sparse_fields.itervalues()))
+        cr.execute("SELECT id, %s FROM account_bank_statement_line "
+                   "WHERE id IN %%s" % ', '.join(serialization_fields),
+                   (tuple(sparse_ids),))
+        stored = dict((row['id'], row) for row in cr.dictfetchall())
+        values = []
+        for vals in vals_list:
+            vals = vals.copy()
+            for k in set(vals) & set(sparse_fields):
+                field = sparse_fields[k].serialization_field
+                if field not in vals:
+                    vals[field] = simplejson.loads(
+                        stored[vals['id']][field] or '{}')
+                vals[field][k] = vals.pop(k)
+            values.append(vals)
+        return values
+
+    def _pg_cast_type(self, col):
+        """ Return the type to cast the values written in a column, without
+        the size of the type: the values are already truncated like the ORM
+        does in `_prepare_insert`, an overlong value must fail instead of
+        being truncated silently by a cast to varchar(n) """
+        return orm.get_pg_type(self._columns[col])[0].split('(')[0]
+
+    def _update_lines(self, cr, uid, vals_list, context=None):
+        """ Do raw update of many lines into database because ORM is awfully
+        slow when doing batch write. The lines are grouped by the columns
+        they update and each group is updated with a single query per
+        `_update_chunk_size` lines, joining the lines on a VALUES list.
+        The sparse fields are stored in their serialized field.
+
+        :param list vals_list: dicts of values to write, with the id of the
+          line in the 'id' key
+        """
+        groups = defaultdict(list)
+        for vals in self._merge_sparse_fields(cr, uid, vals_list,
+                                              context=context):
+            cols = self._get_available_columns([vals])
+            groups[tuple(cols)].append(self._prepare_insert(vals, cols))
+        size = self._update_chunk_size
+        for cols, store in groups.iteritems():
+            # the values of VALUES are untyped, cast them in the type of
+            # the column they are written in
+            set_clause = ', '.join(
+                '%s = v.%s::%s' % (col, col, self._pg_cast_type(col))
+                for col in cols)
+            row = '(%s)' % ', '.join(['%s'] * (len(cols) + 1))
+            for start in xrange(0, len(store), size):
+                chunk = store[start:start + size]
+                sql = ("UPDATE account_bank_statement_line AS l "
+                       "SET %s FROM (VALUES %s) AS v(id, %s) "
+                       "WHERE l.id = v.id" %
+                       (set_clause, ', '.join([row] * len(chunk)),
+                        ', '.join(cols)))
+                params = []
+                for vals in chunk:
+                    params.append(vals['id'])
+                    params.extend(vals[col] for col in cols)
+                try:
+                    cr.execute(sql, params)
+                except psycopg2.Error as sql_err:
+                    cr.rollback()
+                    raise orm.except_orm(_("ORM bypass error"),
+                                         sql_err.pgerror)
+        return True
 
 
 class AccountBankStatement(orm.Model):
@@ -591,6 +852,65 @@ class AccountBankStatement(orm.Model):
         self.message_post(cr, uid, [stat_id], body=body, context=context)
         return True
 
+    # number of lines completed in a transaction, or in a chunk of a
+    # background job
+    _completion_chunk_size = 500
+
+    def _complete_lines(self, cr, uid, stat, line_ids, context=None):
+        """Complete the given lines of a statement with the rules of its
+        profile, without committing. Every rule is applied once on all the
+        lines not completed by the previous rules.
+
+        :param stat: browse record of the statement
+        :param list line_ids: ids of the lines to complete
+        :return: tuple (number of completed lines, list of error messages)
+        """
+        if context is None:
+            context = {}
+        stat_line_obj = self.pool['account.bank.statement.line']
+        profile_obj = self.pool.get('account.statement.profile')
+        msg_lines = []
+        ctx = context.copy()
+        ctx['line_ids'] = tuple(line_ids)
+        b_profile = stat.profile_id
+        rules = profile_obj._get_rules(cr, uid, b_profile, context=context)
+        # Only for perfo even it gains almost nothing
+        profile_id = b_profile.id
+        master_account_id = b_profile.receivable_account_id
+        master_account_id = master_account_id.id if \
+            master_account_id else False
+        lines = []
+        for line in stat_line_obj.read(cr, uid, ctx['line_ids']):
+            if line.get('already_completed'):
+                continue
+            # performance trick
+            line['master_account_id'] = master_account_id
+            line['profile_id'] = profile_id
+            lines.append(line)
+        results, errors = profile_obj._find_values_from_rules_batch(
+            cr, uid, rules, lines, context=ctx)
+        compl_lines = len(results)
+        to_update = []
+        for line in lines:
+            if line['id'] in errors:
+                msg_lines.append(errors[line['id']])
+            res = results.get(line['id'])
+            if res:
+                res['id'] = line['id']
+                to_update.append(res)
+        if to_update:
+            try:
+                stat_line_obj._update_lines(
+                    cr, uid, to_update, context=context)
+            except Exception as exc:
+                msg_lines.append(repr(exc))
+                error_type, error_value, trbk = sys.exc_info()
+                st = "Error: %s\nDescription: %s\nTraceback:" % (
+                    error_type.__name__, error_value)
+                st += ''.join(traceback.format_tb(trbk, 30))
+                _logger.error(st)
+        return compl_lines, msg_lines
+
     def button_auto_completion(self, cr, uid, ids, context=None):
         """Complete line with values given by rules and tic the
         already_completed checkbox so we won't compute them again unless the
@@ -599,58 +919,88 @@ class AccountBankStatement(orm.Model):
         if context is None:
             context = {}
         stat_line_obj = self.pool['account.bank.statement.line']
-        profile_obj = self.pool.get('account.statement.profile')
-        compl_lines = 0
         stat_line_obj.check_access_rule(cr, uid, [], 'create')
         stat_line_obj.check_access_rights(
             cr, uid, 'create', raise_exception=True)
+        size = self._completion_chunk_size
         for stat in self.browse(cr, uid, ids, context=context):
+            line_ids = [x.id for x in stat.line_ids]
+            compl_lines = 0
             msg_lines = []
-            ctx = context.copy()
-            ctx['line_ids'] = tuple((x.id for x in stat.line_ids))
-            b_profile = stat.profile_id
-            rules = profile_obj._get_rules(cr, uid, b_profile, context=context)
-            # Only for perfo even it gains almost nothing
-            profile_id = b_profile.id
-            master_account_id = b_profile.receivable_account_id
-            master_account_id = master_account_id.id if \
-                master_account_id else False
-            res = False
-            for line in stat_line_obj.read(cr, uid, ctx['line_ids']):
-                try:
-                    # performance trick
-                    line['master_account_id'] = master_account_id
-                    line['profile_id'] = profile_id
-                    res = stat_line_obj._get_line_values_from_rules(
-                        cr, uid, line, rules, context=ctx)
-                    if res:
-                        compl_lines += 1
-                except ErrorTooManyPartner, exc:
-                    msg_lines.append(repr(exc))
-                except Exception, exc:
-                    msg_lines.append(repr(exc))
-                    error_type, error_value, trbk = sys.exc_info()
-                    st = "Error: %s\nDescription: %s\nTraceback:" % (
-                        error_type.__name__, error_value)
-                    st += ''.join(traceback.format_tb(trbk, 30))
-                    _logger.error(st)
-                if res:
-                    # stat_line_obj.write(cr, uid, [line.id], vals, context=ctx)
-                    try:
-                        stat_line_obj._update_line(
-                            cr, uid, res, context=context)
-                    except Exception as exc:
-                        msg_lines.append(repr(exc))
-                        error_type, error_value, trbk = sys.exc_info()
-                        st = "Error: %s\nDescription: %s\nTraceback:" % (
-                            error_type.__name__, error_value)
-                        st += ''.join(traceback.format_tb(trbk, 30))
-                        _logger.error(st)
-                    # we can commit as it is not needed to be atomic
-                    # commiting here adds a nice perfo boost
-                    if not compl_lines % 500:
-                        cr.commit()
+            for start in xrange(0, len(line_ids), size):
+                count, messages = self._complete_lines(
+                    cr, uid, stat, line_ids[start:start + size],
+                    context=context)
+                compl_lines += count
+                msg_lines += messages
+                # we can commit as it is not needed to be atomic
+                # commiting here adds a nice perfo boost
+                if start + size < len(line_ids):
+                    cr.commit()
             msg = u'\n'.join(msg_lines)
             self.write_completion_log(cr, uid, stat.id,
                                       msg, compl_lines, context=context)
         return True
+
+    def _completion_chunks(self, cr, uid, ids, context=None):
+        """Return the payloads of the job chunks completing the lines of
+        the statements, each chunk holding at most
+        `_completion_chunk_size` lines of a statement.
+        """
+        size = self._completion_chunk_size
+        chunks = []
+        for stat in self.browse(cr, uid, ids, context=context):
+            line_ids = [x.id for x in stat.line_ids]
+            for start in xrange(0, len(line_ids), size):
+                chunks.append({'statement_id': stat.id,
+                               'line_ids': line_ids[start:start + size]})
+        return chunks
+
+    def enqueue_auto_completion(self, cr, uid, ids, context=None):
+        """Complete the statements in the background. When called from
+        a chunk of a job, the completion is appended to this job.
+
+        :return: id of the job
+        """
+        if context is None:
+            context = {}
+        stat_line_obj = self.pool['account.bank.statement.line']
+        stat_line_obj.check_access_rule(cr, uid, [], 'create')
+        stat_line_obj.check_access_rights(
+            cr, uid, 'create', raise_exception=True)
+        job_obj = self.pool.get('account.job')
+        if job_obj is None:
+            raise orm.except_orm(
+                _('Error'),
+                _('The module account_job_queue must be installed to run '
+                  'the completion in the background.'))
+        chunks = self._completion_chunks(cr, uid, ids, context=context)
+        job_id = context.get('job_id')
+        if job_id:
+            job_obj.add_chunks(cr, uid, job_id, chunks, context=context)
+            return job_id
+        names = [stat.name for stat in
+                 self.browse(cr, uid, ids, context=context)]
+        return job_obj.enqueue(
+            cr, uid, _('Completion of %s') % ', '.join(names),
+            self._name, 'complete_lines_chunk', chunks, context=context)
+
+    def button_auto_completion_background(self, cr, uid, ids, context=None):
+        """Same as `button_auto_completion` but run in a background job
+
+        :return: action showing the progress of the job
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        job_id = self.enqueue_auto_completion(cr, uid, ids, context=context)
+        return self.pool['account.job'].open_job(
+            cr, uid, job_id, context=context)
+
+    def complete_lines_chunk(self, cr, uid, payload, context=None):
+        """Chunk of a job created by `enqueue_auto_completion`"""
+        stat = self.browse(cr, uid, payload['statement_id'], context=context)
+        compl_lines, msg_lines = self._complete_lines(
+            cr, uid, stat, payload['line_ids'], context=context)
+        self.write_completion_log(cr, uid, stat.id, u'\n'.join(msg_lines),
+                                  compl_lines, context=context)
+        return compl_lines
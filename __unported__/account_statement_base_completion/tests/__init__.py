@@ -21,7 +21,9 @@
 #
 
 from . import test_base_completion
+from . import test_label_matcher
 
 checks = [
-    test_base_completion
+    test_base_completion,
+    test_label_matcher,
 ]
@@ -22,6 +22,10 @@
 from openerp.tests import common
 import time
 from collections import namedtuple
+from openerp.addons.account_statement_base_completion.statement import (
+    ErrorTooManyPartner)
+
+completion_rule = namedtuple("completion_rule", ["id", "function_to_call"])
 
 name_completion_case = namedtuple(
     "name_completion_case", ["partner_name", "line_label", "should_match"])
@@ -118,3 +122,124 @@ class base_completion(common.TransactionCase):
                     self.partner_id, statement_line.partner_id['id'],
                     "Partner id should be empty after completion(partner_name: "
                     "%s, line_name: %s)" % (case.partner_name, case.line_label))
+
+    def _add_test_rule(self, name, function):
+        """Add a rule function for one line on the rule model, removed at
+        the end of the test"""
+        rule_obj = self.registry('account.statement.completion.rule')
+        setattr(rule_obj, name, function)
+        self.addCleanup(delattr, rule_obj, name)
+        return completion_rule(False, name)
+
+    def test_rules_order_batch(self):
+        """Test the rules are applied in their order, each on the lines
+        not completed by the previous ones"""
+        called = {'first': [], 'second': []}
+
+        def first_rule(cr, uid, line, context=None):
+            called['first'].append(line['id'])
+            if line['ref'] in ('A', 'AB'):
+                return {'partner_id': 1}
+            return {}
+
+        def second_rule(cr, uid, line, context=None):
+            called['second'].append(line['id'])
+            if line['ref'] in ('AB', 'B'):
+                return {'partner_id': 2}
+            return {}
+
+        rules = [self._add_test_rule('test_first_rule', first_rule),
+                 self._add_test_rule('test_second_rule', second_rule)]
+        lines = [{'id': 1, 'ref': 'A'},
+                 {'id': 2, 'ref': 'AB'},
+                 {'id': 3, 'ref': 'B'},
+                 {'id': 4, 'ref': 'C'}]
+        results, errors = self.profile_obj._find_values_from_rules_batch(
+            self.cr, self.uid, rules, lines)
+        self.assertEquals(called['first'], [1, 2, 3, 4])
+        self.assertEquals(called['second'], [3, 4])
+        self.assertEquals(results[1]['partner_id'], 1)
+        self.assertEquals(results[2]['partner_id'], 1)
+        self.assertEquals(results[3]['partner_id'], 2)
+        self.assertTrue(results[1]['already_completed'])
+        self.assertNotIn(4, results)
+        self.assertEquals(errors, {})
+
+    def test_rules_errors_batch(self):
+        """Test the errors of a rule are reported on their line only and
+        the lines in error are not given to the next rules"""
+        called = []
+
+        def failing_rule(cr, uid, line, context=None):
+            if line['ref'] == 'TOO MANY':
+                raise ErrorTooManyPartner('Line named "%s" was matched by '
+                                          'more than one partner.' %
+                                          line['ref'])
+            if line['ref'] == 'BROKEN':
+                raise ValueError('broken line')
+            if line['ref'] == 'OK':
+                return {'partner_id': 1}
+            return {}
+
+        def next_rule(cr, uid, line, context=None):
+            called.append(line['id'])
+            return {'partner_id': 2}
+
+        rules = [self._add_test_rule('test_failing_rule', failing_rule),
+                 self._add_test_rule('test_next_rule', next_rule)]
+        lines = [{'id': 1, 'ref': 'TOO MANY'},
+                 {'id': 2, 'ref': 'BROKEN'},
+                 {'id': 3, 'ref': 'OK'},
+                 {'id': 4, 'ref': 'OTHER'}]
+        results, errors = self.profile_obj._find_values_from_rules_batch(
+            self.cr, self.uid, rules, lines)
+        self.assertEquals(sorted(errors), [1, 2])
+        self.assertIn('more than one partner', errors[1])
+        self.assertIn('broken line', errors[2])
+        self.assertEquals(results[3]['partner_id'], 1)
+        self.assertEquals(results[4]['partner_id'], 2)
+        self.assertEquals(called, [4])
+
+    def test_batch_method_override(self):
+        """Test the batch method of a rule is not used when a module
+        overrides the method for one line only"""
+        rule_obj = self.registry('account.statement.completion.rule')
+        function = 'get_from_ref_and_invoice'
+        self.assertEquals(rule_obj._get_batch_method(function),
+                          getattr(rule_obj, function + '_batch'))
+
+        def get_from_ref_and_invoice(obj, cr, uid, st_line, context=None):
+            return {}
+
+        override = type('TestRuleOverride', (type(rule_obj),),
+                        {'_register': False,
+                         function: get_from_ref_and_invoice})
+        rule = object.__new__(override)
+        self.assertIsNone(rule._get_batch_method(function))
+
+    def test_update_lines_sparse(self):
+        """Test a completed sparse field is merged into its serialized
+        field, keeping the other values of the serialized field"""
+        statement_id = self.account_bank_statement_obj.create(
+            self.cr, self.uid, {
+                "balance_end_real": 0.0,
+                "balance_start": 0.0,
+                "date": time.strftime('%Y-%m-%d'),
+                "journal_id": self.journal_id,
+            })
+        line_obj = self.account_bank_statement_line_obj
+        line_id = line_obj.create(self.cr, self.uid, {
+            'amount': 1000.0,
+            'name': 'Line with a label',
+            'ref': 'My ref',
+            'statement_id': statement_id,
+            'additionnal_bank_fields': {'other': 'kept'},
+        })
+        line_obj._update_lines(self.cr, self.uid, [
+            {'id': line_id, 'label': 'Completed label',
+             'partner_id': self.partner_id}])
+        line = line_obj.browse(self.cr, self.uid, line_id)
+        self.assertEquals(line.additionnal_bank_fields,
+                          {'other': 'kept', 'label': 'Completed label'})
+        self.assertEquals(line.label, 'Completed label')
+        self.assertEquals(line.partner_id.id, self.partner_id)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2014 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import threading
+import unittest2
+
+from ..label_matcher import LabelMatcher, NameIndex
+
+
+class TestLabelMatcher(unittest2.TestCase):
+
+    def test_find(self):
+        matcher = LabelMatcher([('ACME', 1), ('Camptocamp', 2)])
+        self.assertEqual(matcher.find('Payment ACME 2014/0042'), set([1]))
+        self.assertEqual(matcher.find('Camptocamp and ACME'), set([1, 2]))
+        self.assertEqual(matcher.find('Nothing to find'), set())
+        self.assertEqual(matcher.find(''), set())
+        self.assertEqual(matcher.find(None), set())
+
+    def test_overlapping_labels(self):
+        matcher = LabelMatcher([('he', 1), ('she', 2), ('his', 3),
+                                ('hers', 4)])
+        self.assertEqual(matcher.find('ushers'), set([1, 2, 4]))
+        self.assertEqual(matcher.find('this'), set([3]))
+
+    def test_label_in_label(self):
+        matcher = LabelMatcher([('SHOP', 1), ('SHOP INC', 2),
+                                ('TOYSHOP', 3)])
+        self.assertEqual(matcher.find('TOYSHOP INC'), set([1, 2, 3]))
+        self.assertEqual(matcher.find('TOY SHOP'), set([1]))
+
+    def test_same_label_several_values(self):
+        matcher = LabelMatcher([('ACME', 1), ('ACME', 2)])
+        self.assertEqual(matcher.find('ACME'), set([1, 2]))
+
+    def test_case_folding(self):
+        matcher = LabelMatcher([('AcMe', 1), (u'Caf\xc9', 2)])
+        self.assertEqual(matcher.find('payment acme'), set([1]))
+        self.assertEqual(matcher.find('PAYMENT ACME'), set([1]))
+        self.assertEqual(matcher.find(u'CAF\xc9 DU COMMERCE'), set([2]))
+
+    def test_empty_labels_ignored(self):
+        matcher = LabelMatcher([('', 1), ('ACME', 2)])
+        self.assertEqual(matcher.find('ACME'), set([2]))
+        self.assertEqual(matcher.find('anything'), set())
+        self.assertEqual(LabelMatcher([]).find('anything'), set())
+
+
+class TestNameIndex(unittest2.TestCase):
+
+    def test_find(self):
+        index = NameIndex([(1, 'Camptocamp'), (2, 'Acsone SA'),
+                           (3, 'Akretion')])
+        self.assertEqual(index.find('Payment from CAMPTOCAMP'), set([1]))
+        self.assertEqual(index.find('acsone sa and akretion'), set([2, 3]))
+        self.assertEqual(index.find('Acsone'), set())
+        self.assertEqual(index.find(''), set())
+        self.assertEqual(index.find(None), set())
+
+    def test_name_in_name(self):
+        index = NameIndex([(1, 'Shop'), (2, 'Toy Shop'), (3, 'Shopping')])
+        self.assertEqual(index.find('Toy Shop Inc'), set([1, 2]))
+        self.assertEqual(index.find('Shopping'), set([1, 3]))
+
+    def test_short_names(self):
+        index = NameIndex([(1, 'AB'), (2, 'X'), (3, '')])
+        self.assertEqual(index.find('ab'), set([1]))
+        self.assertEqual(index.find('XYZ'), set([2]))
+        self.assertEqual(index.find('Z'), set())
+        self.assertNotIn(3, index.names)
+
+    def test_add_replaces_name(self):
+        index = NameIndex([(1, 'Camptocamp')])
+        index.add(1, 'Akretion')
+        self.assertEqual(index.find('Camptocamp'), set())
+        self.assertEqual(index.find('Akretion'), set([1]))
+        index.add(2, 'Acsone')
+        self.assertEqual(index.find('Akretion and Acsone'), set([1, 2]))
+
+    def test_remove(self):
+        index = NameIndex([(1, 'Camptocamp'), (2, 'AB')])
+        index.remove(1)
+        index.remove(2)
+        index.remove(3)
+        self.assertEqual(index.find('Camptocamp AB'), set())
+        self.assertEqual(index.names, {})
+
+    def test_same_as_brute_force(self):
+        names = [(1, 'Jean'), (2, 'Jeanne'), (3, 'Anne'), (4, 'Ann'),
+                 (5, 'Jean-Marc'), (6, 'Marc'), (7, 'Jo')]
+        index = NameIndex(names)
+        index.add(8, 'Marco')
+        index.remove(3)
+        names = dict(names)
+        names[8] = 'Marco'
+        del names[3]
+        for text in ('Jeanne et Marco', 'JEAN-MARC', 'Joanne', 'Annie',
+                     'Marc Anne'):
+            expected = set(key for key, name in names.iteritems()
+                           if name.lower() in text.lower())
+            self.assertEqual(index.find(text), expected)
+
+    def test_threads(self):
+        """ The index can be updated while other threads search it """
+        index = NameIndex((key, 'Partner %d' % key) for key in range(100))
+        errors = []
+
+        def update():
+            try:
+                for key in range(100, 2000):
+                    index.add(key, 'Partner %d' % key)
+                    index.remove(key - 50)
+            except Exception as exc:
+                errors.append(exc)
+
+        def search():
+            try:
+                for __ in range(2000):
+                    index.find('Payment of Partner 1 and Partner 99')
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=update)]
+        threads += [threading.Thread(target=search) for __ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(index.find('Partner 1999'), set([1, 19, 1999]))
+        self.assertEqual(index.find('Partner 1949'), set([1, 19]))
@@ -109,19 +109,10 @@ class AccountStatementProfil(orm.Model):
         statement_line_obj = self.pool['account.bank.statement.line']
         values = parser_vals
         values['statement_id'] = statement_id
-        date = values.get('date')
-        period_memoizer = context.get('period_memoizer')
-        if not period_memoizer:
-            period_memoizer = {}
-            context['period_memoizer'] = period_memoizer
-        if period_memoizer.get(date):
-            values['period_id'] = period_memoizer[date]
-        else:
-            # This is awfully slow...
-            periods = self.pool.get('account.period').find(
-                cr, uid, dt=values.get('date'), context=context)
-            values['period_id'] = periods[0]
-            period_memoizer[date] = periods[0]
+        # the periods are kept in memory by account_period_cache
+        periods = self.pool['account.period'].find(
+            cr, uid, dt=values.get('date'), context=context)
+        values['period_id'] = periods[0]
         values = statement_line_obj._add_missing_default_values(
             cr, uid, values, context)
         return values
@@ -169,6 +160,17 @@ class AccountStatementProfil(orm.Model):
             res.append(statement_id)
         return res
 
+    def import_statement_chunk(self, cr, uid, payload, context=None):
+        """Chunk of a job importing a statement file stored as attachment,
+        see `credit.statement.import`.`import_statement_background`.
+        """
+        ctx = dict(context or {}, file_name=payload['file_name'])
+        attachment = self.pool['ir.attachment'].browse(
+            cr, uid, payload['attachment_id'], context=ctx)
+        return self.multi_statement_import(
+            cr, uid, False, payload['profile_id'], attachment.datas,
+            payload['ftype'], context=ctx)
+
     def _statement_import(self, cr, uid, ids, prof, parser, file_stream,
                           ftype="csv", context=None):
         """Create a bank statement with the given profile and parser. It will
@@ -231,9 +233,15 @@ class AccountStatementProfil(orm.Model):
             }
             attachment_obj.create(cr, uid, attachment_data, context=context)
             # If user ask to launch completion at end of import, do it!
+            # When imported in a background job, the completion is
+            # appended to the job.
             if prof.launch_import_completion:
-                statement_obj.button_auto_completion(
-                    cr, uid, [statement_id], context)
+                if context and context.get('job_id'):
+                    statement_obj.enqueue_auto_completion(
+                        cr, uid, [statement_id], context=context)
+                else:
+                    statement_obj.button_auto_completion(
+                        cr, uid, [statement_id], context)
             # Write the needed log infos on profile
             self.write_logs_after_import(cr, uid, prof.id,
                                          statement_id,
@@ -118,3 +118,38 @@ class CreditPartnerStatementImporter(orm.TransientModel):
         res = action_obj.read(cr, uid, action_id)
         res['domain'] = res['domain'][:-1] + ",('id', 'in', %s)]" % sid
         return res
+
+    def import_statement_background(self, cr, uid, req_id, context=None):
+        """Import the statement in a background job. The file is kept as
+        an attachment of the job until it is imported.
+        """
+        if isinstance(req_id, list):
+            req_id = req_id[0]
+        importer = self.browse(cr, uid, req_id, context)
+        ftype = self._check_extension(importer.file_name)
+        job_obj = self.pool.get('account.job')
+        if job_obj is None:
+            raise orm.except_orm(
+                _('Error'),
+                _('The module account_job_queue must be installed to '
+                  'import the statement in the background.'))
+        job_id = job_obj.enqueue(
+            cr, uid, _('Import of %s') % importer.file_name,
+            'account.statement.profile', 'import_statement_chunk', [],
+            context=context)
+        attachment_id = self.pool['ir.attachment'].create(
+            cr, uid,
+            {'name': importer.file_name,
+             'datas': importer.input_statement,
+             'datas_fname': importer.file_name,
+             'res_model': 'account.job',
+             'res_id': job_id},
+            context=context)
+        job_obj.add_chunks(
+            cr, uid, job_id,
+            [{'attachment_id': attachment_id,
+              'profile_id': importer.profile_id.id,
+              'ftype': ftype.replace('.', ''),
+              'file_name': importer.file_name}],
+            context=context)
+        return job_obj.open_job(cr, uid, job_id, context=context)
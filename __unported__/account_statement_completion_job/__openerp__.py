@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2014 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+{'name': 'Bank statement completion in background jobs',
+ 'version': '1.0',
+ 'author': 'Camptocamp',
+ 'maintainer': 'Camptocamp',
+ 'category': 'Finance',
+ 'complexity': 'easy',
+ 'depends': ['account_statement_base_completion',
+             'account_job_queue',
+             ],
+ 'description': """
+Add the button "Auto Completion in Background" on the bank statements,
+which runs the completion of their lines in a job of the module
+account_job_queue.
+
+Installed automatically with account_statement_base_completion and
+account_job_queue.
+ """,
+ 'website': 'http://www.camptocamp.com',
+ 'data': ['statement_view.xml'],
+ 'test': [],
+ 'installable': False,
+ 'images': [],
+ 'auto_install': True,
+ 'license': 'AGPL-3',
+ }
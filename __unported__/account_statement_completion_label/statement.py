@@ -112,6 +112,47 @@ class AccountStatementCompletionRule(orm.Model):
             res['account_id'] = label_info[0]['account_id']
         return res
 
+    def get_from_label_and_partner_field_batch(self, cr, uid, rule_id, lines,
+                                               context=None):
+        """Batch version of `get_from_label_and_partner_field`: the
+        statement labels are matched against all the lines in one query.
+        """
+        res = {}
+        if not lines:
+            return res
+        cr.execute("""
+            SELECT st_l.id,
+                   l.partner_id,
+                   l.account_id
+            FROM account_bank_statement_line as st_l
+            INNER JOIN account_bank_statement as s
+                ON st_l.statement_id = s.id
+            INNER JOIN account_statement_label as l
+                ON l.profile_id = s.profile_id
+            WHERE
+                st_l.name ~* l.label
+            AND
+                st_l.id IN %s
+                """, (tuple(line['id'] for line in lines),))
+        label_infos = defaultdict(list)
+        for line_id, partner, account in cr.fetchall():
+            label_infos[line_id].append({'partner_id': partner,
+                                         'account_id': account})
+        for line in lines:
+            label_info = label_infos.get(line['id'])
+            if not label_info:
+                continue
+            if len(label_info) > 1:
+                res[line['id']] = ErrorTooManyPartner(
+                    _('Line named "%s" (Ref:%s) was matched by more than one '
+                      'statement label.') % (line['name'], line['ref']))
+                continue
+            vals = {'account_id': label_info[0]['account_id']}
+            if label_info[0]['partner_id']:
+                vals['partner_id'] = label_info[0]['partner_id']
+            res[line['id']] = vals
+        return res
+
 
 class AccountStatementLabel(orm.Model):
     """Create a new class to map an account statement label to a partner
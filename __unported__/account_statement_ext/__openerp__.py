@@ -26,6 +26,7 @@
  'category': 'Finance',
  'complexity': 'normal',
  'depends': ['account',
+             'account_period_cache',
              'report_webkit',
              'account_voucher'],
  'description': """
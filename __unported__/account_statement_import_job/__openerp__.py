@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2014 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+{'name': 'Bank statement import in background jobs',
+ 'version': '1.0',
+ 'author': 'Camptocamp',
+ 'maintainer': 'Camptocamp',
+ 'category': 'Finance',
+ 'complexity': 'easy',
+ 'depends': ['account_statement_base_import',
+             'account_job_queue',
+             ],
+ 'description': """
+Add the button "Import in background" on the wizard importing the bank
+statements, which imports the file in a job of the module
+account_job_queue.
+
+Installed automatically with account_statement_base_import and
+account_job_queue.
+ """,
+ 'website': 'http://www.camptocamp.com',
+ 'data': ['wizard/import_statement_view.xml'],
+ 'test': [],
+ 'installable': False,
+ 'images': [],
+ 'auto_install': True,
+ 'license': 'AGPL-3',
+ }